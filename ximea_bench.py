@@ -0,0 +1,172 @@
+'''
+Benchmark of the ximea save pipeline on simulated cameras (see ximea_sim), so
+performance regressions can be caught on any linux box without a camera.
+
+Every combination of ims_per_file and write backend runs the real acquisition and
+save pipeline (start_multi_ximea_aquisition) for a number of seconds into out_dir,
+and reports sustained saved fps, missed/dropped frames, peak memory and chunk
+write latency percentiles.
+
+Usage:
+    python ximea_bench.py /mnt/data/bench --seconds 10 --fps 200 --ims_per_file 100 400 --backends buffered direct
+'''
+import os as os
+import shutil
+import threading
+import time
+import resource
+import logging
+import ximea_sim
+import ximea_utils
+from ximea_container import chunk_meta
+from ximea_packing import PIXEL_FORMATS, PIXEL_BITS, is_packed, frame_bytes
+from ximea_proxy import ProxyRecording
+
+def current_rss():
+    '''
+    Resident memory of this process in bytes
+    '''
+    with open('/proc/self/statm') as f:
+        return(int(f.read().split()[1]) * resource.getpagesize())
+
+def run_pipeline(out_dir, seconds=10, n_cams=1, imshape=(1544, 2064), fps=200, jitter=0.0,
+                 ims_per_file=400, write_backend='buffered', logger=None, pixel_format='uint8', **options):
+    '''
+    Record simulated cameras through the save pipeline for a while
+    Params:
+        out_dir (str): recording folder to create (on the disk to test)
+        seconds (float): how long to record
+        n_cams (int): simulated cameras recording at once
+        imshape (tuple): (height, width) of the frames
+        fps (float): frame rate of each camera
+        jitter (float): frame interval jitter, in periods
+        ims_per_file (int): frames per chunk file
+        write_backend (str): 'buffered' or 'direct'
+        pixel_format (str): pixel format the cameras deliver (see ximea_packing)
+        options: passed on to start_multi_ximea_aquisition (ring_slots, writer_mode,
+            chunk_format, compression, proxy_every, ...)
+    Returns:
+        results (dict)
+    '''
+    logger = logger or logging.getLogger(__name__)
+    cameras = [ximea_sim.Camera(k, imshape, fps, jitter, seed=k) for k in range(n_cams)]
+    for camera in cameras:
+        if(pixel_format != 'uint8'):
+            camera.set_imgdataformat('XI_FRM_TRANSPORT_DATA')
+            camera.set_output_bit_depth(f'XI_BPP_{PIXEL_BITS[pixel_format]}')
+            if is_packed(pixel_format):
+                camera.enable_output_bit_packing()
+        camera.start_acquisition()
+    images = [ximea_sim.Image() for _ in cameras]
+    cam_names = [f'sim_{k}' for k in range(n_cams)] if n_cams > 1 else ['ximea']
+    metas = [chunk_meta(imshape[0], imshape[1], pixel_format, 'RG', c.serial, '') for c in cameras]
+    stop = threading.Event()
+    recording = threading.Event()
+    saving = threading.Event()
+
+    rss_start = current_rss()
+    peak_rss = rss_start
+    t0 = time.perf_counter()
+    _, _, healths = ximea_utils.start_multi_ximea_aquisition(cameras, images, cam_names, out_dir, ims_per_file,
+                                                             stop, recording, saving, ximea_sim.SimulatedPool(), logger,
+                                                             frame_size=frame_bytes(imshape[0], imshape[1], pixel_format),
+                                                             chunk_metas=metas, write_backend=write_backend,
+                                                             **options)
+    while time.perf_counter() - t0 < seconds:
+        peak_rss = max(peak_rss, current_rss())
+        time.sleep(0.05)
+    stop.set()
+    t_stop = time.perf_counter()
+    #wait for the pipeline to wind down (the savers drain the rings)
+    time.sleep(0.2)
+    while recording.is_set() or saving.is_set():
+        peak_rss = max(peak_rss, current_rss())
+        time.sleep(0.05)
+    t_done = time.perf_counter()
+    for camera in cameras:
+        camera.stop_acquisition()
+
+    snaps = [h.snapshot() for h in healths]
+    latencies = [h.latency_percentiles((50, 90, 99)) for h in healths]
+    frames_saved = sum(s['frames_saved'] for s in snaps)
+    proxy_frames = sum(len(ProxyRecording(out_dir, cam_name)) for cam_name in cam_names) if options.get('proxy_every') else 0
+    bytes_written = sum(s['bytes_written'] for s in snaps)
+    return({'ims_per_file': ims_per_file,
+            'write_backend': write_backend,
+            'cameras': n_cams,
+            'seconds': t_stop - t0,
+            'drain_seconds': t_done - t_stop,
+            'frames_saved': frames_saved,
+            'fps': frames_saved / (t_stop - t0) / n_cams,
+            'target_fps': fps,
+            'missed_frames': sum(s['missed_frames'] for s in snaps),
+            'dropped_frames': sum(s['dropped_frames'] for s in snaps),
+            'proxy_frames': proxy_frames,
+            'write_MBps': bytes_written / (t_done - t0) / 1e6,
+            'peak_rss_MB': peak_rss / 1e6,
+            'rss_growth_MB': (peak_rss - rss_start) / 1e6,
+            'peak_child_rss_MB': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1e3,
+            'latency_p50_ms': max(l[0] for l in latencies) * 1e3,
+            'latency_p90_ms': max(l[1] for l in latencies) * 1e3,
+            'latency_p99_ms': max(l[2] for l in latencies) * 1e3,
+            'loop_period_p99_ms': max(s['loop_period_p99'] for s in snaps) * 1e3})
+
+def run_benchmark(out_dir, ims_per_files=(100, 400), backends=('buffered', 'direct'), keep=False, **kwargs):
+    '''
+    run_pipeline for every ims_per_file and write backend
+    Params:
+        out_dir (str): folder on the disk to test, each run records into its own subfolder
+        ims_per_files (list of int): chunk sizes to try
+        backends (list of str): write backends to try
+        keep (bool): keep the recordings instead of deleting them after each run
+        kwargs: passed on to run_pipeline
+    Returns:
+        results (list of dict)
+    '''
+    results = []
+    for ims_per_file in ims_per_files:
+        for backend in backends:
+            run_dir = os.path.join(out_dir, f'bench_{backend}_{ims_per_file}')
+            shutil.rmtree(run_dir, ignore_errors=True)
+            results.append(run_pipeline(run_dir, ims_per_file=ims_per_file, write_backend=backend, **kwargs))
+            if not keep:
+                shutil.rmtree(run_dir, ignore_errors=True)
+    return(results)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the ximea save pipeline with simulated cameras')
+    parser.add_argument('out_dir', help='folder on the disk to benchmark')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--cameras', type=int, default=1)
+    parser.add_argument('--fps', type=float, default=200)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--shape', type=int, nargs=2, default=(1544, 2064))
+    parser.add_argument('--ims_per_file', type=int, nargs='+', default=[100, 400])
+    parser.add_argument('--backends', nargs='+', default=['buffered', 'direct'])
+    parser.add_argument('--writer_mode', default='thread', choices=['thread', 'process'])
+    parser.add_argument('--chunk_format', default='indexed', choices=['indexed', 'raw'])
+    parser.add_argument('--ring_slots', type=int, default=64)
+    parser.add_argument('--sync_policy', default='chunk', choices=['chunk', 'interval', 'stop'])
+    parser.add_argument('--no_preallocate', action='store_true', help='let chunk files grow write by write')
+    parser.add_argument('--adaptive', action='store_true', help='let the savers choose the chunk size (ims_per_file is ignored)')
+    parser.add_argument('--pixel_format', default='uint8', choices=PIXEL_FORMATS)
+    parser.add_argument('--realtime', action='store_true', help='pin the pipeline to cores and hold off GC while recording')
+    parser.add_argument('--proxy_every', type=int, default=0, help='also write a proxy of every Nth frame')
+    parser.add_argument('--keep', action='store_true', help='keep the recordings')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmark(args.out_dir, args.ims_per_file, args.backends, args.keep,
+                            seconds=args.seconds, n_cams=args.cameras, imshape=tuple(args.shape),
+                            fps=args.fps, jitter=args.jitter, writer_mode=args.writer_mode,
+                            chunk_format=args.chunk_format, ring_slots=args.ring_slots, clock_sample_hz=0,
+                            sync_policy=args.sync_policy, preallocate=not args.no_preallocate,
+                            adaptive_chunks=args.adaptive, realtime=args.realtime, pixel_format=args.pixel_format,
+                            proxy_every=args.proxy_every)
+    for r in results:
+        print(f"{r['write_backend']:>8} ims_per_file {r['ims_per_file']:>5}: {r['fps']:.1f}/{r['target_fps']:.0f} fps, "
+              f"{r['missed_frames']:.0f} missed, {r['dropped_frames']:.0f} dropped, {r['write_MBps']:.0f} MB/s, "
+              f"peak rss {r['peak_rss_MB']:.0f} MB (+{r['rss_growth_MB']:.0f}), "
+              f"chunk latency p50/p90/p99 {r['latency_p50_ms']:.1f}/{r['latency_p90_ms']:.1f}/{r['latency_p99_ms']:.1f} ms, "
+              f"frame period p99 {r['loop_period_p99_ms']:.2f} ms"
+              + (f", {r['proxy_frames']} proxy frames" if args.proxy_every else ''))
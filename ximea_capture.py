@@ -19,6 +19,14 @@ from video_overlay.plugins.generic_overlay import Video_Overlay
 
 import threading
 import ximea_utils
+import ximea_codec
+import ximea_writers
+import ximea_preview
+import ximea_stripes
+import ximea_devices
+import ximea_preroll
+import ximea_realtime
+import ximea_packing
 
 #logging
 import logging
@@ -30,8 +38,12 @@ import cv2
 
 class Ximea_Capture(Plugin):
     """
-    Ximea Capture captures frames from a Ximea camera
+    Ximea Capture captures frames from one or more Ximea cameras
     during collection in parallel with world camera
+
+    serial_num, yaml_loc and cam_names take comma separated lists, one entry
+    per camera (a single yaml_loc is used for every camera). Each camera gets
+    its own acquisition pipeline and folder in the recording.
     """
     #icon_chr = chr(0xEC09)
     #icon_font = "pupil_icons"
@@ -41,7 +53,15 @@ class Ximea_Capture(Plugin):
     def __init__(self, g_pool,
     record_ximea=True, preview_ximea=False,
     serial_num='XECAS1922001', subject='TEST_SUBJECT', task='TEST_TASK',
-     yaml_loc='/home/vasha/cy.yaml', imshape=(1544, 2064), ims_per_file=400):
+     yaml_loc='/home/vasha/cy.yaml', imshape=(1544, 2064), ims_per_file=400,
+     ring_slots=64, ring_policy='block', writer_mode='thread', write_backend='buffered',
+     chunk_format='indexed', compression='none', compress_workers=4,
+     cam_names='', writer_procs=0, disk_budget_gb=0, min_free_gb=2, preview_cam=0,
+     preview_fps=15, preview_step=1, preview_every=10, clock_sample_hz=1.0,
+     stripe_dirs='', stripe_mode='round_robin', preallocate=True, sync_policy='chunk', sync_interval=5.0,
+     adaptive_chunks=False, min_ims_per_file=50, max_ims_per_file=2000,
+     preroll_seconds=0, preroll_budget_mb=2000, realtime=False, gc_mode='freeze',
+     proxy_every=0, proxy_step=4, proxy_quality=70):
         super().__init__(g_pool)
         self.order = 0.1
         #self.pupil_display_list = []
@@ -54,11 +74,57 @@ class Ximea_Capture(Plugin):
         self.task = task
         self.imshape = imshape
         self.ims_per_file = ims_per_file
+        self.ring_slots = ring_slots
+        self.ring_policy = ring_policy
+        self.writer_mode = writer_mode
+        self.write_backend = write_backend
+        self.chunk_format = chunk_format
+        self.compression = compression
+        self.compress_workers = compress_workers
+        self.cam_names = cam_names
+        self.writer_procs = writer_procs
+        self.disk_budget_gb = disk_budget_gb
+        self.min_free_gb = min_free_gb
+        self.preview_cam = preview_cam
+        self.preview_fps = preview_fps
+        self.preview_step = preview_step
+        self.preview_every = preview_every
+        self.clock_sample_hz = clock_sample_hz
+        self.stripe_dirs = stripe_dirs
+        self.stripe_mode = stripe_mode
+        self.preallocate = preallocate
+        self.sync_policy = sync_policy
+        self.sync_interval = sync_interval
+        self.adaptive_chunks = adaptive_chunks
+        self.min_ims_per_file = min_ims_per_file
+        self.max_ims_per_file = max_ims_per_file
+        self.preroll_seconds = preroll_seconds
+        self.preroll_budget_mb = preroll_budget_mb
+        self.realtime = realtime
+        self.gc_mode = gc_mode
+        self.proxy_every = proxy_every
+        self.proxy_step = proxy_step
+        self.proxy_quality = proxy_quality
 
+        self.cameras = []
+        self.image_handles = []
+        self.open_serials = []
         self.camera = None
         self.image_handle = None
         self.camera_open = False
-        self.save_queue =  None
+        self.frame_rings =  None
+        self.preview_taps = None
+        self.healths = None
+        self.health_text = None
+        self.preview_worker = None
+        self.recording_ximea = False
+        self.camera_worker = ximea_devices.CameraSetWorker(logger)
+        self.camera_worker.start()
+        self.camera_generation = 0
+        self.camera_text = None
+        self.camera_status = None
+        self.reopen_pending = False
+        self.prerolls = None
         self.blink_counter = 0
 
         #self.save_folder = g_pool.rec_dir
@@ -68,7 +134,7 @@ class Ximea_Capture(Plugin):
         self.currently_saving =  threading.Event()
 
         try:
-            self.camera, self.image_handle, self.camera_open = ximea_utils.init_camera(self.serial_num, self.yaml_loc, logger)
+            self.open_cameras()
         except Exception as e:
             logger.info(f'Problem with Opening Camera: {e}')
             self.preview_ximea = False
@@ -79,6 +145,162 @@ class Ximea_Capture(Plugin):
         # g_pool.get_timestamp = get_timestamp
         # g_pool.get_now = get_time_monotonic
 
+    def split_list(self, value):
+        return([v.strip() for v in str(value).split(',') if v.strip()])
+
+    def serial_nums(self):
+        return(self.split_list(self.serial_num))
+
+    def yaml_locs(self):
+        yamls = self.split_list(self.yaml_loc)
+        if len(yamls) == 1:
+            yamls = yamls * len(self.serial_nums())
+        return(yamls)
+
+    def camera_names(self):
+        """
+        Name of each camera, 'ximea' for a single unnamed camera (the original layout)
+        """
+        names = self.split_list(self.cam_names)
+        serials = self.serial_nums()
+        if len(names) == len(serials):
+            return(names)
+        if len(serials) == 1:
+            return(['ximea'])
+        return([f'ximea_{s}' for s in serials])
+
+    def open_cameras(self):
+        """
+        Ask the camera worker to (re)open every configured camera, in the background.
+        Cameras already open under the same serial number stay open and only get the
+        settings that changed applied. The new cameras are picked up in gl_display.
+        """
+        serials = self.serial_nums()
+        yamls = self.yaml_locs()
+        if len(yamls) != len(serials):
+            raise ValueError(f'{len(serials)} serial numbers but {len(yamls)} settings files')
+        if self.recording_ximea:
+            logger.info('Ximea cameras are recording, reopening them when the recording is done')
+            self.reopen_pending = True
+            return
+        #the worker is about to change the cameras, nothing else may use them meanwhile
+        self.stop_preroll()
+        self.stop_preview()
+        self.camera_open = False
+        self.camera_worker.request_open(serials, yamls)
+
+    def adopt_cameras(self):
+        """
+        Take over the cameras the camera worker finished opening
+        """
+        self.camera_generation = self.camera_worker.generation
+        self.open_serials, self.cameras, self.image_handles = self.camera_worker.cameras()
+        self.camera_open = self.camera_worker.state == 'open'
+        self.set_preview_cam(self.preview_cam)
+
+    def close_cameras(self):
+        self.stop_preroll()
+        self.stop_preview()
+        self.camera_worker.stop()
+        self.cameras = []
+        self.image_handles = []
+        self.open_serials = []
+        self.camera = None
+        self.image_handle = None
+        self.camera_open = False
+
+    def frame_sizes(self):
+        """
+        Size of a raw frame of every camera, in the pixel format it is set to (8 bit or
+        packed 10/12 bit, see ximea_packing)
+        """
+        return([ximea_utils.camera_frame_size(camera, self.imshape) if camera is not None else 0
+                for camera in self.cameras])
+
+    def ring_frame_size(self):
+        return(max(self.frame_sizes() + [int(np.prod(self.imshape))]))
+
+    def set_preview_cam(self, preview_cam):
+        """
+        Pick which camera the preview shows
+        """
+        self.preview_cam = preview_cam if preview_cam < len(self.cameras) else 0
+        if self.cameras:
+            self.camera = self.cameras[self.preview_cam]
+            self.image_handle = self.image_handles[self.preview_cam]
+        if self.preview_worker is not None:
+            self.stop_preview()
+            self.start_preview()
+
+    def start_preview(self):
+        """
+        Start grabbing preview frames from the preview camera in the background
+        """
+        pixel_format = ximea_packing.camera_pixel_format(self.camera) if self.camera is not None else 'uint8'
+        self.preview_worker = ximea_preview.PreviewWorker(self.camera, self.image_handle, self.imshape, logger,
+                                                          max_fps=self.preview_fps, step=self.preview_step,
+                                                          pixel_format=pixel_format)
+        if self.recording_ximea:
+            self.preview_worker.pause()
+            if self.preview_taps:
+                self.preview_worker.attach_tap(self.preview_taps[self.preview_cam])
+        elif self.preroll_tap() is not None:
+            self.preview_worker.pause()
+            self.preview_worker.attach_tap(self.preroll_tap())
+        self.preview_worker.start()
+
+    def start_preroll(self):
+        """
+        Keep the last preroll_seconds of frames of every camera in memory (within
+        preroll_budget_mb), saved ahead of the live frames when recording starts
+        """
+        if self.preview_worker is not None:
+            #the pre-roll reads the cameras now, the preview gets its frames through a tap
+            self.preview_worker.pause()
+        frame_size = self.ring_frame_size()
+        budget = self.preroll_budget_mb * 1e6 / max(len(self.cameras), 1)
+        self.prerolls = []
+        for camera, image_handle, frame_nbytes in zip(self.cameras, self.image_handles, self.frame_sizes()):
+            n_frames = ximea_preroll.preroll_frames(self.preroll_seconds, ximea_preroll.camera_fps(camera),
+                                                    frame_size, budget, self.ring_slots)
+            if camera is None or n_frames == 0:
+                logger.info('Pre-roll does not fit in its memory budget')
+                self.prerolls.append(None)
+                continue
+            preroll = ximea_preroll.PreRollWorker(camera, image_handle, self.g_pool, n_frames, frame_size,
+                                                  self.ring_slots, self.writer_mode, max(self.preview_every, 1), logger,
+                                                  frame_nbytes)
+            preroll.start()
+            self.prerolls.append(preroll)
+        if self.preview_worker is not None and self.preroll_tap() is not None:
+            self.preview_worker.attach_tap(self.preroll_tap())
+
+    def stop_preroll(self):
+        """
+        Stop the pre-roll and drop the frames it holds
+        """
+        if self.prerolls is None:
+            return
+        for preroll in self.prerolls:
+            if preroll is not None:
+                preroll.stop()
+        self.prerolls = None
+        if self.preview_worker is not None:
+            self.preview_worker.detach_tap()
+
+    def preroll_tap(self):
+        """
+        Tap on the pre-roll of the preview camera, None if it has none
+        """
+        if not self.prerolls or self.preview_cam >= len(self.prerolls) or self.prerolls[self.preview_cam] is None:
+            return(None)
+        return(self.prerolls[self.preview_cam].tap)
+
+    def stop_preview(self):
+        if self.preview_worker is not None:
+            self.preview_worker.stop()
+            self.preview_worker = None
+
     def init_ui(self):
         self.add_menu()
         self.menu.label = "Ximea Cpature"
@@ -94,6 +316,8 @@ class Ximea_Capture(Plugin):
             #     self.record_ximea = False
         def set_preview(preview_ximea):
             self.preview_ximea = preview_ximea
+            if not self.preview_ximea:
+                self.stop_preview()
             if(self.currently_recording.is_set() & self.preview_ximea):
                 logger.info('Cant preview while recording')
             # try:
@@ -105,10 +329,8 @@ class Ximea_Capture(Plugin):
             #     self.record_ximea = False
         def set_serial_num(new_serial_num):
             self.serial_num = new_serial_num
-            if not self.camera == None:
-                self.camera.close_device()
             try:
-                self.camera, self.image_handle, self.camera_open = ximea_utils.init_camera(self.serial_num, self.yaml_loc, logger)
+                self.open_cameras()
             except Exception as e:
                 logger.info(f'Problem with Serial Number: {e}')
                 self.preview_ximea = False
@@ -119,26 +341,91 @@ class Ximea_Capture(Plugin):
             self.task = new_task_name
         def set_yaml_loc(new_yaml_loc):
             self.yaml_loc = new_yaml_loc
-            if not self.camera == None:
-                self.camera.close_device()
             try:
-                self.camera, self.image_handle, self.camera_open = ximea_utils.init_camera(self.serial_num, self.yaml_loc, logger)
+                self.open_cameras()
             except Exception as e:
                 logger.info(r'Problem with Yaml File: {e}')
                 self.preview_ximea = False
                 self.record_ximea = False
         help_str = "Ximea Capture Captures frames from Ximea Cameras in Parallel with Record."
         self.menu.append(ui.Info_Text(help_str))
-        self.menu.append(ui.Text_Input("serial_num", self, setter=set_serial_num, label="Serial Number"))
+        self.camera_text = ui.Info_Text("Ximea cameras: closed")
+        self.camera_status = None
+        self.menu.append(self.camera_text)
+        self.health_text = ui.Info_Text("Not recording from Ximea Cameras.")
+        self.menu.append(self.health_text)
+        def set_cam_names(new_cam_names):
+            self.cam_names = new_cam_names
+        def set_stripe_dirs(new_stripe_dirs):
+            self.stripe_dirs = new_stripe_dirs
+        def set_preroll_seconds(new_preroll_seconds):
+            #restarted with the new size by gl_display
+            self.preroll_seconds = new_preroll_seconds
+            self.stop_preroll()
+        def set_preroll_budget_mb(new_preroll_budget_mb):
+            self.preroll_budget_mb = new_preroll_budget_mb
+            self.stop_preroll()
+        def set_preview_fps(new_preview_fps):
+            self.preview_fps = new_preview_fps
+            if self.preview_worker is not None:
+                self.preview_worker.max_fps = new_preview_fps
+        def set_preview_step(new_preview_step):
+            self.preview_step = new_preview_step
+            if self.preview_worker is not None:
+                self.preview_worker.step = new_preview_step
+        self.menu.append(ui.Text_Input("serial_num", self, setter=set_serial_num, label="Serial Number(s)"))
         self.menu.append(ui.Switch("preview_ximea",self, setter=set_preview, label="Preview Ximea Cameras"))
-        self.menu.append(ui.Text_Input("yaml_loc", self, setter=set_yaml_loc, label="Cam Settings Location"))
+        self.menu.append(ui.Slider("preview_cam", self, min=0, max=8, step=1, setter=self.set_preview_cam, label="Preview Camera #"))
+        self.menu.append(ui.Slider("preview_fps", self, min=1, max=60, step=1, setter=set_preview_fps, label="Preview FPS"))
+        self.menu.append(ui.Slider("preview_step", self, min=1, max=4, step=1, setter=set_preview_step, label="Preview Downscale"))
+        self.menu.append(ui.Slider("preview_every", self, min=0, max=100, step=1, label="Preview Every Nth Recorded Frame (0: off)"))
+        self.menu.append(ui.Text_Input("yaml_loc", self, setter=set_yaml_loc, label="Cam Settings Location(s)"))
+        self.menu.append(ui.Text_Input("cam_names", self, setter=set_cam_names, label="Camera Names"))
         self.menu.append(ui.Text_Input("subject", self, setter=set_subject_id, label="Subject ID"))
         self.menu.append(ui.Text_Input("task", self, setter=set_task_name, label="Task Name"))
         self.menu.append(ui.Switch("record_ximea",self, setter=set_record, label="Record From Ximea Cameras"))
+        self.menu.append(ui.Slider("ring_slots", self, min=8, max=512, step=8, label="Frame Buffer Slots"))
+        self.menu.append(ui.Selector("ring_policy", self, selection=['block', 'overwrite'], label="Full Buffer Policy"))
+        self.menu.append(ui.Selector("writer_mode", self, selection=['thread', 'process'], label="Frame Writer"))
+        self.menu.append(ui.Selector("write_backend", self, selection=['buffered', 'direct'], label="Write Backend"))
+        self.menu.append(ui.Selector("chunk_format", self, selection=['indexed', 'raw'], label="Chunk File Format"))
+        self.menu.append(ui.Selector("compression", self, selection=['none'] + ximea_codec.available_codecs(), label="Lossless Compression"))
+        self.menu.append(ui.Slider("compress_workers", self, min=1, max=16, step=1, label="Compression Threads"))
+        self.menu.append(ui.Slider("writer_procs", self, min=0, max=8, step=1, label="Writer Processes (0: one per camera)"))
+        self.menu.append(ui.Slider("disk_budget_gb", self, min=0, max=4000, step=10, label="Disk Budget GB (0: no limit)"))
+        self.menu.append(ui.Slider("min_free_gb", self, min=0, max=100, step=1, label="Keep Free GB"))
+        self.menu.append(ui.Text_Input("stripe_dirs", self, setter=set_stripe_dirs, label="Stripe Over Folders (other disks)"))
+        self.menu.append(ui.Selector("stripe_mode", self, selection=list(ximea_stripes.STRIPE_MODES), label="Striping"))
+        self.menu.append(ui.Switch("preallocate", self, label="Preallocate Chunk Files"))
+        self.menu.append(ui.Selector("sync_policy", self, selection=list(ximea_writers.SYNC_POLICIES), label="Sync Chunks to Disk"))
+        self.menu.append(ui.Slider("sync_interval", self, min=1, max=60, step=1, label="Sync Interval Seconds"))
+        self.menu.append(ui.Switch("adaptive_chunks", self, label="Adaptive Chunk Size"))
+        self.menu.append(ui.Slider("min_ims_per_file", self, min=10, max=1000, step=10, label="Min Frames per Chunk"))
+        self.menu.append(ui.Slider("max_ims_per_file", self, min=100, max=10000, step=100, label="Max Frames per Chunk"))
+        self.menu.append(ui.Slider("preroll_seconds", self, min=0, max=30, step=0.5, setter=set_preroll_seconds, label="Pre-roll Seconds (0: off)"))
+        self.menu.append(ui.Slider("preroll_budget_mb", self, min=100, max=32000, step=100, setter=set_preroll_budget_mb, label="Pre-roll Memory MB"))
+        self.menu.append(ui.Switch("realtime", self, label="Low Jitter Mode (pin cores, hold GC)"))
+        self.menu.append(ui.Selector("gc_mode", self, selection=list(ximea_realtime.GC_MODES), label="Garbage Collection While Recording"))
+        self.menu.append(ui.Slider("proxy_every", self, min=0, max=100, step=1, label="Proxy Every Nth Recorded Frame (0: off)"))
+        self.menu.append(ui.Slider("proxy_step", self, min=1, max=8, step=1, label="Proxy Downscale"))
+        self.menu.append(ui.Slider("proxy_quality", self, min=10, max=100, step=5, label="Proxy JPEG Quality"))
+        self.menu.append(ui.Slider("clock_sample_hz", self, min=0, max=20, step=0.5, label="Clock Sync Samples per Second"))
 
         # set_save_dir()
 
     def gl_display(self):
+        #pick up cameras the camera worker finished (re)opening
+        if self.camera_worker.generation != self.camera_generation:
+            self.adopt_cameras()
+        camera_state = self.camera_worker.state
+        if self.camera_text is not None and self.camera_status != (camera_state, self.camera_worker.message):
+            self.camera_status = (camera_state, self.camera_worker.message)
+            self.camera_text.text = f'Ximea cameras: {camera_state}' + (f' ({self.camera_worker.message})' if self.camera_worker.message else '')
+        cameras_settled = self.camera_open or not self.camera_worker.busy()
+        if(self.preroll_seconds and self.prerolls is None and self.camera_open
+           and not self.recording_ximea and not self.camera_worker.busy()):
+            self.start_preroll()
+
         # blink?
         if int(self.blink_counter / 10) % 2 == 1:
             if self.currently_recording.is_set():
@@ -147,25 +434,52 @@ class Ximea_Capture(Plugin):
                 draw_points_norm([(0.01,0.01)], size=35, color=RGBA(1.0, 0.1, 0.1, 0.8))
         self.blink_counter += 1
 
+        #refresh the pipeline health about once a second
+        if self.healths and self.health_text is not None and self.blink_counter % 30 == 0:
+            self.health_text.text = '\n'.join(h.status_text() for h in self.healths)
+
         if(self.preview_ximea):
-            if(self.currently_recording.is_set()):
+            if((self.currently_recording.is_set() or self.recording_ximea) and not self.preview_taps):
                 #if we are currently saving, don't grab images
                 im = np.ones((*self.imshape,3)).astype(np.uint8)
                 alp=0
-            elif(not self.camera_open):
+            elif(not self.camera_open and cameras_settled):
                 logger.info(f'Unable to Open Camera!')
                 self.preview_ximea = False
                 im = np.zeros((*self.imshape,3)).astype(np.uint8)
                 alp = 0.5
+            elif(not self.camera_open or self.camera_worker.busy()):
+                #cameras are being (re)opened in the background
+                im = np.zeros((*self.imshape,3)).astype(np.uint8)
+                alp = 0
             else:
-                im = ximea_utils.decode_ximea_frame(self.camera, self.image_handle, self.imshape, logger)
-                alp=1
+                #frames are grabbed and binned by the preview worker, just show the newest one
+                #(while recording, the worker shows frames from the recording's preview tap)
+                if self.preview_worker is None:
+                    self.start_preview()
+                elif not self.recording_ximea and self.preroll_tap() is None:
+                    self.preview_worker.resume()
+                _, im = self.preview_worker.latest()
+                if im is None:
+                    im = np.zeros((2, 2, 3)).astype(np.uint8)
+                    alp = 0
+                else:
+                    alp = 1
             #cv2.imshow('image',im)
             #cv2.imwrite('/home/vasha/img.png', im)
             gl_utils.make_coord_system_norm_based()
             draw_gl_texture(im, interpolation=True, alpha=alp)
 
-        if(self.record_ximea):
+        if self.recording_ximea and self.stop_collecting_event.is_set() and not self.currently_recording.is_set():
+            self.recording_ximea = False
+            self.preview_taps = None
+            if self.preview_worker is not None:
+                self.preview_worker.detach_tap()
+            if self.reopen_pending:
+                self.reopen_pending = False
+                self.open_cameras()
+
+        if(self.record_ximea and cameras_settled):
             if not self.camera_open:
                 logger.info('Camera Not Open!')
                 self.record_ximea = False
@@ -180,18 +494,66 @@ class Ximea_Capture(Plugin):
         if notification.get("subject") == 'recording.started':
             self.save_dir = os.path.join(notification.get("rec_path"),'ximea')
 
-            if(self.record_ximea):
-                logger.info('Starting Recording from Ximea Cameras...')
+            if(self.record_ximea and not self.camera_open):
+                logger.info(f'Ximea cameras are not open ({self.camera_worker.state}), recording WITHOUT them')
+            elif(self.record_ximea):
+                logger.info(f'Starting Recording from Ximea Cameras {self.camera_names()}...')
                 logger.info(f'Saving Ximea Frames at {self.save_dir}...')
                 self.stop_collecting_event.clear()
+                if(self.compression != 'none' and self.chunk_format == 'raw'):
+                    logger.info('Compressed frames need indexed chunks, switching chunk format to indexed')
+                    self.chunk_format = 'indexed'
                 os.mkdir(self.save_dir)
-                self.save_queue = ximea_utils.start_ximea_aquisition(self.camera, self.image_handle,
+                #the recording pipeline owns the cameras until it is done
+                self.recording_ximea = True
+                if self.preview_worker is not None:
+                    self.preview_worker.pause()
+                disk_budget = ximea_writers.DiskBudget(self.disk_budget_gb * 1e9, self.min_free_gb * 1e9)
+                self.frame_rings, self.preview_taps, self.healths = ximea_utils.start_multi_ximea_aquisition(self.cameras, self.image_handles,
+                                                   self.camera_names(),
                                                    self.save_dir, self.ims_per_file,
                                                    self.stop_collecting_event,
                                                    self.currently_recording,
                                                    self.currently_saving,
                                                    self.g_pool,
-                                                   logger)
+                                                   logger,
+                                                   frame_size=self.ring_frame_size(),
+                                                   ring_slots=self.ring_slots,
+                                                   ring_policy=self.ring_policy,
+                                                   writer_mode=self.writer_mode,
+                                                   writer_procs=self.writer_procs,
+                                                   disk_budget=disk_budget,
+                                                   preview_every=self.preview_every if self.preview_ximea else 0,
+                                                   clock_sample_hz=self.clock_sample_hz,
+                                                   chunk_metas=[ximea_utils.make_chunk_meta(camera, self.imshape, yaml_loc)
+                                                                for camera, yaml_loc in zip(self.cameras, self.yaml_locs())],
+                                                   write_backend=self.write_backend,
+                                                   chunk_format=self.chunk_format,
+                                                   compression=None if self.compression == 'none' else self.compression,
+                                                   compress_workers=self.compress_workers,
+                                                   stripe_dirs=[os.path.join(root, os.path.basename(os.path.normpath(notification.get("rec_path"))), 'ximea')
+                                                                for root in self.split_list(self.stripe_dirs)],
+                                                   stripe_mode=self.stripe_mode,
+                                                   preallocate=self.preallocate,
+                                                   sync_policy=self.sync_policy,
+                                                   sync_interval=self.sync_interval,
+                                                   adaptive_chunks=self.adaptive_chunks,
+                                                   min_ims_per_file=self.min_ims_per_file,
+                                                   max_ims_per_file=self.max_ims_per_file,
+                                                   prerolls=self.prerolls,
+                                                   realtime=self.realtime,
+                                                   gc_mode=self.gc_mode,
+                                                   proxy_every=self.proxy_every,
+                                                   proxy_step=self.proxy_step,
+                                                   proxy_quality=self.proxy_quality)
+                #the pre-roll rings are the recording's frame rings now
+                self.prerolls = None
+                if self.preview_taps[0] is None:
+                    self.preview_taps = None
+                    if self.preview_worker is not None:
+                        self.preview_worker.detach_tap()
+                elif self.preview_worker is not None:
+                    self.preview_worker.attach_tap(self.preview_taps[self.preview_cam])
                 ximea_utils.write_user_info(self.save_dir, self.subject, self.task)
 
             else:
@@ -229,6 +591,8 @@ class Ximea_Capture(Plugin):
         return(False)
 
     def deinit_ui(self):
+        self.health_text = None
+        self.camera_text = None
         self.remove_menu()
 
     def cleanup(self):
@@ -237,5 +601,4 @@ class Ximea_Capture(Plugin):
         This happens either voluntarily or forced.
         if you have an gui or glfw window destroy it here.
         """
-        if not self.camera == None:
-            self.camera.close_device()
+        self.close_cameras()
@@ -0,0 +1,187 @@
+'''
+Camera to pupil clock mapping for ximea recordings.
+
+While recording, a ClockSampler thread per camera reads the camera clock bracketed
+by two pupil clock reads, at a configurable rate. Every sample goes to
+timestamp_clocksync_{cam_name}.tsv (pupil time is the middle of the bracket, the
+bracket width is kept as the uncertainty of the sample) and into a ClockFit, a
+robust linear fit of pupil time against camera time (offset plus drift) that turns
+whole arrays of camera timestamps into pupil time in one operation.
+
+After a recording: load_clock_fit(<rec_path>/ximea, cam_name).to_sync(camera_times)
+'''
+import os as os
+import threading
+import time
+import numpy as np
+
+CLOCK_SAMPLE_DTYPE = np.dtype([('time_cam', '<f8'),
+                               ('time_sync', '<f8'),
+                               ('time_wall', '<f8'),
+                               ('round_trip', '<f8')])
+
+def sample_clocks(cam_handle, g_pool):
+    '''
+    Read the camera clock between two reads of the pupil (and wall) clock
+    Params:
+        cam_handle (XimeaCamera instance): camera handle to query time
+        g_pool: contains queriable clock
+    Returns:
+        time_cam, time_sync, time_wall, round_trip (floats, seconds): camera time,
+        middle of the pupil and wall clock reads, and time between the two pupil reads
+    '''
+    t_wall_1 = time.time()
+    t_sync_1 = g_pool.get_timestamp()
+    t_cam = cam_handle.get_param('timestamp')
+    t_cam = t_cam/(1e9) #this is returned in nanoseconds, change to seconds
+    t_sync_2 = g_pool.get_timestamp()
+    t_wall_2 = time.time()
+    return(t_cam, (t_sync_1 + t_sync_2) / 2, (t_wall_1 + t_wall_2) / 2, t_sync_2 - t_sync_1)
+
+class ClockFit():
+    '''
+    Robust linear fit time_sync = offset + drift * (time_cam - t0) over clock samples.
+
+    Samples whose pupil clock bracket was much wider than usual (the thread was
+    descheduled in between) are left out, then the fit is repeated dropping samples
+    more than n_mad median absolute deviations off the line. The fit is redone
+    lazily whenever samples were added since the last one.
+    Params:
+        n_mad (float): residual cut off, in (normal scaled) median absolute deviations
+        max_round_trip (float): samples with a wider bracket than this many times the
+            median bracket are ignored
+    '''
+    def __init__(self, n_mad=3.0, max_round_trip=2.0):
+        self.n_mad = n_mad
+        self.max_round_trip = max_round_trip
+        self.samples = np.zeros(64, dtype=CLOCK_SAMPLE_DTYPE)
+        self.n_samples = 0
+        self._fitted = 0
+        self.t0 = 0.0
+        self.offset = 0.0
+        self.drift = 1.0
+        self.residual = 0.0
+        self.n_used = 0
+
+    @classmethod
+    def from_samples(cls, samples, **kwargs):
+        fit = cls(**kwargs)
+        for s in samples:
+            fit.add(s['time_cam'], s['time_sync'], s['time_wall'], s['round_trip'])
+        return(fit)
+
+    def add(self, time_cam, time_sync, time_wall=0.0, round_trip=0.0):
+        if self.n_samples == len(self.samples):
+            self.samples = np.resize(self.samples, 2 * len(self.samples))
+        self.samples[self.n_samples] = (time_cam, time_sync, time_wall, round_trip)
+        self.n_samples += 1
+
+    def fit(self):
+        '''
+        Refit if there are new samples
+        Returns:
+            offset (float): pupil time at camera time t0
+            drift (float): pupil seconds per camera second
+        '''
+        if self._fitted == self.n_samples:
+            return(self.offset, self.drift)
+        s = self.samples[:self.n_samples]
+        self._fitted = self.n_samples
+        self.t0 = float(s['time_cam'][0])
+        x = s['time_cam'] - self.t0
+        y = s['time_sync']
+        keep = s['round_trip'] <= self.max_round_trip * np.median(s['round_trip']) + 1e-9
+        if keep.sum() < 2 or np.ptp(x[keep]) == 0:
+            #not enough spread for a slope yet, just the offset
+            self.offset, self.drift = float(np.median(y - x)), 1.0
+            self.n_used = int(keep.sum())
+            return(self.offset, self.drift)
+        for _ in range(5):
+            drift, offset = np.polyfit(x[keep], y[keep], 1)
+            residual = y - (offset + drift * x)
+            mad = 1.4826 * np.median(np.abs(residual[keep]))
+            new_keep = keep & (np.abs(residual) <= self.n_mad * mad + 1e-9)
+            if new_keep.sum() < 2 or (new_keep == keep).all():
+                break
+            keep = new_keep
+        self.offset, self.drift = float(offset), float(drift)
+        self.residual = float(np.std(residual[keep]))
+        self.n_used = int(keep.sum())
+        return(self.offset, self.drift)
+
+    def to_sync(self, time_cam):
+        '''
+        Map camera time(s) in seconds to pupil time
+        Params:
+            time_cam (float or np.ndarray): camera timestamps in seconds
+        Returns:
+            time_sync (float or np.ndarray): pupil timestamps
+        '''
+        offset, drift = self.fit()
+        return(offset + drift * (np.asarray(time_cam, dtype=np.float64) - self.t0))
+
+def clock_sample_file_name(save_folder, cam_name):
+    return(os.path.join(save_folder, f'timestamp_clocksync_{cam_name}.tsv'))
+
+def read_clock_samples(file_name):
+    '''
+    Load a timestamp_clocksync_{cam_name}.tsv
+    Returns:
+        samples (np.ndarray): structured array of CLOCK_SAMPLE_DTYPE
+    '''
+    data = np.loadtxt(file_name, delimiter='\t', skiprows=1, ndmin=2)
+    samples = np.zeros(len(data), dtype=CLOCK_SAMPLE_DTYPE)
+    for k, name in enumerate(CLOCK_SAMPLE_DTYPE.names):
+        samples[name] = data[:, k]
+    return(samples)
+
+def load_clock_fit(save_folder, cam_name='ximea', **kwargs):
+    '''
+    ClockFit of the clock samples taken during a recording
+    '''
+    return(ClockFit.from_samples(read_clock_samples(clock_sample_file_name(save_folder, cam_name)), **kwargs))
+
+class ClockSampler(threading.Thread):
+    '''
+    Thread sampling the camera and pupil clocks every 1/rate seconds (plus once when
+    started and once when stopped) into a ClockFit and the clocksync tsv.
+    Params:
+        camera (XimeaCamera instance): camera to sample
+        g_pool: contains queriable clock
+        cam_name (str): camera name, used for the file name
+        save_folder (str): folder the clocksync tsv goes to
+        rate (float): samples per second
+    '''
+    def __init__(self, camera, g_pool, cam_name, save_folder, rate=1.0):
+        super().__init__(daemon=True, name=f'clock_sampler_{cam_name}')
+        self.camera = camera
+        self.g_pool = g_pool
+        self.file_name = clock_sample_file_name(save_folder, cam_name)
+        self.period = 1.0 / rate
+        self.clock_fit = ClockFit()
+        self.stop_event = threading.Event()
+
+    def sample(self, f):
+        t_cam, t_sync, t_wall, round_trip = sample_clocks(self.camera, self.g_pool)
+        self.clock_fit.add(t_cam, t_sync, t_wall, round_trip)
+        f.write(f'{t_cam}\t{t_sync}\t{t_wall}\t{round_trip}\n')
+        f.flush()
+
+    def run(self):
+        with open(self.file_name, 'w') as f:
+            f.write('time_cam\ttime_sync\ttime_wall\tround_trip\n')
+            self.sample(f)
+            while not self.stop_event.wait(self.period):
+                self.sample(f)
+            self.sample(f)
+
+    def stop(self, timeout=5):
+        '''
+        Take the last sample and wait for the thread
+        Returns:
+            clock_fit (ClockFit): fit over every sample
+        '''
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        return(self.clock_fit)
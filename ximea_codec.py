@@ -0,0 +1,321 @@
+'''
+Lossless compression of raw ximea bayer frames.
+
+A frame is split into its four bayer color planes (each a half resolution image of
+one filter color, so neighbouring pixels are similar), every row of each plane is
+delta coded (uint8, wrapping, so exactly reversible) and each plane is compressed
+with a fast general purpose coder: zstd or lz4 when those packages are installed,
+zlib otherwise. Codec names ('bp-zlib', 'bp-zstd', 'bp-lz4') go in the codec field
+of indexed chunk headers.
+
+An encoded frame is a small struct (PAYLOAD_FORMAT: height, width and the compressed
+size of each plane) followed by the four compressed planes.
+
+FrameCompressor runs the encoding on a thread pool (the coders release the GIL) so
+compression keeps up with capture on a multi core machine.
+
+Benchmark: python ximea_codec.py [<rec_path>/ximea] --workers 4
+'''
+import struct
+import time
+import zlib
+import threading
+import collections
+import queue as queue
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from ximea_ringbuffer import EndOfStream
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+PAYLOAD_FORMAT = '<IIIIII'
+PAYLOAD_SIZE = struct.calcsize(PAYLOAD_FORMAT)
+
+def available_codecs():
+    '''
+    Codec names usable on this machine (fastest first)
+    '''
+    codecs = []
+    if zstandard is not None:
+        codecs.append('bp-zstd')
+    if lz4_frame is not None:
+        codecs.append('bp-lz4')
+    codecs.append('bp-zlib')
+    return(codecs)
+
+_local = threading.local()
+
+def _coder(codec, level=None):
+    '''
+    (compress, decompress) functions of one codec. zstd contexts can't be shared
+    between threads, so every thread gets its own.
+    '''
+    cache = _local.__dict__.setdefault('coders', {})
+    if (codec, level) not in cache:
+        cache[(codec, level)] = _make_coder(codec, level)
+    return(cache[(codec, level)])
+
+def _make_coder(codec, level=None):
+    if(codec == 'bp-zstd'):
+        if zstandard is None:
+            raise ValueError('bp-zstd needs the zstandard package')
+        compressor = zstandard.ZstdCompressor(level=1 if level is None else level)
+        decompressor = zstandard.ZstdDecompressor()
+        return(compressor.compress, decompressor.decompress)
+    elif(codec == 'bp-lz4'):
+        if lz4_frame is None:
+            raise ValueError('bp-lz4 needs the lz4 package')
+        return(lambda b: lz4_frame.compress(b, compression_level=0 if level is None else level), lz4_frame.decompress)
+    elif(codec == 'bp-zlib'):
+        return(lambda b: zlib.compress(b, 1 if level is None else level), zlib.decompress)
+    raise ValueError(f'Unknown codec {codec}, use one of {available_codecs()}')
+
+def split_planes(frame):
+    '''
+    The four bayer planes of a (height, width) frame, row delta coded
+    '''
+    planes = []
+    for dy, dx in ((0, 0), (0, 1), (1, 0), (1, 1)):
+        plane = frame[dy::2, dx::2]
+        delta = np.empty_like(plane)
+        delta[:, 0] = plane[:, 0]
+        np.subtract(plane[:, 1:], plane[:, :-1], out=delta[:, 1:])
+        planes.append(delta)
+    return(planes)
+
+def merge_planes(planes, imshape):
+    '''
+    Inverse of split_planes
+    '''
+    frame = np.empty(imshape, dtype=np.uint8)
+    for (dy, dx), delta in zip(((0, 0), (0, 1), (1, 0), (1, 1)), planes):
+        frame[dy::2, dx::2] = np.cumsum(delta, axis=1, dtype=np.uint8)
+    return(frame)
+
+def encode_frame(raw, imshape, codec='bp-zlib', level=None):
+    '''
+    Losslessly compress one raw 8 bit bayer frame
+    Params:
+        raw (bytes-like or np.ndarray): raw frame data
+        imshape (tuple): (height, width), both even
+        codec (str): one of available_codecs()
+        level (int): coder specific compression level (default: fastest)
+    Returns:
+        payload (bytes): encoded frame
+    '''
+    compress = _coder(codec, level)[0]
+    frame = np.frombuffer(raw, dtype=np.uint8).reshape(imshape)
+    data = [compress(np.ascontiguousarray(plane)) for plane in split_planes(frame)]
+    return(struct.pack(PAYLOAD_FORMAT, imshape[0], imshape[1], *[len(d) for d in data]) + b''.join(data))
+
+def decode_frame(payload, codec='bp-zlib'):
+    '''
+    Decode a frame made by encode_frame
+    Returns:
+        frame (np.ndarray): (height, width) uint8 bayer frame
+    '''
+    decompress = _coder(codec)[1]
+    payload = memoryview(payload).cast('B')
+    height, width, *sizes = struct.unpack_from(PAYLOAD_FORMAT, payload)
+    plane_shape = (height // 2, width // 2)
+    planes = []
+    pos = PAYLOAD_SIZE
+    for size in sizes:
+        planes.append(np.frombuffer(decompress(payload[pos:pos+size]), dtype=np.uint8).reshape(plane_shape))
+        pos += size
+    return(merge_planes(planes, (height, width)))
+
+class FrameCompressor():
+    '''
+    Compress frames on a pool of worker threads while keeping their order.
+
+    submit() starts compressing a frame (the raw buffer must stay valid until its
+    result comes back, ie keep the ring slot), and returns the oldest finished
+    (tag, payload) pairs once more than max_pending frames are in flight. drain()
+    returns everything still pending.
+    Params:
+        imshape (tuple): (height, width) of the frames
+        codec (str): one of available_codecs()
+        workers (int): compression threads
+        level (int): coder specific compression level (default: fastest)
+    '''
+    def __init__(self, imshape, codec='bp-zlib', workers=4, level=None):
+        self.imshape = tuple(imshape)
+        self.codec = codec
+        self.level = level
+        _coder(codec, level)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = 2 * workers
+        self.pending = collections.deque()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def pop(self):
+        '''
+        Wait for the oldest frame in flight and return its (tag, payload)
+        '''
+        tag, future = self.pending.popleft()
+        payload = future.result()
+        self.bytes_out += len(payload)
+        return(tag, payload)
+
+    def submit(self, raw, tag):
+        self.bytes_in += memoryview(raw).nbytes
+        self.pending.append((tag, self.pool.submit(encode_frame, raw, self.imshape, self.codec, self.level)))
+        done = []
+        while len(self.pending) > self.max_pending:
+            done.append(self.pop())
+        return(done)
+
+    def drain(self):
+        done = []
+        while self.pending:
+            done.append(self.pop())
+        return(done)
+
+    @property
+    def ratio(self):
+        return(self.bytes_in / self.bytes_out if self.bytes_out else 0)
+
+    def close(self):
+        self.pool.shutdown()
+
+class CompressedQueue():
+    '''
+    Wraps a FrameRing so that get() hands out frames compressed on a FrameCompressor
+    pool, in their original order, with raw_data replaced by the encoded payload.
+    Ring slots are released as soon as their frame is compressed, so release() of the
+    (None) slot returned by get() does nothing - the save loop works unchanged. The
+    ring's EndOfStream is passed on once every frame before it is compressed.
+    '''
+    def __init__(self, ring, compressor):
+        self.ring = ring
+        self.compressor = compressor
+        self.ready = collections.deque()
+
+    def _finish(self, done):
+        for (slot, frame), payload in done:
+            self.ring.release(slot)
+            self.ready.append((None, frame._replace(raw_data=payload)))
+
+    def get(self, block=True, timeout=None):
+        while not self.ready:
+            try:
+                #don't wait on the ring while there are frames being compressed
+                slot, frame = self.ring.get(block and not self.compressor.pending, timeout)
+            except queue.Empty:
+                if not self.compressor.pending:
+                    raise
+                self._finish([self.compressor.pop()])
+                continue
+            except EndOfStream:
+                if not self.compressor.pending:
+                    raise
+                self._finish(self.compressor.drain())
+                continue
+            self._finish(self.compressor.submit(frame.raw_data, (slot, frame)))
+        return(self.ready.popleft())
+
+    def release(self, slot):
+        pass
+
+    def empty(self):
+        return(self.ring.empty() and not self.compressor.pending and not self.ready)
+
+    def qsize(self):
+        return(self.ring.qsize() + len(self.compressor.pending) + len(self.ready))
+
+    def stats(self):
+        return(self.ring.stats())
+
+def synthetic_frames(n_frames, imshape=(1544, 2064), seed=0):
+    '''
+    Smooth bayer-like test frames with sensor noise, for benchmarking without a recording
+    '''
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:imshape[0], 0:imshape[1]]
+    base = 60 + 50 * np.sin(x / 97.0) * np.cos(y / 131.0)
+    gains = np.array([[1.0, 1.6], [1.6, 0.8]])[y % 2, x % 2]
+    frames = []
+    for k in range(n_frames):
+        frame = base * gains + 20 * np.sin((x + 7 * k) / 23.0) + rng.normal(0, 2.5, imshape)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return(frames)
+
+def benchmark(frames, codec, workers=4, out_file=None):
+    '''
+    Compression ratio and throughput of a codec on a list of frames, against the raw path.
+    Params:
+        frames (list of np.ndarray): raw (height, width) uint8 frames
+        codec (str): codec to test
+        workers (int): compression threads
+        out_file (str): if given, also write raw and compressed frames to this file (fsynced)
+            and report the effective raw-equivalent write throughput of both
+    Returns:
+        results (dict)
+    '''
+    import os
+    imshape = frames[0].shape
+    raw_bytes = sum(f.nbytes for f in frames)
+    results = {'codec': codec, 'workers': workers, 'frames': len(frames)}
+
+    compressor = FrameCompressor(imshape, codec, workers)
+    t0 = time.perf_counter()
+    payloads = []
+    for k, frame in enumerate(frames):
+        payloads.extend(p for _, p in compressor.submit(frame, k))
+    payloads.extend(p for _, p in compressor.drain())
+    t_compress = time.perf_counter() - t0
+    compressor.close()
+    results['ratio'] = compressor.ratio
+    results['compress_MBps'] = raw_bytes / t_compress / 1e6
+
+    t0 = time.perf_counter()
+    for payload, frame in zip(payloads, frames):
+        if not np.array_equal(decode_frame(payload, codec), frame):
+            raise AssertionError(f'{codec} round trip is not lossless')
+    results['decompress_MBps'] = raw_bytes / (time.perf_counter() - t0) / 1e6
+
+    if out_file is not None:
+        for name, chunks in (('raw', frames), ('compressed', payloads)):
+            t0 = time.perf_counter()
+            with open(out_file, 'wb') as f:
+                for c in chunks:
+                    f.write(c)
+                f.flush()
+                os.fsync(f.fileno())
+            elapsed = time.perf_counter() - t0
+            results[f'{name}_write_MBps'] = raw_bytes / elapsed / 1e6
+        #compressed path can't go faster than compression itself
+        results['compressed_write_MBps'] = min(results['compressed_write_MBps'], results['compress_MBps'])
+        os.remove(out_file)
+    return(results)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark lossless bayer compression against the raw path')
+    parser.add_argument('save_folder', nargs='?', default=None, help='recording to take frames from (default: synthetic frames)')
+    parser.add_argument('--cam_name', default='ximea')
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--out_file', default=None, help='file on the target disk to time raw vs compressed writes')
+    args = parser.parse_args()
+    if args.save_folder:
+        from ximea_reader import XimeaRecording
+        rec = XimeaRecording(args.save_folder, args.cam_name)
+        frames = [np.array(rec[i]) for i in range(min(args.frames, len(rec)))]
+    else:
+        frames = synthetic_frames(args.frames)
+    for codec in available_codecs():
+        r = benchmark(frames, codec, args.workers, args.out_file)
+        line = f"{codec}: ratio {r['ratio']:.2f}, compress {r['compress_MBps']:.0f} MB/s, decompress {r['decompress_MBps']:.0f} MB/s"
+        if args.out_file:
+            line += f", write raw {r['raw_write_MBps']:.0f} MB/s vs compressed {r['compressed_write_MBps']:.0f} MB/s (raw equivalent)"
+        print(line)
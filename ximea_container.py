@@ -0,0 +1,393 @@
+'''
+Self describing chunk files for ximea recordings.
+
+An indexed chunk (.xchunk) is laid out as
+
+    [header, HEADER_SIZE bytes][frame 0][frame 1]...[frame n-1][index, n * INDEX_DTYPE]
+
+The header is a fixed struct (HEADER_FORMAT) zero padded to one page, so the frame
+data stays page aligned for O_DIRECT writes. It carries the frame shape, pixel format
+(dtype: uint8, uint16 or the packed10/packed12 formats of ximea_packing), the
+bayer pattern (as used by cv2.COLOR_Bayer<pattern>2BGR), camera serial, a hash of
+the camera settings file, the index of the first frame in the recording, and the
+frame count and offset of the per frame index. The header is rewritten with the
+frame count and index offset when the chunk is closed, so a chunk with n_frames == 0
+was not closed cleanly - its frames can still be recovered as far as the timestamp
+log (see ximea_timestamps) lists them: frames are logged only once they are written
+(by the saver, or by the stripe writer of a striped chunk). The file size can't
+tell: a preallocated chunk has its full size from the start.
+
+The index holds the byte offset, size, camera frame number and camera timestamp of
+every frame in the chunk, so any frame can be found without parsing the timestamp tsv.
+'''
+import os as os
+import re
+import glob
+import struct
+import hashlib
+import numpy as np
+from collections import namedtuple
+from ximea_writers import open_chunk_file
+from ximea_timestamps import timestamp_log_name, read_timestamp_log
+from ximea_packing import frame_bytes, PIXEL_FORMATS
+
+CHUNK_MAGIC = b'XIMCHUNK'
+CHUNK_VERSION = 1
+HEADER_SIZE = 4096
+HEADER_FORMAT = '<8sHIII16s8s32s40s8sQQQQ'
+CHUNK_FORMATS = ('raw', 'indexed')
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'),
+                        ('nbytes', '<u8'),
+                        ('nframe', '<u8'),
+                        ('tsSec', '<u4'),
+                        ('tsUSec', '<u4')])
+
+TSV_DTYPE = np.dtype([('i', '<u8'),
+                      ('nframe', '<u8'),
+                      ('tsSec', '<u4'),
+                      ('tsUSec', '<u4')])
+
+chunk_meta = namedtuple("chunk_meta", "height width dtype bayer serial settings_hash")
+chunk_header = namedtuple("chunk_header", "version height width dtype bayer serial settings_hash codec frame_size first_index n_frames index_offset")
+
+def settings_hash(settings_file):
+    '''
+    sha1 of a camera settings file, stored in the chunk header to tie frames to settings
+    '''
+    with open(settings_file, 'rb') as f:
+        return(hashlib.sha1(f.read()).hexdigest())
+
+def frame_size_of(meta):
+    return(frame_bytes(meta.height, meta.width, meta.dtype))
+
+def pack_header(meta, first_index, n_frames=0, index_offset=0, codec='raw'):
+    '''
+    Pack a chunk header (padded to HEADER_SIZE)
+    '''
+    header = struct.pack(HEADER_FORMAT, CHUNK_MAGIC, CHUNK_VERSION, HEADER_SIZE,
+                         meta.height, meta.width,
+                         meta.dtype.encode(), meta.bayer.encode(),
+                         str(meta.serial).encode(), str(meta.settings_hash).encode(),
+                         codec.encode(), frame_size_of(meta),
+                         first_index, n_frames, index_offset)
+    return(header.ljust(HEADER_SIZE, b'\0'))
+
+def unpack_header(buf):
+    '''
+    Parse the header of an indexed chunk
+    Params:
+        buf (bytes-like): at least the first HEADER_SIZE bytes of the chunk
+    Returns:
+        header (chunk_header)
+    '''
+    fields = struct.unpack_from(HEADER_FORMAT, buf)
+    if fields[0] != CHUNK_MAGIC:
+        raise ValueError('Not an indexed ximea chunk')
+    if fields[1] > CHUNK_VERSION:
+        raise ValueError(f'Chunk version {fields[1]} is newer than this reader ({CHUNK_VERSION})')
+    text = [f.rstrip(b'\0').decode() for f in fields[5:10]]
+    return(chunk_header(fields[1], fields[3], fields[4], *text, *fields[10:]))
+
+def is_indexed_chunk(file_name):
+    with open(file_name, 'rb') as f:
+        return(f.read(len(CHUNK_MAGIC)) == CHUNK_MAGIC)
+
+def read_chunk_header(file_name):
+    with open(file_name, 'rb') as f:
+        return(unpack_header(f.read(HEADER_SIZE)))
+
+def read_chunk_index(file_name, header=None, ts=None):
+    '''
+    Load the per frame index of an indexed chunk. For a chunk that was not closed
+    cleanly the index is rebuilt from the frames of the chunk in the timestamp log
+    (see recovered_frames). That is not possible for compressed frames, an unclosed
+    compressed chunk reads as empty.
+    Params:
+        ts (np.ndarray): timestamps of the recording (read_timestamps), None if it has
+            no timestamp file
+    '''
+    if header is None:
+        header = read_chunk_header(file_name)
+    if header.n_frames:
+        return(np.fromfile(file_name, dtype=INDEX_DTYPE, count=header.n_frames, offset=header.index_offset))
+    if(header.codec != 'raw'):
+        return(np.zeros(0, dtype=INDEX_DTYPE))
+    return(recovered_frames(file_name, header.first_index, header.frame_size, ts, HEADER_SIZE))
+
+def chunk_capacity(file_name):
+    '''
+    Frames a chunk was opened for, from its frame_{i} / frames_{start}_{end} name
+    '''
+    m = re.match(r'frames?_(\d+)(?:_(\d+))?\.(?:bin|xchunk)$', os.path.basename(file_name))
+    if m is None:
+        raise ValueError(f'Not a chunk file name: {file_name}')
+    return(1 if m.group(2) is None else int(m.group(2)) - int(m.group(1)) + 1)
+
+def recovered_frames(file_name, first_index, frame_size, ts, offset=0):
+    '''
+    Index of the frames of a chunk without an index of its own (a raw .bin chunk or an
+    indexed chunk that wasn't closed): the frames of the chunk's range in the timestamp
+    log, which the saver writes behind the frames, with their frame numbers and
+    timestamps. Only recordings from before the log (never preallocated) are sized
+    by the file.
+    Params:
+        first_index (int): recording index of the chunk's first frame
+        frame_size (int): bytes per frame
+        ts (np.ndarray): timestamps of the recording sorted by i (read_timestamps), None
+            if it has no timestamp file
+        offset (int): byte offset of the first frame in the file
+    Returns:
+        index (np.ndarray): INDEX_DTYPE records
+    '''
+    if ts is None:
+        n_frames = max(os.path.getsize(file_name) - offset, 0) // frame_size
+        logged = None
+    else:
+        i = ts['i']
+        capacity = chunk_capacity(file_name)
+        logged = ts[np.searchsorted(i, first_index):np.searchsorted(i, first_index + capacity)]
+        #frames are logged in order, a gap means the rest didn't make it
+        n_frames = int(np.argmin(np.append(logged['i'] == first_index + np.arange(len(logged)), False)))
+        logged = logged[:n_frames]
+    index = np.zeros(n_frames, dtype=INDEX_DTYPE)
+    index['offset'] = offset + np.arange(n_frames) * frame_size
+    index['nbytes'] = frame_size
+    if logged is not None:
+        index['nframe'] = logged['nframe']
+        index['tsSec'] = logged['tsSec']
+        index['tsUSec'] = logged['tsUSec']
+    return(index)
+
+def chunk_file_name(fstart, ims_per_file, chunk_format='raw'):
+    '''
+    File name of the chunk starting at frame fstart. Raw chunks keep the original
+    frame_{i}.bin / frames_{start}_{end}.bin names.
+    '''
+    ext = 'xchunk' if chunk_format == 'indexed' else 'bin'
+    if(ims_per_file == 1):
+        return(f'frame_{fstart}.{ext}')
+    return(f'frames_{fstart}_{fstart+ims_per_file-1}.{ext}')
+
+class RawChunkWriter():
+    '''
+    Headerless chunk: the raw frames back to back (the original recording format)
+    '''
+    def __init__(self, file_name, backend='buffered', preallocate=0, syncer=None):
+        self.f = open_chunk_file(file_name, backend, preallocate=preallocate, syncer=syncer)
+        self.n_frames = 0
+
+    @property
+    def direct(self):
+        return(self.f.direct)
+
+    @property
+    def size(self):
+        return(self.f.size)
+
+    def append(self, raw_data, nframe, tsSec, tsUSec):
+        self.f.write(raw_data)
+        self.n_frames += 1
+
+    def close(self):
+        self.f.close()
+
+class IndexedChunkWriter():
+    '''
+    Writes an indexed chunk (see module docstring).
+    Params:
+        file_name (str): path of the chunk file
+        meta (chunk_meta): frame shape / camera description for the header
+        first_index (int): index of the first frame of this chunk in the recording
+        backend (str): chunk file write backend, see ximea_writers
+        capacity (int): expected number of frames, the index grows past it if needed
+        codec (str): 'raw' or the ximea_codec codec the appended frames are encoded with
+        preallocate (int): bytes to reserve for the chunk up front, see ximea_writers
+        syncer (ximea_writers.ChunkSyncer): fdatasync policy
+    '''
+    def __init__(self, file_name, meta, first_index, backend='buffered', capacity=400, codec='raw', preallocate=0, syncer=None):
+        self.meta = meta
+        self.first_index = first_index
+        self.codec = codec
+        self.f = open_chunk_file(file_name, backend, preallocate=preallocate, syncer=syncer)
+        self.f.write(pack_header(meta, first_index, codec=codec))
+        self.index = np.zeros(max(capacity, 1), dtype=INDEX_DTYPE)
+        self.n_frames = 0
+
+    @property
+    def direct(self):
+        return(self.f.direct)
+
+    @property
+    def size(self):
+        return(self.f.size)
+
+    def append(self, raw_data, nframe, tsSec, tsUSec):
+        if self.n_frames == len(self.index):
+            self.index = np.resize(self.index, 2*len(self.index))
+        self.index[self.n_frames] = (self.f.size, len(raw_data), nframe, tsSec, tsUSec)
+        self.f.write(raw_data)
+        self.n_frames += 1
+
+    def close(self):
+        try:
+            index_offset = self.f.size
+            self.f.write(self.index[:self.n_frames].tobytes())
+            self.f.write_at(0, pack_header(self.meta, self.first_index, self.n_frames, index_offset, self.codec))
+        finally:
+            self.f.close()
+
+def chunk_preallocation(chunk_format, capacity, frame_size, codec='raw'):
+    '''
+    Size of a full chunk of capacity frames in bytes, 0 if it can't be known up front
+    (compressed frames) or frame_size is unknown
+    '''
+    if(codec != 'raw' or not frame_size):
+        return(0)
+    if(chunk_format == 'indexed'):
+        return(HEADER_SIZE + capacity * (frame_size + INDEX_DTYPE.itemsize))
+    return(capacity * frame_size)
+
+def open_chunk_writer(file_name, first_index, chunk_format='raw', meta=None, backend='buffered', capacity=400, codec='raw',
+                      frame_size=0, syncer=None):
+    '''
+    Open a writer for one chunk of a recording.
+    Params:
+        chunk_format (str): 'raw' (headerless .bin) or 'indexed' (.xchunk, needs meta)
+        codec (str): encoding of the appended frames, compressed frames need indexed chunks
+        frame_size (int): bytes per frame, if given the file is preallocated for capacity
+            frames (and truncated to what was written on close)
+        syncer (ximea_writers.ChunkSyncer): fdatasync policy, None to leave it to the OS
+    Returns:
+        writer (RawChunkWriter or IndexedChunkWriter): has append(raw_data, nframe, tsSec, tsUSec) and close()
+    '''
+    preallocate = chunk_preallocation(chunk_format, capacity, frame_size, codec)
+    if(chunk_format == 'indexed'):
+        if meta is None:
+            raise ValueError('Indexed chunks need a chunk_meta')
+        return(IndexedChunkWriter(file_name, meta, first_index, backend, capacity, codec, preallocate, syncer))
+    elif(chunk_format == 'raw'):
+        if(codec != 'raw'):
+            raise ValueError('Compressed frames can only be stored in indexed chunks')
+        return(RawChunkWriter(file_name, backend, preallocate, syncer))
+    raise ValueError(f'Unknown chunk format {chunk_format}, use one of {CHUNK_FORMATS}')
+
+def list_raw_chunks(cam_dir):
+    '''
+    Find the headerless frame_{i}.bin / frames_{start}_{end}.bin files of a recording,
+    sorted by first frame.
+    Returns:
+        chunks (list of (int, str)): first frame index and path of each chunk
+    '''
+    chunks = []
+    for file_name in glob.glob(os.path.join(cam_dir, 'frame*.bin')):
+        m = re.match(r'frames?_(\d+)(?:_\d+)?\.bin$', os.path.basename(file_name))
+        if m:
+            chunks.append((int(m.group(1)), file_name))
+    return(sorted(chunks))
+
+def read_timestamp_tsv(ts_file_name):
+    '''
+    Load timestamps_{cam}.tsv (i, frame, camtime with camtime as sec.usec)
+    Returns:
+        ts (np.ndarray): structured array with i, nframe, tsSec, tsUSec
+    '''
+    rows = []
+    with open(ts_file_name, 'r') as f:
+        next(f)
+        for line in f:
+            i, nframe, camtime = line.split('\t')
+            sec, usec = camtime.strip().split('.')
+            rows.append((int(i), int(nframe), int(sec), int(usec)))
+    return(np.array(rows, dtype=TSV_DTYPE))
+
+def timestamp_file(save_folder, cam_name):
+    '''
+    The binary timestamps_{cam}.tslog of a recording if there is one, else the
+    timestamps_{cam}.tsv of older recordings, None if neither exists
+    '''
+    for file_name in (timestamp_log_name(save_folder, cam_name),
+                      os.path.join(save_folder, f'timestamps_{cam_name}.tsv')):
+        if os.path.exists(file_name):
+            return(file_name)
+    return(None)
+
+def read_timestamps(save_folder, cam_name):
+    '''
+    Per frame timestamps of a recording (see timestamp_file, empty if it has none),
+    in recording order (the chunks of a striped recording are logged as they finish)
+    Returns:
+        ts (np.ndarray): structured array with (at least) i, nframe, tsSec, tsUSec
+    '''
+    file_name = timestamp_file(save_folder, cam_name)
+    if file_name is None:
+        return(np.zeros(0, dtype=TSV_DTYPE))
+    if file_name.endswith('.tslog'):
+        ts = read_timestamp_log(file_name)
+    else:
+        ts = read_timestamp_tsv(file_name)
+    if np.any(np.diff(ts['i'].astype(np.int64)) < 0):
+        ts = ts[np.argsort(ts['i'], kind='stable')]
+    return(ts)
+
+def convert_raw_recording(save_folder, cam_name, meta, out_folder=None, ims_per_file=None, backend='buffered'):
+    '''
+    Convert a recording of headerless .bin chunks + its timestamps to indexed chunks.
+    Params:
+        save_folder (str): folder holding the {cam_name} frame folder and timestamp file
+        cam_name (str): camera name, ie 'ximea'
+        meta (chunk_meta): description of the frames (the raw files don't have one)
+        out_folder (str): where to write the {cam_name} folder of indexed chunks (default: in place)
+        ims_per_file (int): frames per output chunk (default: same as the input chunks)
+    Returns:
+        n_frames (int): number of frames converted
+    '''
+    out_folder = save_folder if out_folder is None else out_folder
+    out_dir = os.path.join(out_folder, cam_name)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    chunks = list_raw_chunks(os.path.join(save_folder, cam_name))
+    ts = read_timestamps(save_folder, cam_name) if timestamp_file(save_folder, cam_name) else None
+    frame_size = frame_size_of(meta)
+    if ims_per_file is None:
+        ims_per_file = chunks[1][0] - chunks[0][0] if len(chunks) > 1 else chunk_capacity(chunks[0][1])
+
+    n_frames = 0
+    writer = None
+    for fstart, file_name in chunks:
+        index = recovered_frames(file_name, fstart, frame_size, ts)
+        if len(index) == 0:
+            continue
+        frames = np.memmap(file_name, dtype=np.uint8, mode='r')
+        for j, entry in enumerate(index):
+            i = fstart + j
+            if writer is None or i % ims_per_file == 0:
+                if writer is not None:
+                    writer.close()
+                cstart = i - i % ims_per_file
+                writer = IndexedChunkWriter(os.path.join(out_dir, chunk_file_name(cstart, ims_per_file, 'indexed')),
+                                            meta, i, backend, ims_per_file)
+            writer.append(frames[j*frame_size:(j+1)*frame_size], entry['nframe'], entry['tsSec'], entry['tsUSec'])
+            n_frames += 1
+        del frames
+    if writer is not None:
+        writer.close()
+    return(n_frames)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert a raw .bin ximea recording to indexed chunks')
+    parser.add_argument('save_folder', help='recording folder holding the camera folder and timestamps')
+    parser.add_argument('--cam_name', default='ximea')
+    parser.add_argument('--out_folder', default=None)
+    parser.add_argument('--shape', type=int, nargs=2, default=(1544, 2064))
+    parser.add_argument('--bayer', default='RG')
+    parser.add_argument('--pixel_format', default='uint8', choices=PIXEL_FORMATS)
+    parser.add_argument('--serial', default='')
+    parser.add_argument('--settings', default=None, help='camera settings yaml used for the recording')
+    parser.add_argument('--ims_per_file', type=int, default=None)
+    args = parser.parse_args()
+    meta = chunk_meta(args.shape[0], args.shape[1], args.pixel_format, args.bayer, args.serial,
+                      settings_hash(args.settings) if args.settings else '')
+    n = convert_raw_recording(args.save_folder, args.cam_name, meta, args.out_folder, args.ims_per_file)
+    print(f'Converted {n} frames')
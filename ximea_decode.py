@@ -0,0 +1,81 @@
+import numpy as np
+import cv2
+from ximea_packing import unpack_frames, to_8bit
+
+BAYER_TO_BGR = {'RG': cv2.COLOR_BayerRG2BGR,
+                'GR': cv2.COLOR_BayerGR2BGR,
+                'BG': cv2.COLOR_BayerBG2BGR,
+                'GB': cv2.COLOR_BayerGB2BGR}
+
+def bayer_pixels(raw, imshape, pixel_format='uint8', keep_depth=False):
+    '''
+    (height, width) pixel values of a raw frame (stored bytes, or an already unpacked
+    2d frame): uint8, or uint16 for high bit depth frames when keep_depth
+    '''
+    if not isinstance(raw, np.ndarray) or raw.ndim == 1:
+        raw = unpack_frames(raw, imshape, pixel_format)
+    im = raw.reshape(imshape)
+    return(im if keep_depth else to_8bit(im, pixel_format))
+
+def demosaic_frame(raw, imshape, norm=True, bayer='RG', pixel_format='uint8', keep_depth=False):
+    '''
+    Turn raw ximea bayer data into a BGR image: debayer, rotate 180 degrees (flip both
+    axes, the camera is mounted upside down) and optionally stretch to the full range.
+    This is what decode_ximea_frame shows in the live preview, and what offline export uses.
+    Params:
+        raw (bytes-like or np.ndarray): raw bayer frame
+        imshape (tuple): (height, width) of the frame
+        norm (bool): min/max normalize to 0-255 (0-65535 for a uint16 image)
+        bayer (str): bayer pattern for cv2.COLOR_Bayer<bayer>2BGR
+        pixel_format (str): how the frame is stored, see ximea_packing
+        keep_depth (bool): uint16 image of high bit depth frames instead of uint8
+    Returns:
+        im (np.ndarray): (height, width, 3) BGR image
+    '''
+    im = bayer_pixels(raw, imshape, pixel_format, keep_depth)
+    im = cv2.cvtColor(im, BAYER_TO_BGR[bayer])
+    im = cv2.flip(im, -1)
+    if(norm):
+        im = cv2.normalize(im, None, 0, np.iinfo(im.dtype).max, cv2.NORM_MINMAX)
+    return(im)
+
+#position (row, col) of the red and blue sites in the top left 2x2 block of each
+#cv2 bayer pattern (cv2 names the pattern by the second row, so BayerRG starts with B)
+BAYER_SITES = {'RG': ((1, 1), (0, 0)),
+               'BG': ((0, 0), (1, 1)),
+               'GR': ((1, 0), (0, 1)),
+               'GB': ((0, 1), (1, 0))}
+
+def bin_bayer_frame(raw, imshape, step=1, norm=True, bayer='RG', pixel_format='uint8'):
+    '''
+    Cheap low resolution BGR image from raw bayer data: every 2x2 bayer block becomes
+    one pixel (red, mean of the two greens, blue) instead of a full debayer. Same
+    orientation and colors as demosaic_frame, at half the resolution (or less, see step).
+    Params:
+        raw (bytes-like or np.ndarray): raw bayer frame
+        imshape (tuple): (height, width) of the frame
+        step (int): only use every step-th bayer block in each direction, the output is
+            (height/2/step, width/2/step)
+        norm (bool): min/max normalize to 0-255
+        bayer (str): bayer pattern, as for demosaic_frame
+        pixel_format (str): how the frame is stored, see ximea_packing
+    Returns:
+        im (np.ndarray): (height//(2*step), width//(2*step), 3) BGR image
+    '''
+    im = bayer_pixels(raw, imshape, pixel_format)
+    (ry, rx), (by, bx) = BAYER_SITES[bayer]
+    s = 2 * step
+    red = im[ry::s, rx::s]
+    blue = im[by::s, bx::s]
+    green_a = im[ry::s, bx::s]
+    green_b = im[by::s, rx::s]
+    h = min(red.shape[0], blue.shape[0])
+    w = min(red.shape[1], blue.shape[1])
+    out = np.empty((h, w, 3), dtype=np.uint8)
+    out[..., 0] = blue[:h, :w]
+    out[..., 1] = cv2.addWeighted(green_a[:h, :w], 0.5, green_b[:h, :w], 0.5, 0)
+    out[..., 2] = red[:h, :w]
+    out = cv2.flip(out, -1)
+    if(norm):
+        out = cv2.normalize(out, None, 0, 255, cv2.NORM_MINMAX)
+    return(out)
@@ -0,0 +1,156 @@
+'''
+Ximea cameras opened, reconfigured and closed off the GL thread.
+
+Opening a camera (open the device, apply settings, start acquisition) takes long
+enough to freeze the world window, so the plugin hands it to a CameraSetWorker
+thread instead. The worker owns the cameras while it changes them and goes through
+the states
+    closed -> opening -> open (or error) -> opening -> ... -> closed
+Requests are coalesced: only the newest wanted configuration is kept, and the
+worker waits until requests have stopped coming for settle seconds before acting
+on it, so typing a serial number reopens the cameras once instead of per key.
+Cameras already open under the same serial number are kept and only get the
+settings that changed (see ximea_settings).
+
+The plugin polls generation: when it changes, a new set of cameras is ready
+(cameras(), plus state and message for the menu).
+'''
+import threading
+import time
+import ximea_utils
+
+CAMERA_STATES = ('closed', 'opening', 'open', 'error')
+
+class CameraSetWorker(threading.Thread):
+    '''
+    Background opener of a set of cameras.
+    Params:
+        logger (instace of class logger): used to pass messages to gui
+        settle (float): seconds without new requests before one is acted on
+    '''
+    def __init__(self, logger, settle=0.3):
+        super().__init__(daemon=True, name='ximea_camera_init')
+        self.logger = logger
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.wanted = None
+        self.t_wanted = 0.0
+        self.pending = False
+        self.stopping = False
+        self.state = 'closed'
+        self.message = ''
+        self.generation = 0
+        self.requests = 0
+        self.coalesced = 0
+        self._serials = []
+        self._cameras = []
+        self._image_handles = []
+
+    def request_open(self, serials, settings_files):
+        '''
+        Ask for these cameras (serial numbers, one settings yaml each) to be open
+        '''
+        self._request((list(serials), list(settings_files)))
+
+    def request_close(self):
+        self._request(([], []))
+
+    def _request(self, wanted):
+        with self.lock:
+            if self.pending:
+                self.coalesced += 1
+            self.wanted = wanted
+            self.t_wanted = time.monotonic()
+            self.pending = True
+            self.requests += 1
+            self.changed.notify_all()
+
+    def busy(self):
+        with self.lock:
+            return(self.pending or self.state == 'opening')
+
+    def cameras(self):
+        '''
+        (serials, cameras, image_handles) of the current set, None entries for cameras that failed
+        '''
+        with self.lock:
+            return(list(self._serials), list(self._cameras), list(self._image_handles))
+
+    def stop(self, timeout=10):
+        '''
+        Close every camera and end the thread
+        '''
+        self.request_close()
+        with self.lock:
+            self.stopping = True
+            self.changed.notify_all()
+        self.join(timeout)
+
+    def _set_state(self, state, message=''):
+        with self.lock:
+            self.state = state
+            self.message = message
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.changed.wait()
+                #let a burst of requests settle (not when closing up)
+                while not self.stopping and time.monotonic() - self.t_wanted < self.settle:
+                    self.changed.wait(self.settle - (time.monotonic() - self.t_wanted))
+                serials, settings_files = self.wanted
+                self.pending = False
+                stopping = self.stopping
+            try:
+                self._apply(serials, settings_files)
+            except Exception as e:
+                #the thread has to live on for the next request
+                self.logger.info(f'Problem opening cameras: {e}')
+                self._set_state('error', f'Could not open cameras: {e}')
+            if stopping:
+                with self.lock:
+                    if not self.pending:
+                        return
+
+    def _apply(self, serials, settings_files):
+        t_start = time.perf_counter()
+        self._set_state('opening' if serials else 'closed', f'Opening {len(serials)} camera(s)' if serials else '')
+        already_open = {serial: (camera, image_handle) for serial, camera, image_handle
+                        in zip(self._serials, self._cameras, self._image_handles) if camera is not None}
+        cameras = []
+        image_handles = []
+        for serial, settings_file in zip(serials, settings_files):
+            camera, image_handle, camera_open = None, None, False
+            try:
+                if serial in already_open:
+                    camera, image_handle = already_open.pop(serial)
+                    camera_open = ximea_utils.reapply_cam_settings(camera, settings_file, self.logger)
+                    if not camera_open:
+                        camera.close_device()
+                if not camera_open:
+                    camera, image_handle, camera_open = ximea_utils.init_camera(serial, settings_file, self.logger)
+            except Exception as e:
+                self.logger.info(f'Problem opening camera {serial}: {e}')
+                camera, image_handle = None, None
+            cameras.append(camera)
+            image_handles.append(image_handle)
+        for camera, _ in already_open.values():
+            try:
+                camera.stop_acquisition()
+                camera.close_device()
+            except Exception as e:
+                self.logger.info(f'Problem closing camera: {e}')
+        failed = [serial for serial, camera in zip(serials, cameras) if camera is None]
+        with self.lock:
+            self._serials = list(serials)
+            self._cameras = cameras
+            self._image_handles = image_handles
+            if not serials:
+                self.state, self.message = 'closed', ''
+            elif failed:
+                self.state, self.message = 'error', f"Could not open {', '.join(failed)}"
+            else:
+                self.state, self.message = 'open', f'{len(serials)} camera(s) open in {time.perf_counter() - t_start:.1f} s'
+            self.generation += 1
@@ -0,0 +1,171 @@
+'''
+Offline export of a recorded ximea session to BGR frames or video.
+
+The recording is split into batches of frames which are demosaiced (same semantics as
+the live preview, see ximea_decode.demosaic_frame) by a pool of worker processes. Each
+worker reads its frames through the memory mapped reader and writes its output straight
+to disk, so the session is never held in memory. 10/12 bit recordings (see
+ximea_packing) are exported as 16 bit png and npy, video is 8 bit. Finished batches are appended to
+export_progress.txt in the output folder (as their frame range) and skipped when the export
+is run again. Resuming with batches that don't line up with the finished ones (another
+batch size, or a recording that changed) is refused rather than skipping or repeating frames.
+
+Usage:
+    python ximea_export.py <rec_path>/ximea <out_folder> --format video --workers 8
+'''
+import os as os
+import time
+import multiprocessing as mp
+import numpy as np
+import cv2
+from ximea_reader import XimeaRecording
+from ximea_decode import demosaic_frame
+from ximea_packing import PIXEL_FORMATS
+
+EXPORT_FORMATS = ('png', 'npy', 'video')
+PROGRESS_FILE = 'export_progress.txt'
+
+_recording = None
+
+def _init_worker(save_folder, cam_name, imshape, pixel_format):
+    global _recording
+    _recording = XimeaRecording(save_folder, cam_name, imshape, pixel_format)
+
+def export_batch(job):
+    '''
+    Demosaic frames [start, stop) of the worker's recording and write them to out_folder.
+    Params:
+        job (tuple): (batch number, start, stop, out_folder, format, norm, fps)
+    Returns:
+        (batch number, start, stop, seconds of cpu time spent)
+    '''
+    batch, start, stop, out_folder, fmt, norm, fps = job
+    t0 = time.process_time()
+    bayer = _recording.header.bayer if _recording.header is not None else 'RG'
+    pixel_format = _recording.pixel_format
+    if(fmt == 'video'):
+        h, w = _recording.imshape
+        file_name = os.path.join(out_folder, f'segment_{batch:05d}.avi')
+        writer = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+        for i in range(start, stop):
+            writer.write(demosaic_frame(_recording[i], _recording.imshape, norm, bayer, pixel_format))
+        writer.release()
+    elif(fmt == 'npy'):
+        file_name = os.path.join(out_folder, f'frames_{start:08d}_{stop-1:08d}.npy')
+        h, w = _recording.imshape
+        out = np.lib.format.open_memmap(file_name + '.part', mode='w+', dtype=_recording.dtype, shape=(stop - start, h, w, 3))
+        for i in range(start, stop):
+            out[i - start] = demosaic_frame(_recording[i], _recording.imshape, norm, bayer, pixel_format, keep_depth=True)
+        out.flush()
+        del out
+        os.replace(file_name + '.part', file_name)
+    elif(fmt == 'png'):
+        for i in range(start, stop):
+            cv2.imwrite(os.path.join(out_folder, f'frame_{i:08d}.png'),
+                        demosaic_frame(_recording[i], _recording.imshape, norm, bayer, pixel_format, keep_depth=True))
+    else:
+        raise ValueError(f'Unknown export format {fmt}, use one of {EXPORT_FORMATS}')
+    return(batch, start, stop, time.process_time() - t0)
+
+def read_progress(out_folder):
+    '''
+    (batch number, start, stop) of the batches already exported to out_folder
+    '''
+    progress_file_name = os.path.join(out_folder, PROGRESS_FILE)
+    if not os.path.exists(progress_file_name):
+        return(set())
+    done = set()
+    with open(progress_file_name, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) != 3:
+                raise ValueError(f'{progress_file_name} has no frame ranges (older export), export to a new folder')
+            done.add(tuple(int(x) for x in fields))
+    return(done)
+
+def export_recording(save_folder, out_folder, cam_name='ximea', fmt='video', batch_size=None,
+                     workers=None, norm=True, fps=200, imshape=(1544, 2064), progress=print, pixel_format='uint8'):
+    '''
+    Export every frame of a recording to BGR images, npy stacks or MJPG video segments.
+    Params:
+        save_folder (str): recording folder holding the {cam_name} folder
+        out_folder (str): where to write the export (and its progress file)
+        fmt (str): 'png' (one image per frame), 'npy' (one array per batch) or
+            'video' (one MJPG .avi segment per batch, listed in segments.txt for ffmpeg concat)
+        batch_size (int): frames per batch (default: frames in the first chunk)
+        workers (int): worker processes (default: all cores)
+        norm (bool): min/max normalize like the live preview
+        fps (float): frame rate written into video segments
+        imshape (tuple): frame shape, only needed for raw .bin recordings
+        pixel_format (str): pixel format of raw .bin recordings without a manifest
+        progress (callable): called with a progress string after every batch
+    Returns:
+        summary (dict): frames, batches, wall seconds, frames/s and frames/s per core
+    '''
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {fmt}, use one of {EXPORT_FORMATS}')
+    workers = workers or os.cpu_count()
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    recording = XimeaRecording(save_folder, cam_name, imshape, pixel_format)
+    n_frames = len(recording)
+    if batch_size is None:
+        batch_size = int(recording.chunk_starts[1]) if len(recording.chunks) else 1
+    starts = list(range(0, n_frames, batch_size))
+    batches = {(b, s, min(s + batch_size, n_frames)) for b, s in enumerate(starts)}
+    done = read_progress(out_folder)
+    if not done <= batches:
+        raise ValueError(f'{out_folder} holds batches of another batch size or recording '
+                         f'({len(done - batches)} don\'t match), resume with the same batch size or export to a new folder')
+    jobs = [(b, s, min(s + batch_size, n_frames), out_folder, fmt, norm, fps)
+            for b, s in enumerate(starts) if (b, s, min(s + batch_size, n_frames)) not in done]
+    if(fmt == 'video'):
+        with open(os.path.join(out_folder, 'segments.txt'), 'w') as f:
+            f.writelines(f"file 'segment_{b:05d}.avi'\n" for b in range(len(starts)))
+
+    t0 = time.time()
+    frames_done = 0
+    cpu_seconds = 0
+    with open(os.path.join(out_folder, PROGRESS_FILE), 'a') as progress_file, \
+         mp.Pool(workers, initializer=_init_worker, initargs=(save_folder, cam_name, imshape, pixel_format)) as pool:
+        for batch, start, stop, cpu in pool.imap_unordered(export_batch, jobs):
+            progress_file.write(f'{batch} {start} {stop}\n')
+            progress_file.flush()
+            frames_done += stop - start
+            cpu_seconds += cpu
+            done.add((batch, start, stop))
+            elapsed = time.time() - t0
+            progress(f'{len(done)}/{len(starts)} batches, {frames_done} frames, {frames_done / elapsed:.1f} frames/s')
+
+    elapsed = time.time() - t0
+    summary = {'frames': frames_done,
+               'batches': len(jobs),
+               'skipped_batches': len(starts) - len(jobs),
+               'seconds': elapsed,
+               'workers': workers,
+               'frames_per_s': frames_done / elapsed if elapsed else 0,
+               'frames_per_s_per_core': frames_done / cpu_seconds if cpu_seconds else 0}
+    return(summary)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Demosaic a ximea recording to BGR frames or video')
+    parser.add_argument('save_folder', help='recording folder holding the camera folder')
+    parser.add_argument('out_folder')
+    parser.add_argument('--cam_name', default='ximea')
+    parser.add_argument('--format', default='video', choices=EXPORT_FORMATS)
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no_norm', action='store_true')
+    parser.add_argument('--fps', type=float, default=200)
+    parser.add_argument('--shape', type=int, nargs=2, default=(1544, 2064))
+    parser.add_argument('--pixel_format', default='uint8', choices=PIXEL_FORMATS)
+    args = parser.parse_args()
+    summary = export_recording(args.save_folder, args.out_folder, args.cam_name, args.format,
+                               args.batch_size, args.workers, not args.no_norm, args.fps, args.shape,
+                               pixel_format=args.pixel_format)
+    print(f"Exported {summary['frames']} frames in {summary['seconds']:.1f}s "
+          f"({summary['frames_per_s']:.1f} frames/s, {summary['frames_per_s_per_core']:.1f} frames/s per core, "
+          f"{summary['workers']} workers, {summary['skipped_batches']} batches already done)")
@@ -0,0 +1,257 @@
+'''
+Live health counters of the ximea acquisition pipelines.
+
+Each camera gets a PipelineHealth: a small array of doubles in shared memory (so a
+saver in a writer process can update it too) that the acquisition thread and the
+saver fill in as they go, one plain store per counter. The plugin menu shows
+status_text() of every camera while recording, and write_health_summary() puts the
+final numbers in ximea_health.tsv next to user_task_info.txt.
+
+The acquisition loop periods also go into a histogram with log spaced bins (20 per
+decade from 10 us), so frame timing jitter can be compared between runs (ie with and
+without ximea_realtime); it is written to ximea_loop_periods.tsv.
+
+When recording stops, the acquisition thread reports the number of frames it ended
+the stream with (see FrameRing.end_stream) and the saver counts the frames it takes
+off the ring, so status_text() shows how much is left to drain, and the summary
+how long the drain took and whether any frame was lost.
+'''
+import os as os
+import math
+import time
+import multiprocessing as mp
+import numpy as np
+
+HEALTH_FIELDS = ('t_start',
+                 #acquisition thread
+                 'frames', 'last_nframe', 'nframe_gaps', 'missed_frames', 'dropped_frames',
+                 'queue_depth', 'queue_high_water', 'ring_slots',
+                 'loop_period_mean', 'loop_period_max',
+                 #saver
+                 'frames_saved', 'bytes_written', 'chunks_written', 'write_seconds',
+                 'chunk_latency_last', 'chunk_latency_mean', 'chunk_latency_max',
+                 #stop and drain
+                 'frames_drained', 'stream_closed', 'stream_frames', 't_stream_closed', 'drained_at_close',
+                 'drain_done', 'drain_seconds', 'lost_frames')
+
+SUMMARY_FIELDS = ('frames', 'frames_saved', 'nframe_gaps', 'missed_frames', 'dropped_frames',
+                  'queue_high_water', 'ring_slots', 'loop_period_mean', 'loop_period_max',
+                  'loop_period_p50', 'loop_period_p99', 'loop_period_p999',
+                  'chunks_written', 'chunk_latency_mean', 'chunk_latency_max', 'write_MBps', 'seconds',
+                  'stream_frames', 'drain_seconds', 'lost_frames')
+
+#weight of a new sample in the running means
+EWMA = 0.01
+#chunk write latencies kept for percentiles
+N_LATENCIES = 4096
+#loop period histogram: bin k holds periods from PERIOD_MIN * 10**(k/PERIOD_BINS_PER_DECADE) on
+PERIOD_MIN = 1e-5
+PERIOD_BINS_PER_DECADE = 20
+N_PERIOD_BINS = 6 * PERIOD_BINS_PER_DECADE
+
+class PipelineHealth():
+    '''
+    Counters of one camera's pipeline (see HEALTH_FIELDS), picklable into writer processes.
+    Params:
+        cam_name (str): camera the counters belong to
+        ring_slots (int): size of the camera's frame ring, to judge the queue depth
+    '''
+    def __init__(self, cam_name, ring_slots=0):
+        self.cam_name = cam_name
+        self.values = mp.Array('d', len(HEALTH_FIELDS), lock=False)
+        self.fields = {name: k for k, name in enumerate(HEALTH_FIELDS)}
+        self.values[self.fields['t_start']] = time.time()
+        self.values[self.fields['last_nframe']] = -1
+        self.values[self.fields['ring_slots']] = ring_slots
+        self.latencies = mp.Array('d', N_LATENCIES, lock=False)
+        self.periods = mp.Array('d', N_PERIOD_BINS, lock=False)
+        self._rate = (time.time(), 0.0, 0.0)
+
+    def __getitem__(self, name):
+        return(self.values[self.fields[name]])
+
+    def __setitem__(self, name, value):
+        self.values[self.fields[name]] = value
+
+    def frame_acquired(self, nframe, period, queue_depth, dropped=0):
+        '''
+        Acquisition thread, once per frame
+        Params:
+            nframe (int): camera frame number
+            period (float): seconds since the previous frame came in
+            queue_depth (int): frames waiting in (or being written from) the ring
+            dropped (int): frames dropped so far (ring full, or overwritten)
+        '''
+        v, f = self.values, self.fields
+        last = v[f['last_nframe']]
+        if last >= 0 and nframe > last + 1:
+            v[f['nframe_gaps']] += 1
+            v[f['missed_frames']] += nframe - last - 1
+        v[f['last_nframe']] = nframe
+        v[f['frames']] += 1
+        v[f['dropped_frames']] = dropped
+        v[f['queue_depth']] = queue_depth
+        if queue_depth > v[f['queue_high_water']]:
+            v[f['queue_high_water']] = queue_depth
+        if period > 0:
+            mean = v[f['loop_period_mean']]
+            v[f['loop_period_mean']] = period if mean == 0 else mean + EWMA * (period - mean)
+            if period > v[f['loop_period_max']]:
+                v[f['loop_period_max']] = period
+            k = int(math.log10(max(period, PERIOD_MIN) / PERIOD_MIN) * PERIOD_BINS_PER_DECADE)
+            self.periods[min(k, N_PERIOD_BINS - 1)] += 1
+
+    def chunk_written(self, nbytes, n_frames, latency):
+        '''
+        Saver, once per chunk
+        Params:
+            nbytes (int): bytes in the chunk file
+            n_frames (int): frames in the chunk
+            latency (float): seconds spent writing (and closing) the chunk
+        '''
+        v, f = self.values, self.fields
+        self.latencies[int(v[f['chunks_written']]) % N_LATENCIES] = latency
+        v[f['frames_saved']] += n_frames
+        v[f['bytes_written']] += nbytes
+        v[f['chunks_written']] += 1
+        v[f['write_seconds']] += latency
+        v[f['chunk_latency_last']] = latency
+        mean = v[f['chunk_latency_mean']]
+        v[f['chunk_latency_mean']] = latency if mean == 0 else mean + 0.1 * (latency - mean)
+        if latency > v[f['chunk_latency_max']]:
+            v[f['chunk_latency_max']] = latency
+
+    def stream_closed(self, n_frames):
+        '''
+        Acquisition thread, when it ends the stream
+        Params:
+            n_frames (int): frames the saver is due in total
+        '''
+        v, f = self.values, self.fields
+        v[f['stream_frames']] = n_frames
+        v[f['drained_at_close']] = v[f['frames_drained']]
+        v[f['t_stream_closed']] = time.time()
+        v[f['stream_closed']] = 1
+
+    def drained(self, n_frames, lost=0):
+        '''
+        Saver, when it has written everything up to the end of the stream
+        Params:
+            n_frames (int): frames saved
+            lost (int): frames the acquisition committed that never got saved
+        '''
+        v, f = self.values, self.fields
+        v[f['frames_drained']] = n_frames
+        v[f['lost_frames']] = lost
+        if v[f['stream_closed']]:
+            v[f['drain_seconds']] = time.time() - v[f['t_stream_closed']]
+        v[f['drain_done']] = 1
+
+    def drain_progress(self, snap=None):
+        '''
+        Frames still to be saved after the stream was closed, and the estimated seconds
+        until they are (None while recording or if there is no rate yet)
+        '''
+        snap = self.snapshot() if snap is None else snap
+        if not snap['stream_closed'] or snap['drain_done']:
+            return(None)
+        remaining = max(snap['stream_frames'] - snap['frames_drained'], 0)
+        elapsed = time.time() - snap['t_stream_closed']
+        rate = (snap['frames_drained'] - snap['drained_at_close']) / elapsed if elapsed > 0 else 0
+        return(remaining, remaining / rate if rate > 0 else None)
+
+    def latency_percentiles(self, q=(50, 90, 99)):
+        '''
+        Percentiles of the chunk write latency (over the last N_LATENCIES chunks), in seconds
+        '''
+        n = min(int(self['chunks_written']), N_LATENCIES)
+        if n == 0:
+            return([0.0 for _ in q])
+        return(list(np.percentile(np.frombuffer(self.latencies, dtype=np.float64)[:n], q)))
+
+    def period_histogram(self):
+        '''
+        Histogram of the acquisition loop periods
+        Returns:
+            edges (np.ndarray): N_PERIOD_BINS + 1 bin edges in seconds
+            counts (np.ndarray): loop periods in each bin
+        '''
+        edges = PERIOD_MIN * 10 ** (np.arange(N_PERIOD_BINS + 1) / PERIOD_BINS_PER_DECADE)
+        return(edges, np.frombuffer(self.periods, dtype=np.float64).copy())
+
+    def period_percentiles(self, q=(50, 99, 99.9)):
+        '''
+        Percentiles of the acquisition loop period in seconds (bin centers, from the histogram)
+        '''
+        edges, counts = self.period_histogram()
+        if counts.sum() == 0:
+            return([0.0 for _ in q])
+        cum = np.cumsum(counts) / counts.sum()
+        centers = np.sqrt(edges[:-1] * edges[1:])
+        return([float(centers[min(np.searchsorted(cum, p / 100), N_PERIOD_BINS - 1)]) for p in q])
+
+    def snapshot(self):
+        '''
+        All counters plus write_MBps (since the last snapshot) and seconds since the start
+        '''
+        snap = dict(zip(HEALTH_FIELDS, self.values[:]))
+        now = time.time()
+        t_prev, bytes_prev, mbps_prev = self._rate
+        if now - t_prev >= 0.5:
+            mbps = (snap['bytes_written'] - bytes_prev) / (now - t_prev) / 1e6
+            self._rate = (now, snap['bytes_written'], mbps)
+        else:
+            mbps = mbps_prev
+        snap['write_MBps'] = mbps
+        snap['seconds'] = now - snap['t_start']
+        snap['loop_period_p50'], snap['loop_period_p99'], snap['loop_period_p999'] = self.period_percentiles((50, 99, 99.9))
+        return(snap)
+
+    def falling_behind(self, snap=None):
+        '''
+        Is the saver losing ground (ring more than half full, or frames lost)?
+        '''
+        snap = self.snapshot() if snap is None else snap
+        return(snap['queue_depth'] > snap['ring_slots'] / 2 or snap['dropped_frames'] > 0)
+
+    def status_text(self):
+        '''
+        One line summary for the plugin menu
+        '''
+        s = self.snapshot()
+        fps = 1 / s['loop_period_mean'] if s['loop_period_mean'] else 0
+        text = (f"{self.cam_name}: {fps:.0f} fps, {s['missed_frames']:.0f} missed in {s['nframe_gaps']:.0f} gaps, "
+                f"{s['dropped_frames']:.0f} dropped, queue {s['queue_depth']:.0f}/{s['ring_slots']:.0f} "
+                f"(max {s['queue_high_water']:.0f}), {s['write_MBps']:.0f} MB/s, "
+                f"chunk {s['chunk_latency_last']*1e3:.0f} ms (max {s['chunk_latency_max']*1e3:.0f} ms), "
+                f"frame period p99 {s['loop_period_p99']*1e3:.1f} ms")
+        if self.falling_behind(s):
+            text = 'FALLING BEHIND! ' + text
+        if(s['drain_done'] and s['stream_closed']):
+            text = (f"{self.cam_name}: saved {s['frames_drained']:.0f} of {s['stream_frames']:.0f} frames, "
+                    f"drained in {s['drain_seconds']:.1f} s after stop")
+            if s['lost_frames']:
+                text = f"LOST {s['lost_frames']:.0f} FRAMES! " + text
+        elif s['stream_closed']:
+            remaining, eta = self.drain_progress(s)
+            text = (f"{self.cam_name}: stopped, saving {remaining:.0f} of {s['stream_frames']:.0f} frames still queued"
+                    + (f" (~{eta:.1f} s)" if eta is not None else ''))
+        return(text)
+
+def write_health_summary(folder, healths):
+    '''
+    Write the counters of every camera to {folder}/ximea_health.tsv (one row per camera),
+    and their loop period histograms to {folder}/ximea_loop_periods.tsv
+    '''
+    with open(os.path.join(folder, 'ximea_health.tsv'), 'w') as f:
+        f.write('cam\t' + '\t'.join(SUMMARY_FIELDS) + '\n')
+        for health in healths:
+            snap = health.snapshot()
+            snap['write_MBps'] = snap['bytes_written'] / snap['seconds'] / 1e6 if snap['seconds'] else 0
+            f.write(health.cam_name + '\t' + '\t'.join(f'{snap[k]:g}' for k in SUMMARY_FIELDS) + '\n')
+    with open(os.path.join(folder, 'ximea_loop_periods.tsv'), 'w') as f:
+        f.write('cam\tperiod_from\tperiod_to\tcount\n')
+        for health in healths:
+            edges, counts = health.period_histogram()
+            for k in np.flatnonzero(counts):
+                f.write(f'{health.cam_name}\t{edges[k]:g}\t{edges[k+1]:g}\t{counts[k]:g}\n')
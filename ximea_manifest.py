@@ -0,0 +1,114 @@
+'''
+Chunk manifest of a ximea recording.
+
+manifest_{cam_name}.yaml sits in the recording folder and lists every chunk file of a
+camera in recording order: the index of its first frame, how many frames it was
+opened for, which target directory it went to and its path inside that directory.
+Chunks are added as they are opened (so a crashed recording still lists its last
+chunk), one flow style line appended per chunk, and once a chunk is closed a second
+line records how many frames it actually holds (fewer than it was opened for if
+the recording stopped in it). read_manifest folds those into the chunk entries as
+n_frames, a chunk without one was never closed.
+
+XimeaRecording reads the manifest when there is one, so chunks striped over several
+disks (see ximea_stripes) read back as one sequence. If a target directory has
+moved, chunks are also looked for in the folder of the manifest itself (ie after
+the stripes were copied together).
+'''
+import os as os
+import json
+import threading
+import yaml
+
+def manifest_file_name(save_folder, cam_name):
+    return(os.path.join(save_folder, f'manifest_{cam_name}.yaml'))
+
+class ChunkManifest():
+    '''
+    Writer of a chunk manifest.
+    Params:
+        file_name (str): manifest to create (truncated if it exists)
+        cam_name (str): camera the chunks belong to
+        targets (list of str): directories chunks are written to
+        chunk_format (str): 'raw' or 'indexed'
+        info (dict): anything else to record in the header
+    '''
+    def __init__(self, file_name, cam_name, targets, chunk_format, info=None):
+        self.file_name = file_name
+        header = {'cam_name': cam_name,
+                  'chunk_format': chunk_format,
+                  'targets': [os.path.abspath(t) for t in targets]}
+        header.update(info or {})
+        self.file = open(file_name, 'w')
+        self.file.write(yaml.safe_dump(header, default_flow_style=False))
+        self.file.write('chunks:\n')
+        self.file.flush()
+        self.n_chunks = 0
+        #stripe writer threads record closed chunks
+        self.lock = threading.Lock()
+
+    def add(self, first_index, capacity, target, file_name):
+        '''
+        Record a chunk
+        Params:
+            first_index (int): recording index of its first frame
+            capacity (int): frames the chunk was opened for
+            target (int): index of the target directory it is written to
+            file_name (str): path of the chunk relative to the target directory
+        '''
+        entry = {'first_index': int(first_index), 'capacity': int(capacity),
+                 'target': int(target), 'file': file_name}
+        self._append(entry)
+        self.n_chunks += 1
+
+    def closed(self, first_index, n_frames):
+        '''
+        Record the frames a chunk holds once it is closed
+        Params:
+            first_index (int): recording index of its first frame
+            n_frames (int): frames written to it
+        '''
+        self._append({'first_index': int(first_index), 'n_frames': int(n_frames)})
+
+    def _append(self, entry):
+        with self.lock:
+            self.file.write('- ' + json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def read_manifest(save_folder, cam_name):
+    '''
+    Load the manifest of a camera, None if the recording has none
+    '''
+    file_name = manifest_file_name(save_folder, cam_name)
+    if not os.path.exists(file_name):
+        return(None)
+    with open(file_name, 'r') as f:
+        manifest = yaml.safe_load(f)
+    chunks = {}
+    for entry in manifest.get('chunks') or []:
+        if 'file' in entry:
+            chunks[entry['first_index']] = entry
+        elif entry['first_index'] in chunks:
+            chunks[entry['first_index']]['n_frames'] = entry['n_frames']
+    manifest['chunks'] = list(chunks.values())
+    return(manifest)
+
+def manifest_chunk_files(save_folder, manifest):
+    '''
+    (first_index, path) of every chunk in a manifest, in recording order
+    '''
+    chunks = []
+    for entry in sorted(manifest['chunks'], key=lambda e: e['first_index']):
+        path = os.path.join(manifest['targets'][entry['target']], entry['file'])
+        if not os.path.exists(path):
+            moved = os.path.join(save_folder, entry['file'])
+            if not os.path.exists(moved):
+                raise FileNotFoundError(f"Chunk {entry['file']} is neither in {manifest['targets'][entry['target']]} nor in {save_folder}")
+            path = moved
+        chunks.append((entry['first_index'], path))
+    return(chunks)
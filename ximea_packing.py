@@ -0,0 +1,157 @@
+'''
+High bit depth ximea frames, kept packed from the camera to the disk.
+
+The cameras can deliver 10 or 12 bit pixels packed in the GenICam PFNC LSB layout
+(imgdataformat XI_FRM_TRANSPORT_DATA, output_bit_depth XI_BPP_10/XI_BPP_12,
+is_output_bit_packing true, output_bit_packing_type XI_DATA_PACK_PFNC_LSB_PACKING
+in the settings yaml): the pixels form one little endian bit stream, so
+
+    packed10: 4 pixels in 5 bytes (1.25 bytes per pixel)
+    packed12: 2 pixels in 3 bytes (1.5 bytes per pixel)
+
+instead of 2 bytes per pixel as uint16. Frames go through the ring, the chunk files
+and the timestamped index in that packed form; the pixel format is the dtype of the
+chunk header (see ximea_container.chunk_meta). unpack_frames turns them into uint16
+(whole stacks at once, with a few vectorized shifts per byte column) for the
+preview, the export and the reader, to_8bit for display.
+'''
+import ctypes
+import numpy as np
+
+PIXEL_FORMATS = ('uint8', 'uint16', 'packed10', 'packed12')
+PIXEL_BITS = {'uint8': 8, 'uint16': 16, 'packed10': 10, 'packed12': 12}
+#(pixels, bytes) of one packed group
+PACKED_GROUPS = {'packed10': (4, 5), 'packed12': (2, 3)}
+
+def is_packed(pixel_format):
+    return(pixel_format in PACKED_GROUPS)
+
+def pixel_dtype(pixel_format):
+    '''
+    numpy dtype of unpacked frames
+    '''
+    if pixel_format not in PIXEL_BITS:
+        raise ValueError(f'Unknown pixel format {pixel_format}, use one of {PIXEL_FORMATS}')
+    return(np.dtype(np.uint8 if pixel_format == 'uint8' else np.uint16))
+
+def frame_bytes(height, width, pixel_format='uint8'):
+    '''
+    Size in bytes of one stored (packed) frame
+    '''
+    if is_packed(pixel_format):
+        pixels, nbytes = PACKED_GROUPS[pixel_format]
+        if (height * width) % pixels:
+            raise ValueError(f'{pixel_format} frames need a multiple of {pixels} pixels, not {height}x{width}')
+        return(height * width // pixels * nbytes)
+    return(height * width * pixel_dtype(pixel_format).itemsize)
+
+def unpack_frames(raw, imshape, pixel_format, out=None):
+    '''
+    Stored frame(s) to pixel values.
+    Params:
+        raw (bytes-like or np.ndarray): one frame, or an (n, frame_bytes) stack of them
+        imshape (tuple): (height, width) of a frame
+        pixel_format (str): one of PIXEL_FORMATS
+        out (np.ndarray): uint16 array to unpack into (reused between calls)
+    Returns:
+        frames (np.ndarray): (height, width) or (n, height, width), uint8 for uint8
+            frames, uint16 otherwise (a view of raw unless packed)
+    '''
+    raw = np.frombuffer(raw, dtype=np.uint8) if not isinstance(raw, np.ndarray) else raw
+    lead = raw.shape[:-1] if raw.ndim > 1 else ()
+    shape = (*lead, *imshape)
+    if not is_packed(pixel_format):
+        return(raw.view(pixel_dtype(pixel_format)).reshape(shape))
+    pixels, nbytes = PACKED_GROUPS[pixel_format]
+    g = np.ascontiguousarray(raw).reshape(-1, nbytes)
+    if out is None:
+        out = np.empty(shape, dtype=np.uint16)
+    o = out.reshape(-1, pixels)
+    b = [g[:, k].astype(np.uint16) for k in range(nbytes)]
+    if(pixel_format == 'packed10'):
+        o[:, 0] = b[0] | ((b[1] & 0x3) << 8)
+        o[:, 1] = (b[1] >> 2) | ((b[2] & 0xf) << 6)
+        o[:, 2] = (b[2] >> 4) | ((b[3] & 0x3f) << 4)
+        o[:, 3] = (b[3] >> 6) | (b[4] << 2)
+    else:
+        o[:, 0] = b[0] | ((b[1] & 0xf) << 8)
+        o[:, 1] = (b[1] >> 4) | (b[2] << 4)
+    return(out)
+
+def pack_frames(frames, pixel_format):
+    '''
+    Pixel values to stored frame(s), the inverse of unpack_frames (ie for the
+    simulated camera). Bits above the pixel format's depth are dropped.
+    Params:
+        frames (np.ndarray): (height, width) or (n, height, width) pixel values
+        pixel_format (str): one of PIXEL_FORMATS
+    Returns:
+        raw (np.ndarray): (frame_bytes,) or (n, frame_bytes) uint8
+    '''
+    frames = np.asarray(frames)
+    lead = frames.shape[:-2]
+    size = frame_bytes(frames.shape[-2], frames.shape[-1], pixel_format)
+    if not is_packed(pixel_format):
+        return(np.ascontiguousarray(frames, dtype=pixel_dtype(pixel_format)).view(np.uint8).reshape(*lead, size))
+    pixels, nbytes = PACKED_GROUPS[pixel_format]
+    p = [c.astype(np.uint16) & ((1 << PIXEL_BITS[pixel_format]) - 1)
+         for c in frames.reshape(-1, pixels).T]
+    raw = np.empty((p[0].size, nbytes), dtype=np.uint8)
+    if(pixel_format == 'packed10'):
+        raw[:, 0] = p[0] & 0xff
+        raw[:, 1] = (p[0] >> 8) | ((p[1] & 0x3f) << 2)
+        raw[:, 2] = (p[1] >> 6) | ((p[2] & 0xf) << 4)
+        raw[:, 3] = (p[2] >> 4) | ((p[3] & 0x3) << 6)
+        raw[:, 4] = p[3] >> 2
+    else:
+        raw[:, 0] = p[0] & 0xff
+        raw[:, 1] = (p[0] >> 8) | ((p[1] & 0xf) << 4)
+        raw[:, 2] = p[1] >> 4
+    return(raw.reshape(*lead, size))
+
+def to_8bit(frames, pixel_format):
+    '''
+    Drop the low bits of unpacked frames, for display
+    '''
+    shift = PIXEL_BITS[pixel_format] - 8
+    if not shift:
+        return(frames)
+    return((frames >> shift).astype(np.uint8))
+
+def camera_pixel_format(camera):
+    '''
+    Pixel format a camera is set up to deliver, from its imgdataformat and output
+    bit depth / packing settings
+    '''
+    try:
+        data_format = camera.get_imgdataformat()
+    except Exception:
+        return('uint8')
+    data_format = data_format.decode() if isinstance(data_format, bytes) else str(data_format)
+    if data_format in ('XI_RAW16', 'XI_MONO16'):
+        return('uint16')
+    if(data_format != 'XI_FRM_TRANSPORT_DATA'):
+        return('uint8')
+    depth = camera.get_output_bit_depth()
+    depth = int(str(depth.decode() if isinstance(depth, bytes) else depth).rsplit('_', 1)[-1])
+    if(depth == 8):
+        return('uint8')
+    if not camera.is_output_bit_packing():
+        return('uint16')
+    packing = camera.get_output_bit_packing_type() if hasattr(camera, 'get_output_bit_packing_type') else None
+    packing = packing.decode() if isinstance(packing, bytes) else packing
+    if packing is not None and packing != 'XI_DATA_PACK_PFNC_LSB_PACKING':
+        raise ValueError(f'Unsupported bit packing {packing}, use XI_DATA_PACK_PFNC_LSB_PACKING')
+    if f'packed{depth}' not in PACKED_GROUPS:
+        raise ValueError(f'Unsupported packed bit depth {depth}')
+    return(f'packed{depth}')
+
+def image_data(image_handle, nbytes=None):
+    '''
+    Raw data of a ximea image. get_image_data_raw sizes the buffer by bytes per pixel,
+    which doesn't cover packed frames, so with nbytes (see frame_bytes) the buffer is
+    read directly.
+    '''
+    if nbytes is None or not hasattr(image_handle, 'bp'):
+        return(image_handle.get_image_data_raw())
+    return(ctypes.string_at(image_handle.bp, nbytes))
@@ -0,0 +1,142 @@
+'''
+Pre-roll: the last few seconds of frames before a recording starts.
+
+While a camera is open and not recording, a PreRollWorker grabs its frames into the
+ring that will become the recording's frame ring, dropping the oldest frame once it
+holds max_frames, so the ring always holds the last max_frames frames with their
+nframe, camera and host timestamps. When the recording starts the worker stops
+grabbing and hands the ring over to start_multi_ximea_aquisition: the acquisition
+thread keeps committing live frames behind the pre-roll, and the saver writes the
+pre-roll first, as frames 0..n-1 of the recording.
+
+The ring has max_frames slots for the pre-roll plus ring_slots of headroom for live
+frames while the saver works through the backlog, and is sized from a memory budget
+(see preroll_frames). It is a SharedFrameRing for process writers, so frames are
+never copied again on the way to the saver. A PreviewTap on the ring keeps the live
+preview going without a second reader of the camera.
+'''
+import threading
+import queue as queue
+from ximea_ringbuffer import FrameRing, SharedFrameRing, frame_data
+from ximea_preview import PreviewTap
+from ximea_utils import copy_image_into
+
+def preroll_frames(seconds, fps, frame_size, budget_bytes, ring_slots=64):
+    '''
+    Frames of pre-roll to keep: seconds of frames at fps, capped so that the whole
+    ring (pre-roll plus ring_slots of headroom) fits in budget_bytes
+    '''
+    if seconds <= 0 or fps <= 0:
+        return(0)
+    return(max(0, min(int(seconds * fps), int(budget_bytes // frame_size) - ring_slots)))
+
+def camera_fps(camera, default=200.0):
+    '''
+    Frame rate the camera is set to, default if it can't tell
+    '''
+    try:
+        return(float(camera.get_framerate()))
+    except Exception:
+        return(default)
+
+class PreRollWorker(threading.Thread):
+    '''
+    Grabs frames of an open camera into a bounded ring until handover().
+    Params:
+        camera (XimeaCamera instance): opened, acquiring camera
+        image_handle (Ximea Image): its image handle
+        g_pool: pupil pool, for host timestamps
+        max_frames (int): frames of pre-roll to keep
+        frame_size (int): size of a ring slot in bytes
+        frame_nbytes (int): size of one raw frame of this camera (see ximea_utils.camera_frame_size),
+            default frame_size
+        ring_slots (int): extra slots for the recording to buffer live frames in
+        writer_mode (str): 'thread' or 'process', which kind of ring the recording needs
+        preview_every (int): offer every Nth frame to the tap (for the live preview)
+        logger (instace of class logger): used to pass messages to gui
+    '''
+    def __init__(self, camera, image_handle, g_pool, max_frames, frame_size, ring_slots=64,
+                 writer_mode='thread', preview_every=1, logger=None, frame_nbytes=None):
+        super().__init__(daemon=True, name='ximea_preroll')
+        self.camera = camera
+        self.image_handle = image_handle
+        self.g_pool = g_pool
+        self.max_frames = max(1, int(max_frames))
+        self.frame_nbytes = frame_nbytes or frame_size
+        self.writer_mode = writer_mode
+        self.logger = logger
+        ring_class = SharedFrameRing if writer_mode == 'process' else FrameRing
+        #block policy: the oldest frame is dropped here, by hand, once max_frames are held
+        self.ring = ring_class(self.max_frames + ring_slots, frame_size, 'block')
+        self.tap = PreviewTap(self.ring, preview_every)
+        self.stop_event = threading.Event()
+        self.held = 0
+        self.frames_grabbed = 0
+        self.frames_dropped = 0
+        self.handed_over = False
+
+    def _drop_oldest(self):
+        self.ring.discard_oldest(1)
+        self.held -= 1
+        self.frames_dropped += 1
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                self.camera.get_image(self.image_handle)
+                host_time = self.g_pool.get_timestamp()
+                if self.held >= self.max_frames:
+                    self._drop_oldest()
+                try:
+                    slot = self.ring.claim(timeout=1)
+                except queue.Full:
+                    #slots held by the preview, try again with the next frame
+                    continue
+                nbytes = copy_image_into(self.image_handle, self.ring.frames[slot], self.frame_nbytes)
+                tap_frame = self.tap.wants()
+                if(tap_frame):
+                    self.ring.retain(slot)
+                self.ring.commit(slot, nbytes, self.image_handle.nframe, self.image_handle.tsSec,
+                                 self.image_handle.tsUSec, host_time)
+                self.held += 1
+                self.frames_grabbed += 1
+                if(tap_frame):
+                    self.tap.offer(slot, frame_data(self.ring.frames[slot, :nbytes], self.image_handle.nframe,
+                                                    self.image_handle.tsSec, self.image_handle.tsUSec, host_time))
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.info(f'Pre-roll stopped: {e}')
+
+    def _stop_grabbing(self, timeout=5):
+        '''
+        Returns:
+            stopped (bool): False if the thread is still grabbing after timeout seconds
+        '''
+        self.stop_event.set()
+        self.join(timeout)
+        self.tap.close()
+        return(not self.is_alive())
+
+    def handover(self):
+        '''
+        Stop grabbing and give the ring, holding the pre-roll, to the recording.
+        Raises RuntimeError if the thread doesn't stop, its ring is still being written.
+        Returns:
+            ring (FrameRing or SharedFrameRing): ring to record into
+            n_frames (int): frames of pre-roll in it
+        '''
+        if not self._stop_grabbing():
+            raise RuntimeError('Pre-roll thread did not stop, its frames can not be handed over')
+        self.handed_over = True
+        return(self.ring, self.held)
+
+    def stop(self):
+        '''
+        Stop grabbing and throw the pre-roll away
+        '''
+        if not self._stop_grabbing():
+            if self.logger is not None:
+                self.logger.info('Pre-roll thread did not stop, leaving its ring in place')
+            return
+        if not self.handed_over and hasattr(self.ring, 'unlink'):
+            self.ring.unlink()
@@ -0,0 +1,236 @@
+'''
+Live preview of a ximea camera, off the GL thread.
+
+A PreviewWorker thread grabs frames from the camera (camera.get_image blocks until
+the next frame, so grabbing every frame keeps the preview current instead of showing
+whatever is queued in the camera's buffers), turns at most max_fps of them a second
+into a small BGR image by bayer binning (ximea_decode.bin_bayer_frame) and publishes
+only the newest one to a LatestFrame slot. gl_display reads that slot, which never
+blocks and never waits for the camera.
+
+While recording the camera belongs to the acquisition thread, which hands every
+Nth recorded frame to a PreviewTap instead: the frame stays in its ring slot (the
+slot is retained until the preview is done with it), so the preview costs the
+recording neither a copy nor a camera call.
+'''
+import threading
+import time
+from ximea_decode import bin_bayer_frame
+from ximea_packing import image_data, frame_bytes
+
+class LatestFrame():
+    '''
+    Single slot holding the newest preview image, older ones are simply replaced.
+    seq counts the images published, so readers can tell whether there is a new one.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.image = None
+        self.seq = 0
+
+    def publish(self, image):
+        with self.lock:
+            self.image = image
+            self.seq += 1
+
+    def latest(self):
+        '''
+        (seq, image) of the newest image, image is None if nothing was published yet
+        '''
+        with self.lock:
+            return(self.seq, self.image)
+
+    def clear(self):
+        with self.lock:
+            self.image = None
+
+class PreviewTap():
+    '''
+    Decimated hand over of recorded frames to the preview.
+
+    The acquisition thread asks wants() for every frame it records, and for the
+    frames it wants retain()s the ring slot before committing it and offer()s it.
+    Only the newest offered frame is kept, an older one nobody took is released
+    back to the ring right away. The preview take()s a frame, reads it in place
+    and gives it back with done().
+    Params:
+        ring (FrameRing or SharedFrameRing): ring the recorded frames live in
+        every (int): offer every Nth recorded frame
+    '''
+    def __init__(self, ring, every=10):
+        self.ring = ring
+        self.every = max(int(every), 1)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = None
+        self.in_use = None
+        self.closed = False
+        self.count = 0
+        self.offered = 0
+        self.skipped = 0
+
+    def wants(self):
+        self.count += 1
+        return(not self.closed and self.count % self.every == 0)
+
+    def offer(self, slot, frame):
+        '''
+        Hand a retained slot holding frame (frame_data) to the preview
+        '''
+        with self.lock:
+            old = self.pending
+            self.pending = (slot, frame)
+            self.offered += 1
+            self.changed.notify_all()
+        if old is not None:
+            self.skipped += 1
+            self.ring.release(old[0])
+
+    def take(self, timeout=None):
+        '''
+        Newest offered (slot, frame), or None if there was none within timeout or
+        the tap is closed. Hand the slot back with done().
+        '''
+        with self.lock:
+            self.changed.wait_for(lambda: self.pending is not None or self.closed, timeout)
+            if self.pending is None or self.closed:
+                return(None)
+            taken, self.pending = self.pending, None
+            self.in_use = taken[0]
+            return(taken)
+
+    def done(self, slot):
+        with self.lock:
+            self.in_use = None
+            self.changed.notify_all()
+        self.ring.release(slot)
+
+    def close(self, timeout=1):
+        '''
+        Stop offering frames, release the one waiting and wait for the preview to
+        finish the one it holds (the ring may be unlinked afterwards)
+        '''
+        with self.lock:
+            self.closed = True
+            old, self.pending = self.pending, None
+            self.changed.notify_all()
+            self.changed.wait_for(lambda: self.in_use is None, timeout)
+        if old is not None:
+            self.ring.release(old[0])
+
+class PreviewWorker(threading.Thread):
+    '''
+    Thread grabbing preview frames from one camera into a LatestFrame slot.
+
+    The camera may only be read by one thread at a time, so the worker is paused
+    (pause() returns once the worker is out of get_image) while the recording
+    pipeline owns the camera, and resumed afterwards. Meanwhile frames can come
+    from the recording instead, see attach_tap().
+    Params:
+        camera (XimeaCamera instance): camera to preview
+        image_handle (Ximea Camera image): handle the frames are grabbed into
+        imshape (tuple): (height, width) of the raw frames
+        logger (instace of class logger): used to pass messages to gui
+        max_fps (float): most preview images made per second
+        step (int): bayer blocks to skip per preview pixel, see bin_bayer_frame
+        norm (bool): min/max normalize the preview
+        bayer (str): bayer pattern of the camera
+        pixel_format (str): how the camera delivers its frames, see ximea_packing
+    '''
+    def __init__(self, camera, image_handle, imshape, logger, max_fps=15, step=1, norm=True, bayer='RG', pixel_format='uint8'):
+        super().__init__(daemon=True, name='ximea_preview')
+        self.camera = camera
+        self.image_handle = image_handle
+        self.imshape = tuple(imshape)
+        self.logger = logger
+        self.max_fps = max_fps
+        self.step = step
+        self.norm = norm
+        self.bayer = bayer
+        self.pixel_format = pixel_format
+        self.frame_nbytes = frame_bytes(self.imshape[0], self.imshape[1], pixel_format)
+        self.slot = LatestFrame()
+        self.stop_event = threading.Event()
+        self.run_event = threading.Event()
+        self.run_event.set()
+        self.idle_event = threading.Event()
+        self.tap = None
+        self.frames_grabbed = 0
+        self.frames_shown = 0
+        self.busy_seconds = 0.0
+
+    def pause(self, timeout=5):
+        '''
+        Stop grabbing, and wait until the worker has let go of the camera
+        '''
+        self.run_event.clear()
+        if self.is_alive():
+            self.idle_event.wait(timeout)
+        self.slot.clear()
+
+    def resume(self):
+        self.run_event.set()
+
+    def stop(self, timeout=5):
+        self.stop_event.set()
+        self.run_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def latest(self):
+        return(self.slot.latest())
+
+    def attach_tap(self, tap):
+        '''
+        Show frames offered by a PreviewTap (while recording) instead of grabbing them
+        '''
+        self.tap = tap
+
+    def detach_tap(self):
+        self.tap = None
+
+    def _show(self, raw):
+        t0 = time.perf_counter()
+        im = bin_bayer_frame(raw, self.imshape, self.step, self.norm, self.bayer, self.pixel_format)
+        self.slot.publish(im)
+        self.frames_shown += 1
+        self.busy_seconds += time.perf_counter() - t0
+
+    def _show_tap(self, tap):
+        taken = tap.take(0.5)
+        if taken is None:
+            if tap.closed:
+                #recording is over, wait to be detached
+                self.stop_event.wait(0.1)
+            return
+        slot, frame = taken
+        try:
+            self._show(frame.raw_data)
+        finally:
+            tap.done(slot)
+
+    def run(self):
+        next_shown = 0
+        while not self.stop_event.is_set():
+            tap = self.tap
+            if tap is not None:
+                self._show_tap(tap)
+                continue
+            if not self.run_event.is_set():
+                self.idle_event.set()
+                self.run_event.wait(0.5)
+                continue
+            self.idle_event.clear()
+            try:
+                self.camera.get_image(self.image_handle)
+            except Exception as e:
+                self.logger.info(f'Preview could not grab a frame: {e}')
+                time.sleep(0.1)
+                continue
+            self.frames_grabbed += 1
+            now = time.perf_counter()
+            if now < next_shown:
+                continue
+            next_shown = now + 1.0 / self.max_fps if self.max_fps else now
+            self._show(image_data(self.image_handle, self.frame_nbytes))
+        self.idle_event.set()
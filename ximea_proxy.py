@@ -0,0 +1,153 @@
+'''
+Low resolution proxy of a ximea recording, written while recording.
+
+Browsing a raw recording means reading and demosaicing full resolution bayer frames.
+With proxy_every set, the acquisition thread also hands every Nth recorded frame to a
+PreviewTap for a ProxyWriter thread, which bins it (ximea_decode.bin_bayer_frame, so
+no debayer), JPEG compresses it and appends it to
+
+    proxy_{cam_name}.mjpeg   the JPEGs back to back (plays as motion JPEG)
+    proxy_{cam_name}.idx     PROXY_DTYPE record per proxy frame: byte offset and size
+                             of its JPEG, camera frame number and camera/host time
+
+in the recording folder. The writer runs at a raised nice value and sheds load: the
+tap only keeps the newest offered frame, so when the writer falls behind frames are
+skipped instead of queued, and the recording never waits for it. The ring slot is
+given back as soon as the frame is binned.
+
+ProxyRecording opens a proxy (the index loads in one read, JPEGs are decoded on
+access) and maps its frames to the full resolution XimeaRecording by camera time.
+'''
+import os as os
+import threading
+import time
+import numpy as np
+import cv2
+from ximea_decode import bin_bayer_frame
+from ximea_realtime import make_realtime
+
+PROXY_DTYPE = np.dtype([('offset', '<u8'),
+                        ('nbytes', '<u4'),
+                        ('nframe', '<u8'),
+                        ('tsSec', '<u4'),
+                        ('tsUSec', '<u4'),
+                        ('host_time', '<f8')])
+
+def proxy_file_names(save_folder, cam_name):
+    '''
+    (JPEG stream, index) file names of a camera's proxy
+    '''
+    return(os.path.join(save_folder, f'proxy_{cam_name}.mjpeg'),
+           os.path.join(save_folder, f'proxy_{cam_name}.idx'))
+
+class ProxyWriter(threading.Thread):
+    '''
+    Background writer of a camera's proxy.
+    Params:
+        tap (ximea_preview.PreviewTap): tap on the camera's frame ring (every sets the decimation)
+        save_folder (str): recording folder
+        cam_name (str): camera name
+        imshape (tuple): (height, width) of the raw frames
+        pixel_format (str): how the frames are stored, see ximea_packing
+        bayer (str): bayer pattern, see ximea_decode
+        step (int): bayer blocks per proxy pixel, the proxy is (height/2/step, width/2/step)
+        quality (int): JPEG quality
+        nice (int): nice value of the writer thread, None to leave it
+        logger (instace of class logger): used to pass messages to gui
+    '''
+    def __init__(self, tap, save_folder, cam_name, imshape, pixel_format='uint8', bayer='RG',
+                 step=4, quality=70, nice=10, logger=None):
+        super().__init__(daemon=True, name=f'ximea_proxy_{cam_name}')
+        self.tap = tap
+        self.cam_name = cam_name
+        self.imshape = tuple(imshape)
+        self.pixel_format = pixel_format
+        self.bayer = bayer
+        self.step = step
+        self.quality = quality
+        self.nice = nice
+        self.logger = logger
+        self.file_name, self.index_name = proxy_file_names(save_folder, cam_name)
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.busy_seconds = 0.0
+
+    def run(self):
+        if self.nice is not None:
+            make_realtime(None, self.nice, self.logger, f'{self.cam_name} proxy')
+        offset = 0
+        try:
+            with open(self.file_name, 'wb') as f, open(self.index_name, 'wb') as index:
+                while True:
+                    taken = self.tap.take(0.5)
+                    if taken is None:
+                        if self.tap.closed:
+                            break
+                        continue
+                    t0 = time.perf_counter()
+                    slot, frame = taken
+                    try:
+                        im = bin_bayer_frame(frame.raw_data, self.imshape, self.step, False, self.bayer, self.pixel_format)
+                    finally:
+                        self.tap.done(slot)
+                    ok, jpeg = cv2.imencode('.jpg', im, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+                    if not ok:
+                        continue
+                    f.write(jpeg)
+                    record = np.array([(offset, jpeg.size, frame.nframe, frame.tsSec, frame.tsUSec, frame.host_time)],
+                                      dtype=PROXY_DTYPE)
+                    index.write(record.tobytes())
+                    offset += jpeg.size
+                    self.frames_written += 1
+                    self.bytes_written += jpeg.size
+                    self.busy_seconds += time.perf_counter() - t0
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.info(f'Proxy of {self.cam_name} stopped: {e!r}')
+            return
+        if self.logger is not None:
+            self.logger.info(f'Proxy of {self.cam_name}: {self.frames_written} frames, '
+                             f'{self.tap.skipped} skipped, {self.bytes_written / 1e6:.1f} MB')
+
+    def stats(self):
+        return({'frames': self.frames_written,
+                'skipped': self.tap.skipped,
+                'MB': self.bytes_written / 1e6,
+                'busy_seconds': self.busy_seconds})
+
+class ProxyRecording():
+    '''
+    Frames of a camera's proxy, with the way back to the full recording.
+    Params:
+        save_folder (str): recording folder
+        cam_name (str): camera name
+    '''
+    def __init__(self, save_folder, cam_name='ximea'):
+        self.file_name, index_name = proxy_file_names(save_folder, cam_name)
+        self.index = np.fromfile(index_name, dtype=PROXY_DTYPE)
+        #a proxy cut short by a crash may have an index record for a JPEG that isn't all there
+        size = os.path.getsize(self.file_name)
+        self.index = self.index[self.index['offset'] + self.index['nbytes'] <= size]
+        self.nframe = self.index['nframe']
+        self.timestamps = self.index['tsSec'] + self.index['tsUSec'] * 1e-6
+        self._data = np.memmap(self.file_name, dtype=np.uint8, mode='r') if size else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return(len(self.index))
+
+    def __getitem__(self, i):
+        entry = self.index[i]
+        jpeg = self._data[int(entry['offset']):int(entry['offset']) + int(entry['nbytes'])]
+        return(cv2.imdecode(np.asarray(jpeg), cv2.IMREAD_COLOR))
+
+    def recording_index(self, i, recording):
+        '''
+        Position in the full resolution recording (ximea_reader.XimeaRecording) of proxy frame i
+        '''
+        return(recording.index_at_time(self.timestamps[i]))
+
+    def full_frame(self, i, recording):
+        '''
+        Full resolution raw frame of proxy frame i
+        '''
+        return(recording[self.recording_index(i, recording)])
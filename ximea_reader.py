@@ -0,0 +1,243 @@
+import os as os
+import glob
+import numpy as np
+import ximea_container as container
+import ximea_codec
+import ximea_clock
+from ximea_packing import frame_bytes, is_packed, pixel_dtype, unpack_frames
+from ximea_manifest import read_manifest, manifest_chunk_files
+
+class XimeaRecording():
+    '''
+    Random access, memory mapped view of the frames of one camera in a ximea recording.
+
+    Every chunk file is memory mapped (lazily, on first access) and the recording is
+    exposed as one array-like sequence of raw bayer frames: rec[i] is a zero copy
+    (height, width) view into the mapped chunk, so only the pages actually touched
+    are read from disk. Slices that fall inside one chunk are views as well, slices
+    across chunks are stacked into a new array. Chunks of compressed frames (see
+    ximea_codec) are mapped the same way, but their frames are decoded into new arrays.
+    Packed 10/12 bit frames (see ximea_packing) are unpacked to uint16 arrays, a slice
+    inside one chunk in one go; raw_frame gives the stored bytes.
+
+    Works on indexed .xchunk recordings and on the original headerless .bin chunks
+    (which need imshape and read their timestamps from timestamps_{cam_name}.tslog, or
+    the .tsv of older recordings). Chunks are found through manifest_{cam_name}.yaml
+    when the recording has one, so chunks striped over several disks (see
+    ximea_stripes) read back as one sequence.
+
+    Params:
+        save_folder (str): recording folder holding the {cam_name} folder of chunks
+        cam_name (str): camera name used when recording
+        imshape (tuple): (height, width) of the frames, only needed for .bin chunks
+        dtype (str): pixel format of .bin chunks (uint8, uint16, packed10 or packed12),
+            taken from the manifest when it has one
+    '''
+    def __init__(self, save_folder, cam_name='ximea', imshape=(1544, 2064), dtype='uint8'):
+        self.save_folder = save_folder
+        self.cam_name = cam_name
+        cam_dir = os.path.join(save_folder, cam_name)
+        manifest = read_manifest(save_folder, cam_name)
+        if manifest is not None and manifest['chunks']:
+            chunk_files = manifest_chunk_files(save_folder, manifest)
+            indexed = [f for _, f in chunk_files if f.endswith('.xchunk')]
+            raw = [(fstart, f) for fstart, f in chunk_files if not f.endswith('.xchunk')]
+            dtype = manifest.get('pixel_format', dtype)
+        else:
+            indexed = sorted(glob.glob(os.path.join(cam_dir, '*.xchunk')))
+            raw = container.list_raw_chunks(cam_dir)
+        if indexed:
+            self._load_indexed(indexed)
+        else:
+            self._load_raw(raw, imshape, dtype)
+        self.chunk_starts = np.cumsum([0] + [len(c['index']) for c in self.chunks])
+        self.indices = np.concatenate([c['first_index'] + np.arange(len(c['index'])) for c in self.chunks]) if self.chunks else np.zeros(0, dtype=np.int64)
+        self.nframe = np.concatenate([c['index']['nframe'] for c in self.chunks]) if self.chunks else np.zeros(0, dtype=np.uint64)
+        self.tsSec = np.concatenate([c['index']['tsSec'] for c in self.chunks]) if self.chunks else np.zeros(0, dtype=np.uint32)
+        self.tsUSec = np.concatenate([c['index']['tsUSec'] for c in self.chunks]) if self.chunks else np.zeros(0, dtype=np.uint32)
+        #camera timestamp of every frame in seconds, what index_at_time searches
+        self.timestamps = self.tsSec + self.tsUSec * 1e-6
+        self._maps = {}
+
+    def _timestamps(self):
+        '''
+        Timestamps to recover unclosed chunks with, None if the recording has no timestamp file
+        '''
+        if container.timestamp_file(self.save_folder, self.cam_name) is None:
+            return(None)
+        return(container.read_timestamps(self.save_folder, self.cam_name))
+
+    def _load_indexed(self, file_names):
+        self.chunks = []
+        ts = None
+        for file_name in file_names:
+            header = container.read_chunk_header(file_name)
+            if not header.n_frames and ts is None:
+                #only unclosed chunks need the timestamps
+                ts = self._timestamps()
+            index = container.read_chunk_index(file_name, header, ts)
+            if len(index) == 0:
+                continue
+            self.chunks.append({'file_name': file_name,
+                                'first_index': header.first_index,
+                                'header': header,
+                                'index': index})
+        self.chunks.sort(key=lambda c: c['first_index'])
+        header = container.read_chunk_header(file_names[0])
+        self.imshape = (header.height, header.width)
+        self.pixel_format = header.dtype
+        self.dtype = pixel_dtype(header.dtype)
+        self.header = header
+
+    def _load_raw(self, chunk_files, imshape, dtype):
+        self.imshape = tuple(imshape)
+        self.pixel_format = dtype
+        self.dtype = pixel_dtype(dtype)
+        self.header = None
+        frame_size = frame_bytes(self.imshape[0], self.imshape[1], dtype)
+        ts = self._timestamps()
+        self.chunks = []
+        for fstart, file_name in chunk_files:
+            index = container.recovered_frames(file_name, fstart, frame_size, ts)
+            if len(index) == 0:
+                continue
+            self.chunks.append({'file_name': file_name,
+                                'first_index': fstart,
+                                'header': None,
+                                'index': index})
+
+    def __len__(self):
+        return(int(self.chunk_starts[-1]))
+
+    @property
+    def shape(self):
+        return((len(self), *self.imshape))
+
+    def _codec(self, c):
+        header = self.chunks[c]['header']
+        return('raw' if header is None else header.codec)
+
+    def _chunk_bytes(self, c):
+        '''
+        Whole chunk c mapped as bytes
+        '''
+        if c not in self._maps:
+            self._maps[c] = np.memmap(self.chunks[c]['file_name'], dtype=np.uint8, mode='r')
+        return(self._maps[c])
+
+    def _decode(self, c, j):
+        entry = self.chunks[c]['index'][j]
+        offset = int(entry['offset'])
+        payload = self._chunk_bytes(c)[offset:offset + int(entry['nbytes'])]
+        return(ximea_codec.decode_frame(payload, self._codec(c)))
+
+    def _chunk_frames(self, c):
+        '''
+        (n, height, width) memmap of the frames of (uncompressed) chunk c, or
+        (n, frame bytes) of packed frames
+        '''
+        if c not in self._maps:
+            chunk = self.chunks[c]
+            if is_packed(self.pixel_format):
+                dtype, shape = np.uint8, (frame_bytes(*self.imshape, self.pixel_format),)
+            else:
+                dtype, shape = self.dtype, self.imshape
+            self._maps[c] = np.memmap(chunk['file_name'], dtype=dtype, mode='r',
+                                      offset=int(chunk['index']['offset'][0]),
+                                      shape=(len(chunk['index']), *shape))
+        return(self._maps[c])
+
+    def _frames(self, c, key):
+        frames = self._chunk_frames(c)[key]
+        if is_packed(self.pixel_format):
+            return(unpack_frames(frames, self.imshape, self.pixel_format))
+        return(frames)
+
+    def raw_frame(self, i):
+        '''
+        Frame i as stored (packed frames stay packed), as a flat uint8 array
+        '''
+        c, j = self._locate(int(i))
+        if(self._codec(c) != 'raw'):
+            return(self._decode(c, j).reshape(-1))
+        return(self._chunk_frames(c)[j].reshape(-1).view(np.uint8))
+
+    def _locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f'frame {i} out of range for recording of {len(self)} frames')
+        c = int(np.searchsorted(self.chunk_starts, i, side='right')) - 1
+        return(c, i - int(self.chunk_starts[c]))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            positions = range(*key.indices(len(self)))
+            if len(positions) == 0:
+                return(np.zeros((0, *self.imshape), dtype=self.dtype))
+            c0, j0 = self._locate(positions[0])
+            c1, j1 = self._locate(positions[-1])
+            if c0 == c1 and self._codec(c0) == 'raw':
+                return(self._frames(c0, slice(j0, j1+1, positions.step)))
+            return(np.stack([self[i] for i in positions]))
+        if isinstance(key, (list, np.ndarray)):
+            return(np.stack([self[int(i)] for i in key]))
+        c, j = self._locate(int(key))
+        if(self._codec(c) != 'raw'):
+            return(self._decode(c, j))
+        return(self._frames(c, j))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def index_at_time(self, t, side='nearest'):
+        '''
+        Position of the frame(s) at camera time t (seconds), by binary search over the
+        frame timestamps.
+        Params:
+            t (float or np.ndarray): camera time(s) in seconds
+            side (str): 'nearest' frame, last frame 'before' (or at) t, or first frame 'after' (or at) t
+        Returns:
+            i (int or np.ndarray): frame position(s), clipped to the recording
+        '''
+        ts = self.timestamps
+        t = np.asarray(t, dtype=np.float64)
+        if(side == 'before'):
+            i = np.searchsorted(ts, t, side='right') - 1
+        elif(side == 'after'):
+            i = np.searchsorted(ts, t, side='left')
+        elif(side == 'nearest' and len(ts) < 2):
+            i = np.zeros(t.shape, dtype=np.int64)
+        elif(side == 'nearest'):
+            i = np.clip(np.searchsorted(ts, t), 1, len(ts) - 1)
+            i = np.where(np.abs(ts[i - 1] - t) <= np.abs(ts[i] - t), i - 1, i)
+        else:
+            raise ValueError(f'Unknown side {side}')
+        i = np.clip(i, 0, len(ts) - 1)
+        return(int(i) if i.ndim == 0 else i)
+
+    def frame_at_time(self, t, side='nearest'):
+        '''
+        Raw frame at camera time t (seconds), see index_at_time
+        '''
+        return(self[self.index_at_time(t, side)])
+
+    def pupil_time(self, t=None):
+        '''
+        Map camera time(s) to pupil time with the clock fit of the recording (see
+        ximea_clock, needs the timestamp_clocksync_{cam_name}.tsv written while recording)
+        Params:
+            t (float or np.ndarray): camera time(s) in seconds (default: every frame)
+        Returns:
+            t_sync (float or np.ndarray): pupil time(s)
+        '''
+        if not hasattr(self, '_clock_fit'):
+            self._clock_fit = ximea_clock.load_clock_fit(self.save_folder, self.cam_name)
+        return(self._clock_fit.to_sync(self.timestamps if t is None else t))
+
+    def close(self):
+        '''
+        Drop the chunk memory maps (they are also released when the recording is garbage collected)
+        '''
+        self._maps.clear()
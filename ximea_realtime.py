@@ -0,0 +1,114 @@
+'''
+Low jitter mode for the ximea acquisition pipelines.
+
+In the busy pupil process the acquisition threads compete with everything else for
+the CPU and are stopped by cyclic garbage collection passes, which shows up as
+stretched acquisition loop periods (see the loop period histogram in ximea_health).
+While recording, this mode
+    - freezes cyclic GC (gc.freeze: everything alive at the start is moved out of the
+      collector's reach, so collections only look at new objects) or disables it
+    - pins the acquisition and writer threads/processes to dedicated cores
+      (sched_setaffinity of the calling thread, threads started later inherit it)
+    - lowers their nice value (needs CAP_SYS_NICE or a matching RLIMIT_NICE for
+      negative values, otherwise the nice value is left as it is)
+Every step is best effort: what isn't permitted or available is logged and skipped.
+'''
+import os as os
+import gc
+import threading
+
+GC_MODES = ('freeze', 'disable', 'none')
+
+_gc_lock = threading.Lock()
+_gc_holds = 0
+_gc_state = None
+
+def hold_gc(mode='freeze'):
+    '''
+    Keep cyclic GC out of the way until release_gc (nested holds are counted, GC is
+    restored when the last one is released)
+    '''
+    global _gc_holds, _gc_state
+    if(mode == 'none'):
+        return
+    if mode not in GC_MODES:
+        raise ValueError(f'Unknown gc mode {mode}, use one of {GC_MODES}')
+    with _gc_lock:
+        _gc_holds += 1
+        if _gc_holds > 1:
+            return
+        _gc_state = (mode, gc.isenabled())
+        gc.collect()
+        if(mode == 'freeze' and hasattr(gc, 'freeze')):
+            gc.freeze()
+        else:
+            gc.disable()
+
+def release_gc():
+    global _gc_holds, _gc_state
+    with _gc_lock:
+        if _gc_holds == 0:
+            return
+        _gc_holds -= 1
+        if _gc_holds > 0:
+            return
+        mode, was_enabled = _gc_state
+        if(mode == 'freeze' and hasattr(gc, 'unfreeze')):
+            gc.unfreeze()
+        elif was_enabled:
+            gc.enable()
+        _gc_state = None
+
+def plan_cores(n_acq, n_writers, cores=None):
+    '''
+    Dedicated cores for n_acq acquisition threads and n_writers writers: the last
+    usable cores go to acquisition (one each), the ones before them are shared by
+    the writers, the rest is left to pupil.
+    Params:
+        cores (list of int): cores to use, default every core this process may run on
+    Returns:
+        acq_cores (list of list of int): cores of each acquisition thread ([] to not pin)
+        writer_cores (list of int): cores the writers share ([] to not pin)
+    '''
+    if cores is None:
+        if not hasattr(os, 'sched_getaffinity'):
+            return([[] for _ in range(n_acq)], [])
+        cores = sorted(os.sched_getaffinity(0))
+        #leave pupil at least two cores of its own
+        cores = cores[2:] if len(cores) > n_acq + 2 else []
+    cores = list(cores)
+    if len(cores) < n_acq:
+        return([[] for _ in range(n_acq)], [])
+    acq_cores = [[c] for c in cores[len(cores) - n_acq:]]
+    writer_cores = cores[:len(cores) - n_acq][-max(n_writers, 1):] if n_writers else []
+    return(acq_cores, writer_cores)
+
+def make_realtime(cores=None, nice=-10, logger=None, label=''):
+    '''
+    Pin the calling thread to cores and lower its nice value, where permitted
+    Params:
+        cores (list of int): cores to run on, empty or None to leave the affinity alone
+        nice (int): nice value to set, None to leave it alone
+        label (str): name for the log
+    Returns:
+        applied (list of str): what was done
+    '''
+    applied = []
+    if cores and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, cores)
+            applied.append(f'cores {list(cores)}')
+        except OSError as e:
+            if logger is not None:
+                logger.info(f'{label}: could not pin to cores {list(cores)}: {e}')
+    if nice is not None and hasattr(os, 'setpriority'):
+        try:
+            #per thread on linux: the thread id is a pid for setpriority
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+            applied.append(f'nice {nice}')
+        except OSError as e:
+            if logger is not None:
+                logger.info(f'{label}: could not set nice {nice} (not permitted?): {e}')
+    if logger is not None and applied:
+        logger.info(f"{label}: {', '.join(applied)}")
+    return(applied)
@@ -0,0 +1,186 @@
+'''
+Replay of a recorded ximea session as a camera.
+
+ReplayCamera serves the frames of a recording (raw .bin or indexed chunks, read
+through XimeaRecording) with the camera interface init_camera returns: get_image()
+fills an image handle (ximea_sim.Image) with the raw frame (as stored, so packed
+10/12 bit frames stay packed and the camera reports their pixel format, see
+ximea_packing), nframe, tsSec and tsUSec as they were recorded. Frames come at their original timing (speed=1), scaled
+(speed=2 plays twice as fast) or as fast as possible (speed=0). A prefetch thread
+reads ahead into a bounded queue, so disk reads never stall the consumer.
+
+The plugin replays a recording when a serial number is given as
+replay:<rec_path>/ximea/<cam_name> (see ximea_utils.init_camera), the speed can be
+set with replay_speed in the camera settings yaml.
+'''
+import os as os
+import threading
+import queue as queue
+import time
+import numpy as np
+from ximea_reader import XimeaRecording
+from ximea_sim import Xi_error
+from ximea_packing import PIXEL_BITS, is_packed
+
+REPLAY_PREFIX = 'replay:'
+
+class ReplayCamera():
+    '''
+    Camera serving the frames of a recording.
+    Params:
+        save_folder (str): recording folder holding the {cam_name} folder
+        cam_name (str): camera to replay
+        speed (float): 1 for the original timing, 0 for as fast as possible, otherwise
+            a multiple of the original rate
+        prefetch (int): frames read ahead
+        loop (bool): start over at the end instead of timing out
+        imshape (tuple): frame shape, only needed for raw .bin recordings
+    '''
+    def __init__(self, save_folder, cam_name='ximea', speed=1.0, prefetch=32, loop=False, imshape=(1544, 2064)):
+        self.recording = XimeaRecording(save_folder, cam_name, imshape)
+        if len(self.recording) == 0:
+            raise Xi_error(f'Nothing to replay in {os.path.join(save_folder, cam_name)}')
+        self.speed = speed
+        self.prefetch = prefetch
+        self.loop = loop
+        self.params = {}
+        header = self.recording.header
+        self.serial = header.serial if header is not None and header.serial else f'{REPLAY_PREFIX}{cam_name}'
+        self.acquiring = False
+        self.frames = None
+        self.reader = None
+        self.stop_event = threading.Event()
+        self.t_start = 0.0
+        self.ts_start = 0.0
+        self.last_ts = 0.0
+        self.frames_served = 0
+        self.stalls = 0
+
+    @classmethod
+    def from_serial(cls, serial, **kwargs):
+        '''
+        ReplayCamera for a 'replay:<save_folder>/<cam_name>' serial number
+        '''
+        path = os.path.normpath(serial[len(REPLAY_PREFIX):])
+        return(cls(os.path.dirname(path), os.path.basename(path), **kwargs))
+
+    #device
+    def open_device(self):
+        pass
+
+    def open_device_by_SN(self, serial):
+        pass
+
+    def close_device(self):
+        self.stop_acquisition()
+        self.recording.close()
+
+    def get_device_sn(self):
+        return(self.serial.encode())
+
+    #settings (apply_cam_settings looks for set_<name> methods, the recording decides the rest)
+    def set_replay_speed(self, speed):
+        self.speed = speed
+
+    def get_replay_speed(self):
+        return(self.speed)
+
+    def set_replay_loop(self, loop):
+        self.loop = bool(loop)
+
+    def get_replay_loop(self):
+        return(self.loop)
+
+    def get_imgdataformat(self):
+        pixel_format = self.recording.pixel_format
+        if is_packed(pixel_format):
+            return('XI_FRM_TRANSPORT_DATA')
+        return('XI_RAW16' if pixel_format == 'uint16' else 'XI_RAW8')
+
+    def get_output_bit_depth(self):
+        return(f'XI_BPP_{PIXEL_BITS[self.recording.pixel_format]}')
+
+    def is_output_bit_packing(self):
+        return(is_packed(self.recording.pixel_format))
+
+    def set_param(self, name, value):
+        self.params[name] = value
+
+    def get_param(self, name):
+        if(name == 'timestamp'):
+            return(int(self._camera_time() * 1e9))
+        return(self.params.get(name))
+
+    def _camera_time(self):
+        '''
+        Recorded camera time at this moment of the replay
+        '''
+        if not self.acquiring or not self.speed:
+            return(self.last_ts)
+        return(self.ts_start + (time.monotonic() - self.t_start) * self.speed)
+
+    #acquisition
+    def _read_ahead(self):
+        n = len(self.recording)
+        i = 0
+        while not self.stop_event.is_set():
+            if i == n:
+                if not self.loop:
+                    self.frames.put(None)
+                    return
+                i = 0
+            #copy out of the memory map here, so the page faults happen on this thread
+            frame = np.array(self.recording.raw_frame(i))
+            while not self.stop_event.is_set():
+                try:
+                    self.frames.put((i, frame), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            i += 1
+
+    def start_acquisition(self):
+        self.stop_acquisition()
+        self.stop_event.clear()
+        self.frames = queue.Queue(maxsize=self.prefetch)
+        self.reader = threading.Thread(target=self._read_ahead, daemon=True, name='ximea_replay')
+        self.reader.start()
+        self.acquiring = True
+        self.t_start = None
+
+    def stop_acquisition(self):
+        self.acquiring = False
+        self.stop_event.set()
+        if self.reader is not None:
+            self.reader.join(1)
+            self.reader = None
+
+    def get_image(self, image, timeout=5000):
+        '''
+        Wait until the next recorded frame is due and copy it into image
+        '''
+        if not self.acquiring:
+            raise Xi_error('ERROR 10: Acquisition is not started')
+        if self.frames.empty():
+            self.stalls += 1
+        try:
+            item = self.frames.get(True, timeout / 1000)
+        except queue.Empty:
+            raise Xi_error('ERROR 10: Timeout')
+        if item is None:
+            self.frames.put(None)
+            raise Xi_error('ERROR 10: Timeout (end of replay)')
+        i, frame = item
+        ts = float(self.recording.timestamps[i])
+        if self.t_start is None or (self.loop and i == 0):
+            #first frame (or start of a loop) sets the clock
+            self.t_start, self.ts_start = time.monotonic(), ts
+        elif self.speed:
+            due = self.t_start + (ts - self.ts_start) / self.speed
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.last_ts = ts
+        image.set_frame(frame, self.recording.nframe[i], self.recording.tsSec[i], self.recording.tsUSec[i],
+                        self.recording.imshape)
+        self.frames_served += 1
@@ -0,0 +1,402 @@
+import threading
+import time
+import collections
+import queue as queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from collections import namedtuple
+
+frame_data = namedtuple("frame_data", "raw_data nframe tsSec tsUSec host_time", defaults=(0.0,))
+
+RING_POLICIES = ('block', 'overwrite')
+#SharedFrameRing sequence number of a slot whose frame isn't queued
+TAKEN = -1
+
+class EndOfStream(Exception):
+    '''
+    Raised by get() once every frame committed before end_stream() has been handed out
+    Params:
+        n_frames (int): frames the consumer was handed in total
+    '''
+    def __init__(self, n_frames):
+        super().__init__(f'End of stream after {n_frames} frames')
+        self.n_frames = n_frames
+
+class FrameRing():
+    '''
+    Fixed capacity ring of preallocated frame slots used to hand frames from the
+    acquisition thread to the save thread without allocating per frame.
+
+    The producer claim()s a free slot, copies a frame into ring.frames[slot] and
+    commit()s it with its metadata. The consumer get()s committed slots in order
+    and release()s them once written. When every slot is in use the 'block'
+    policy makes claim() wait for the consumer, and the 'overwrite' policy drops
+    the oldest committed frame that the consumer has not picked up yet (and that
+    no preview holds, see retain; if every such frame is held it waits as 'block').
+
+    Slots are reference counted: the producer can retain() a slot before
+    committing it to hand the same frame to a second reader (ie a preview), the
+    slot is only reused once both have released it.
+
+    When the producer is done it calls end_stream(), which queues an end of stream
+    marker behind the last frame with the number of frames the consumer is due.
+    Once the consumer has got every frame before it, get() raises EndOfStream.
+
+    Params:
+        n_slots (int): number of preallocated frame slots
+        frame_size (int): size of each slot in bytes (must fit one raw frame)
+        policy (str): 'block' or 'overwrite', what to do when the ring is full
+    '''
+    def __init__(self, n_slots, frame_size, policy='block'):
+        if policy not in RING_POLICIES:
+            raise ValueError(f'Unknown ring policy {policy}, use one of {RING_POLICIES}')
+        if n_slots < 2:
+            raise ValueError('A frame ring needs at least 2 slots')
+        self.n_slots = int(n_slots)
+        self.frame_size = int(frame_size)
+        self.policy = policy
+        self.frames = np.zeros((self.n_slots, self.frame_size), dtype=np.uint8)
+
+        self._free = collections.deque(range(self.n_slots))
+        self._filled = collections.deque()
+        self._refs = np.zeros(self.n_slots, dtype=np.int64)
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._slot_filled = threading.Condition(self._lock)
+
+        self.high_water = 0
+        self.dropped = 0
+        self.discarded = 0
+        self.n_committed = 0
+        self.ended = None
+
+    @property
+    def occupancy(self):
+        '''
+        Number of slots currently holding a frame (queued or being written).
+        '''
+        return(self.n_slots - len(self._free))
+
+    @property
+    def nbytes(self):
+        return(self.frames.nbytes)
+
+    def claim(self, timeout=None):
+        '''
+        Get the index of a free slot for the producer to copy a frame into.
+        Raises queue.Full if no slot frees up within timeout (block policy).
+        '''
+        with self._lock:
+            if not self._free and self.policy == 'overwrite':
+                #oldest frame only the consumer is due, dropping one a preview holds frees nothing
+                for k, (slot, *_) in enumerate(self._filled):
+                    if self._refs[slot] == 1:
+                        del self._filled[k]
+                        self.dropped += 1
+                        self.high_water = max(self.high_water, self.occupancy)
+                        return(slot)
+            if not self._slot_freed.wait_for(lambda: self._free, timeout):
+                raise queue.Full
+            slot = self._free.popleft()
+            self._refs[slot] = 1
+            self.high_water = max(self.high_water, self.occupancy)
+            return(slot)
+
+    def retain(self, slot):
+        '''
+        Take an extra reference to a claimed slot, released with one more release().
+        Must be called before commit(), once committed the consumer may free the slot.
+        '''
+        with self._lock:
+            self._refs[slot] += 1
+
+    def commit(self, slot, nbytes, nframe, tsSec, tsUSec, host_time=0.0):
+        '''
+        Publish a claimed slot holding nbytes of frame data to the consumer.
+        '''
+        with self._lock:
+            self._filled.append((slot, nbytes, nframe, tsSec, tsUSec, host_time))
+            self.n_committed += 1
+            self._slot_filled.notify()
+
+    def put(self, data, nframe, tsSec, tsUSec, host_time=0.0, timeout=None):
+        '''
+        Copy a bytes-like frame into the ring (claim + copy + commit).
+        '''
+        data = np.frombuffer(data, dtype=np.uint8)
+        if data.size > self.frame_size:
+            raise ValueError(f'Frame of {data.size} bytes does not fit in {self.frame_size} byte slot')
+        slot = self.claim(timeout)
+        self.frames[slot, :data.size] = data
+        self.commit(slot, data.size, nframe, tsSec, tsUSec, host_time)
+
+    def get(self, block=True, timeout=None):
+        '''
+        Get the oldest committed frame. Raises queue.Empty like queue.Queue.get.
+        Returns:
+            slot (int): slot index, hand back with release() when done
+            frame (frame_data): frame with raw_data as a view into the slot
+        '''
+        with self._lock:
+            if not block:
+                timeout = 0
+            if not self._slot_filled.wait_for(lambda: self._filled or self.ended is not None, timeout):
+                raise queue.Empty
+            if not self._filled:
+                raise EndOfStream(self.ended)
+            slot, nbytes, *meta = self._filled.popleft()
+        return(slot, frame_data(self.frames[slot, :nbytes], *meta))
+
+    def discard_oldest(self, timeout=None):
+        '''
+        Producer side: take the oldest committed frame back out of the stream (ie the
+        pre-roll keeping only its last frames)
+        '''
+        slot, _ = self.get(True, timeout)
+        self.discarded += 1
+        self.release(slot)
+
+    def end_stream(self):
+        '''
+        Producer side: no more frames will be committed
+        Returns:
+            n_frames (int): frames the consumer gets in total
+        '''
+        with self._lock:
+            self.ended = self.n_committed - self.dropped - self.discarded
+            self._slot_filled.notify_all()
+            return(self.ended)
+
+    def release(self, slot):
+        '''
+        Return a slot obtained from get() (or retain()ed) to the free pool.
+        '''
+        with self._lock:
+            self._refs[slot] -= 1
+            if self._refs[slot] == 0:
+                self._free.append(slot)
+                self._slot_freed.notify()
+
+    def empty(self):
+        return(not self._filled)
+
+    def qsize(self):
+        return(len(self._filled))
+
+    def stats(self):
+        '''
+        Snapshot of the ring counters.
+        '''
+        return({'slots': self.n_slots,
+                'occupancy': self.occupancy,
+                'high_water': self.high_water,
+                'dropped': self.dropped,
+                'committed': self.n_committed})
+
+
+class SharedFrameRing():
+    '''
+    FrameRing variant whose slots live in a multiprocessing.shared_memory block,
+    so the consumer can run in a separate process. Only slot indices and frame
+    metadata travel through the (small) multiprocessing queues, the frame data
+    itself is never pickled.
+
+    The producer keeps the free list locally and gets slots back from the
+    consumer through a queue. The 'overwrite' policy drops the oldest committed
+    frame the consumer has not picked up yet and no preview holds, as FrameRing
+    does: every frame carries a sequence number, also kept per slot in shared
+    memory, and the producer reuses the slot under a new number, so the consumer
+    skips the stale queue entry when it gets there. If every slot is being written
+    or held, claim waits as for 'block'.
+    retain() works as for FrameRing, but only in the producer process (the
+    reference counts are kept there, every release() comes back through the
+    freed queue).
+
+    Same interface as FrameRing: claim/commit on the producer side, get/release
+    on the consumer side. The ring is picklable and reattaches by name, pass it
+    as an argument to multiprocessing.Process. The creating process should
+    unlink() it once the consumer has exited. end_stream() queues its marker
+    behind the last frame as for FrameRing, the consumer remembers having seen it.
+
+    Params:
+        n_slots (int): number of preallocated frame slots
+        frame_size (int): size of each slot in bytes (must fit one raw frame)
+        policy (str): 'block' or 'overwrite', what to do when the ring is full
+    '''
+    def __init__(self, n_slots, frame_size, policy='block'):
+        if policy not in RING_POLICIES:
+            raise ValueError(f'Unknown ring policy {policy}, use one of {RING_POLICIES}')
+        if n_slots < 2:
+            raise ValueError('A frame ring needs at least 2 slots')
+        self.n_slots = int(n_slots)
+        self.frame_size = int(frame_size)
+        self.policy = policy
+        self.shm = shared_memory.SharedMemory(create=True, size=self.n_slots*self.frame_size)
+        self._attach()
+
+        self._filled = mp.Queue()
+        self._freed = mp.Queue()
+        self._free = collections.deque(range(self.n_slots))
+        self._refs = np.zeros(self.n_slots, dtype=np.int64)
+        #sequence number of the frame queued in each slot, TAKEN once the consumer got it
+        self._seq = mp.Array('q', [TAKEN] * self.n_slots, lock=False)
+        self._seq_lock = mp.Lock()
+        #producer side: (slot, seq) of the committed frames, oldest first, for overwrite
+        self._queued = collections.deque()
+
+        self.high_water = 0
+        self.dropped = 0
+        self.discarded = 0
+        self.n_committed = 0
+        self.ended = None
+
+    def _attach(self):
+        self.frames = np.ndarray((self.n_slots, self.frame_size), dtype=np.uint8, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['frames']
+        del state['_free']
+        del state['_queued']
+        return(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._free = collections.deque()
+        self._queued = collections.deque()
+        self._attach()
+
+    def _collect_freed(self):
+        while True:
+            try:
+                self._unref(self._freed.get_nowait())
+            except queue.Empty:
+                return
+
+    def _unref(self, slot):
+        self._refs[slot] -= 1
+        if self._refs[slot] == 0:
+            self._free.append(slot)
+
+    @property
+    def occupancy(self):
+        '''
+        Number of slots not known to be free on the producer side.
+        '''
+        self._collect_freed()
+        return(self.n_slots - len(self._free))
+
+    @property
+    def nbytes(self):
+        return(self.frames.nbytes)
+
+    def _overwrite_oldest(self):
+        '''
+        Slot of the oldest queued frame only the consumer is due, taken from it, or None
+        '''
+        with self._seq_lock:
+            while self._queued and self._seq[self._queued[0][0]] != self._queued[0][1]:
+                self._queued.popleft()
+            for k, (slot, seq) in enumerate(self._queued):
+                if self._seq[slot] == seq and self._refs[slot] == 1:
+                    #the consumer skips the queue entry of a stale sequence number
+                    self._seq[slot] = TAKEN
+                    del self._queued[k]
+                    return(slot)
+        return(None)
+
+    def claim(self, timeout=None):
+        self._collect_freed()
+        if not self._free:
+            if self.policy == 'overwrite':
+                slot = self._overwrite_oldest()
+                if slot is not None:
+                    self.dropped += 1
+                    self.high_water = self.n_slots
+                    return(slot)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._free:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    self._unref(self._freed.get(True, remaining))
+                except queue.Empty:
+                    raise queue.Full
+        slot = self._free.popleft()
+        self._refs[slot] = 1
+        self.high_water = max(self.high_water, self.n_slots - len(self._free))
+        return(slot)
+
+    def retain(self, slot):
+        self._refs[slot] += 1
+
+    def commit(self, slot, nbytes, nframe, tsSec, tsUSec, host_time=0.0):
+        seq = self.n_committed
+        with self._seq_lock:
+            self._seq[slot] = seq
+            #forget the frames the consumer has got since
+            while self._queued and self._seq[self._queued[0][0]] != self._queued[0][1]:
+                self._queued.popleft()
+            self._queued.append((slot, seq))
+        self._filled.put((slot, seq, nbytes, nframe, tsSec, tsUSec, host_time))
+        self.n_committed += 1
+
+    def put(self, data, nframe, tsSec, tsUSec, host_time=0.0, timeout=None):
+        data = np.frombuffer(data, dtype=np.uint8)
+        if data.size > self.frame_size:
+            raise ValueError(f'Frame of {data.size} bytes does not fit in {self.frame_size} byte slot')
+        slot = self.claim(timeout)
+        self.frames[slot, :data.size] = data
+        self.commit(slot, data.size, nframe, tsSec, tsUSec, host_time)
+
+    def get(self, block=True, timeout=None):
+        if self.ended is not None:
+            raise EndOfStream(self.ended)
+        deadline = None if timeout is None or not block else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            slot, seq, *meta = self._filled.get(block, remaining)
+            if slot is None:
+                self.ended = seq
+                raise EndOfStream(self.ended)
+            with self._seq_lock:
+                if self._seq[slot] != seq:
+                    #overwritten by the producer, the slot holds a newer frame now
+                    continue
+                self._seq[slot] = TAKEN
+            nbytes, *meta = meta
+            return(slot, frame_data(self.frames[slot, :nbytes], *meta))
+
+    def discard_oldest(self, timeout=None):
+        slot, _ = self.get(True, timeout)
+        self.discarded += 1
+        self.release(slot)
+
+    def end_stream(self):
+        n_frames = self.n_committed - self.dropped - self.discarded
+        self._filled.put((None, n_frames))
+        return(n_frames)
+
+    def release(self, slot):
+        self._freed.put(slot)
+
+    def empty(self):
+        return(self._filled.empty())
+
+    def qsize(self):
+        return(self._filled.qsize())
+
+    def stats(self):
+        return({'slots': self.n_slots,
+                'occupancy': self.occupancy,
+                'high_water': self.high_water,
+                'dropped': self.dropped,
+                'committed': self.n_committed})
+
+    def unlink(self):
+        '''
+        Free the shared memory block, call from the creating process when done.
+        '''
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,142 @@
+'''
+Cached, diff-applied camera settings.
+
+A settings yaml maps parameter names to values: `name: value` is applied with
+cam.set_name(value), and `is_name: true/false` with cam.enable_name() or
+cam.disable_name(). Applying used to re-parse the yaml and re-apply every
+parameter on each (re)open. Now:
+    - parsed yamls are cached until the file changes (path, mtime and size)
+    - the setter/getter of every parameter is resolved once per camera model
+    - the device's current value is read back first (get_name() / is_name()), and
+      only parameters that differ are set
+Every parameter's outcome and time is returned, and apply_settings logs a one line
+summary with the slowest ones.
+'''
+import os as os
+import time
+import math
+import threading
+from collections import namedtuple
+import yaml
+
+#action is 'set', 'unchanged', 'missing' (camera has no setter) or 'error'
+setting_applied = namedtuple('setting_applied', 'name value previous action seconds')
+
+_yaml_cache = {}
+_accessor_cache = {}
+_cache_lock = threading.Lock()
+
+def load_settings(config_file):
+    '''
+    Parsed settings yaml, from the cache unless the file changed since
+    '''
+    config_file = os.path.abspath(config_file)
+    st = os.stat(config_file)
+    key = (st.st_mtime_ns, st.st_size)
+    with _cache_lock:
+        cached = _yaml_cache.get(config_file)
+        if cached is not None and cached[0] == key:
+            return(cached[1])
+    with open(config_file, 'r') as f:
+        settings = yaml.safe_load(f) or {}
+    with _cache_lock:
+        _yaml_cache[config_file] = (key, settings)
+    return(settings)
+
+def camera_model(cam):
+    '''
+    Key the resolved accessors are cached under: the camera class and its model name
+    '''
+    try:
+        model = cam.get_device_name()
+        model = model.decode() if isinstance(model, bytes) else str(model)
+    except Exception:
+        model = ''
+    return((type(cam).__module__, type(cam).__name__, model))
+
+def _resolve(cam, name):
+    '''
+    (kind, set, get) for a parameter: kind is 'set' (set_name(value)), 'switch'
+    (enable_name() / disable_name()) or None if the camera can't take it
+    '''
+    if hasattr(cam, f'set_{name}'):
+        return(('set', f'set_{name}', f'get_{name}' if hasattr(cam, f'get_{name}') else None))
+    if name.startswith('is_') and hasattr(cam, f"enable_{name[3:]}"):
+        return(('switch', name[3:], name if hasattr(cam, name) else None))
+    return((None, None, None))
+
+def resolve_accessors(cam, names):
+    '''
+    Setter/getter of each parameter name for this camera's model, cached
+    '''
+    model = camera_model(cam)
+    with _cache_lock:
+        accessors = _accessor_cache.setdefault(model, {})
+        for name in names:
+            if name not in accessors:
+                accessors[name] = _resolve(cam, name)
+        return({name: accessors[name] for name in names})
+
+def same_value(current, value):
+    if current is None:
+        return(False)
+    if isinstance(current, bytes):
+        current = current.decode()
+    if isinstance(value, bool) or isinstance(current, bool):
+        return(bool(current) == bool(value))
+    if isinstance(value, (int, float)) and isinstance(current, (int, float)):
+        #the device rounds some values (ie exposure to its line time)
+        return(math.isclose(current, value, rel_tol=1e-3, abs_tol=1e-9))
+    return(str(current) == str(value))
+
+def apply_settings(cam, config_file, logger=None, force=False):
+    '''
+    Apply the parameters of a settings yaml that differ from what the camera has now.
+    Params:
+        cam (XimeaCamera instance): camera handle
+        config_file (str): settings yaml
+        logger (instace of class logger): used to pass messages to gui
+        force (bool): set every parameter, without reading back the current values
+    Returns:
+        applied (list of setting_applied): outcome and seconds of every parameter
+    '''
+    t_start = time.perf_counter()
+    settings = load_settings(config_file)
+    accessors = resolve_accessors(cam, list(settings))
+    applied = []
+    for name, value in settings.items():
+        t_param = time.perf_counter()
+        kind, setter, getter = accessors[name]
+        previous = None
+        if kind is None:
+            action = 'missing'
+        else:
+            if getter is not None and not force:
+                try:
+                    previous = getattr(cam, getter)()
+                except Exception:
+                    #write only, or not readable in this mode: unknown, so set it
+                    previous = None
+            try:
+                if same_value(previous, value):
+                    action = 'unchanged'
+                elif(kind == 'set'):
+                    getattr(cam, setter)(value)
+                    action = 'set'
+                else:
+                    getattr(cam, f"{'enable' if value else 'disable'}_{setter}")()
+                    action = 'set'
+            except Exception as e:
+                action = 'error'
+                if logger is not None:
+                    logger.info(f'Could not set {name} to {value}: {e}')
+        applied.append(setting_applied(name, value, previous, action, time.perf_counter() - t_param))
+    if logger is not None:
+        n_set = sum(a.action == 'set' for a in applied)
+        slowest = ', '.join(f'{a.name} {a.seconds*1e3:.1f} ms' for a in sorted(applied, key=lambda a: -a.seconds)[:3])
+        logger.info(f'Applied {n_set} of {len(applied)} camera settings from {os.path.basename(config_file)} '
+                    f'in {(time.perf_counter() - t_start)*1e3:.1f} ms (slowest: {slowest})')
+        missing = [a.name for a in applied if a.action == 'missing']
+        if missing:
+            logger.info(f"Camera doesn't have a setter for {', '.join(missing)}")
+    return(applied)
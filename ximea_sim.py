@@ -0,0 +1,247 @@
+'''
+Simulated ximea camera, a drop-in for the parts of ximea.xiapi this package uses.
+
+Camera produces synthetic bayer frames (see ximea_codec.synthetic_frames) at a
+configurable resolution and frame rate, with timestamp jitter, a drifting camera
+clock and randomly missed frames. Setting imgdataformat, output_bit_depth and
+output_bit_packing like on the real camera gives 16 bit or packed 10/12 bit frames
+(see ximea_packing). Like the real camera it keeps a few frames of
+acquisition buffer: a consumer that falls further behind than that loses frames,
+which shows up as gaps in nframe. Image exposes the raw buffer the same way as
+xiapi.Image (bp, width, height, padding_x, get_image_data_raw), so copy_image_into
+and decode_ximea_frame work unchanged.
+
+Set XIMEA_SIMULATE=1 to make ximea_utils (and so the plugin) open simulated cameras
+instead of real ones, or build them directly:
+    camera = ximea_sim.Camera(imshape=(1544, 2064), fps=200); image = ximea_sim.Image()
+'''
+import ctypes
+import time
+import numpy as np
+from ximea_codec import synthetic_frames
+from ximea_packing import camera_pixel_format, pack_frames, PIXEL_BITS
+
+class Xi_error(Exception):
+    pass
+
+class Image():
+    '''
+    Image handle filled in by Camera.get_image
+    '''
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.padding_x = 0
+        self.nframe = 0
+        self.tsSec = 0
+        self.tsUSec = 0
+        self.buffer = None
+        self.bp = None
+        self.bpp = 1
+
+    def get_bytes_per_pixel(self):
+        return(self.bpp)
+
+    def set_frame(self, frame, nframe, tsSec, tsUSec, shape=None):
+        '''
+        Copy a (height, width) uint8 or uint16 frame, or the bytes of a packed frame of
+        the given (height, width) shape, and its metadata into the image
+        '''
+        frame = np.ascontiguousarray(frame)
+        if self.buffer is None or len(self.buffer) != frame.nbytes:
+            self.buffer = (ctypes.c_ubyte * frame.nbytes)()
+            self.bp = ctypes.addressof(self.buffer)
+        self.height, self.width = frame.shape if shape is None else shape
+        self.bpp = max(1, frame.nbytes // (self.height * self.width))
+        ctypes.memmove(self.bp, frame.ctypes.data, frame.nbytes)
+        self.nframe = int(nframe)
+        self.tsSec = int(tsSec)
+        self.tsUSec = int(tsUSec)
+
+    def get_image_data_raw(self):
+        return(ctypes.string_at(self.bp, len(self.buffer)))
+
+    def get_image_data_numpy(self):
+        return(np.frombuffer(self.buffer, dtype=np.uint8).reshape((self.height, self.width)).copy())
+
+class Camera():
+    '''
+    Simulated camera.
+    Params:
+        imshape (tuple): (height, width) of the bayer frames
+        fps (float): frame rate
+        jitter (float): standard deviation of the frame interval, in frame periods
+        drift_ppm (float): how much faster the camera clock runs than the host clock
+        miss_rate (float): probability that the sensor skips a frame (nframe gap)
+        buffer_frames (int): frames the camera holds for a slow consumer before dropping
+        n_patterns (int): distinct synthetic frames cycled through
+        seed (int): random seed
+    '''
+    def __init__(self, dev_id=0, imshape=(1544, 2064), fps=200, jitter=0.0, drift_ppm=0.0,
+                 miss_rate=0.0, buffer_frames=4, n_patterns=4, seed=0):
+        self.dev_id = dev_id
+        self.imshape = tuple(imshape)
+        self.fps = fps
+        self.jitter = jitter
+        self.drift_ppm = drift_ppm
+        self.miss_rate = miss_rate
+        self.buffer_frames = buffer_frames
+        self.n_patterns = n_patterns
+        self.rng = np.random.default_rng(seed)
+        self.serial = f'SIM{dev_id:05d}'
+        self.params = {}
+        self.frames = None
+        self.acquiring = False
+        self.t_open = time.monotonic()
+        self.nframe = 0
+        self.next_frame = 0.0
+
+    #device
+    def open_device(self):
+        self.t_open = time.monotonic()
+
+    def open_device_by_SN(self, serial):
+        self.serial = serial
+        self.open_device()
+
+    def close_device(self):
+        self.acquiring = False
+
+    def get_device_sn(self):
+        return(self.serial.encode())
+
+    def get_device_name(self):
+        return(b'Simulated xiC')
+
+    #settings (apply_cam_settings looks for set_<name> methods, and get_<name> to skip unchanged ones)
+    def set_framerate(self, fps):
+        self.fps = fps
+
+    def get_framerate(self):
+        return(self.fps)
+
+    def get_width(self):
+        return(self.imshape[1])
+
+    def get_height(self):
+        return(self.imshape[0])
+
+    def set_width(self, width):
+        self.imshape = (self.imshape[0], width)
+        self.frames = None
+
+    def set_height(self, height):
+        self.imshape = (height, self.imshape[1])
+        self.frames = None
+
+    def set_exposure(self, exposure):
+        self.params['exposure'] = exposure
+
+    def get_exposure(self):
+        return(self.params.get('exposure'))
+
+    def set_gain(self, gain):
+        self.params['gain'] = gain
+
+    def get_gain(self):
+        return(self.params.get('gain'))
+
+    def set_imgdataformat(self, fmt):
+        self.params['imgdataformat'] = fmt
+        self.frames = None
+
+    def get_imgdataformat(self):
+        return(self.params.get('imgdataformat'))
+
+    def set_output_bit_depth(self, depth):
+        self.params['output_bit_depth'] = depth
+        self.frames = None
+
+    def get_output_bit_depth(self):
+        return(self.params.get('output_bit_depth', 'XI_BPP_8'))
+
+    def enable_output_bit_packing(self):
+        self.params['output_bit_packing'] = True
+        self.frames = None
+
+    def disable_output_bit_packing(self):
+        self.params['output_bit_packing'] = False
+        self.frames = None
+
+    def is_output_bit_packing(self):
+        return(self.params.get('output_bit_packing', False))
+
+    def set_output_bit_packing_type(self, packing):
+        self.params['output_bit_packing_type'] = packing
+
+    def get_output_bit_packing_type(self):
+        return(self.params.get('output_bit_packing_type', 'XI_DATA_PACK_PFNC_LSB_PACKING'))
+
+    def set_acq_timing_mode(self, mode):
+        self.params['acq_timing_mode'] = mode
+
+    def get_acq_timing_mode(self):
+        return(self.params.get('acq_timing_mode'))
+
+    def set_param(self, name, value):
+        self.params[name] = value
+
+    def get_param(self, name):
+        if(name == 'timestamp'):
+            return(int(self._camera_time(time.monotonic()) * 1e9))
+        return(self.params.get(name))
+
+    #acquisition
+    def _camera_time(self, t_host):
+        return((t_host - self.t_open) * (1 + self.drift_ppm * 1e-6))
+
+    def start_acquisition(self):
+        if self.frames is None:
+            self.pixel_format = camera_pixel_format(self)
+            self.frames = synthetic_frames(self.n_patterns, self.imshape)
+            bits = PIXEL_BITS[self.pixel_format]
+            if(bits > 8):
+                #fill the extra low bits with noise
+                self.frames = [pack_frames((f.astype(np.uint16) << (bits - 8)) | self.rng.integers(0, 1 << (bits - 8), f.shape, dtype=np.uint16),
+                                           self.pixel_format) for f in self.frames]
+        self.acquiring = True
+        self.next_frame = time.monotonic() + 1.0 / self.fps
+
+    def stop_acquisition(self):
+        self.acquiring = False
+
+    def get_image(self, image, timeout=5000):
+        '''
+        Wait for the next frame and copy it into image
+        '''
+        if not self.acquiring:
+            raise Xi_error('ERROR 10: Acquisition is not started')
+        period = 1.0 / self.fps
+        now = time.monotonic()
+        #frames that came in while nobody was reading and didn't fit in the buffer are lost
+        behind = int((now - self.next_frame) / period) - self.buffer_frames
+        if behind > 0:
+            self.nframe += behind
+            self.next_frame += behind * period
+        if self.next_frame - now > timeout / 1000:
+            raise Xi_error('ERROR 10: Timeout')
+        if self.next_frame > now:
+            time.sleep(self.next_frame - now)
+        t_frame = self.next_frame
+        interval = period * (1 + self.jitter * self.rng.standard_normal()) if self.jitter else period
+        self.next_frame += max(interval, 0.0)
+        if self.miss_rate and self.rng.random() < self.miss_rate:
+            self.nframe += 1
+        t_cam = self._camera_time(t_frame)
+        image.set_frame(self.frames[self.nframe % len(self.frames)], self.nframe, int(t_cam), (t_cam % 1) * 1e6, self.imshape)
+        self.nframe += 1
+
+class SimulatedPool():
+    '''
+    Stand in for pupil's g_pool: just the clock
+    '''
+    def __init__(self):
+        self.t0 = time.monotonic()
+
+    def get_timestamp(self):
+        return(time.monotonic() - self.t0)
@@ -0,0 +1,173 @@
+'''
+Striping of a camera's chunks over several disks.
+
+The save loop deals whole chunks out to a StripeSet of target directories (one per
+drive), each served by its own StripeWriter thread, so the drives write in
+parallel and the aggregate bandwidth grows with the number of drives. Chunks go
+round robin, or by measured bandwidth (idle drives take turns, and once every
+drive is busy the one expected to finish its queued chunks first gets the next). Frames stay in their ring slot until the writer
+thread has written them. Where each chunk went is recorded in the manifest (see
+ximea_manifest), which the reader follows.
+'''
+import threading
+import queue as queue
+import time
+from ximea_container import open_chunk_writer
+
+STRIPE_MODES = ('round_robin', 'bandwidth')
+
+class StripeWriter(threading.Thread):
+    '''
+    Writer thread of one target directory: opens, fills and closes the chunks it is
+    handed, releasing every frame's ring slot once written.
+    Params:
+        target (str): directory the chunks go to
+        ring (FrameRing, SharedFrameRing or CompressedQueue): where the frames come from
+        open_kwargs (dict): chunk_format, meta, backend, codec, frame_size and syncer
+            for open_chunk_writer
+        report (callable): called with (first frame index, chunk size, frames, write seconds)
+            after every chunk that was closed cleanly, the frames of other chunks are lost
+        logger (instace of class logger): used to pass messages to gui
+        log (callable): called with (frame index, frame) once a frame is written, ie
+            to add it to the timestamp log only when it is on disk
+    '''
+    def __init__(self, target, ring, open_kwargs, report, logger, log=None):
+        super().__init__(daemon=True, name=f'stripe_writer_{target}')
+        self.target = target
+        self.ring = ring
+        self.open_kwargs = open_kwargs
+        self.report = report
+        self.logger = logger
+        self.log = log
+        self.items = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.bandwidth = 0.0
+        self.bytes_written = 0
+
+    def open_chunk(self, file_name, first_index, capacity):
+        with self.lock:
+            self.pending += 1
+        self.items.put(('open', file_name, first_index, capacity))
+
+    def put(self, slot, image):
+        self.items.put(('frame', slot, image))
+
+    def close_chunk(self):
+        self.items.put(('close',))
+
+    def stop(self):
+        '''
+        Finish the queued chunks and exit
+        '''
+        self.items.put(None)
+        self.join()
+
+    def run(self):
+        chunk = None
+        while True:
+            item = self.items.get()
+            if item is None:
+                break
+            if(item[0] == 'frame'):
+                _, slot, image = item
+                try:
+                    if chunk is not None:
+                        t_write = time.perf_counter()
+                        chunk.append(image.raw_data, image.nframe, image.tsSec, image.tsUSec)
+                        write_seconds += time.perf_counter() - t_write
+                        if self.log is not None:
+                            self.log(chunk_start + n_frames, image)
+                        n_frames += 1
+                except Exception as e:
+                    #keep releasing the frames of this chunk so the ring doesn't stall
+                    self.logger.info(f'Write to {self.target} failed, dropping the rest of the chunk: {e}')
+                    try:
+                        chunk.close()
+                    except Exception:
+                        pass
+                    chunk = None
+                finally:
+                    self.ring.release(slot)
+            elif(item[0] == 'open'):
+                _, file_name, first_index, capacity = item
+                chunk_start = first_index
+                n_frames = 0
+                t_write = time.perf_counter()
+                try:
+                    chunk = open_chunk_writer(file_name, first_index, capacity=capacity, **self.open_kwargs)
+                except Exception as e:
+                    self.logger.info(f'Could not open chunk {file_name}: {e}')
+                    chunk = None
+                write_seconds = time.perf_counter() - t_write
+            elif(item[0] == 'close'):
+                try:
+                    if chunk is not None:
+                        t_write = time.perf_counter()
+                        chunk.close()
+                        write_seconds += time.perf_counter() - t_write
+                        if write_seconds > 0:
+                            bandwidth = chunk.size / write_seconds
+                            self.bandwidth = bandwidth if not self.bandwidth else 0.7 * self.bandwidth + 0.3 * bandwidth
+                        self.bytes_written += chunk.size
+                        self.report(chunk_start, chunk.size, n_frames, write_seconds)
+                except Exception as e:
+                    #ie ENOSPC on the final sync or truncate, the thread has to live on for the next chunks
+                    self.logger.info(f'Could not close chunk in {self.target}: {e}')
+                finally:
+                    chunk = None
+                    with self.lock:
+                        self.pending -= 1
+
+class StripeSet():
+    '''
+    One StripeWriter per target directory, and the choice of where the next chunk goes.
+    Params:
+        targets (list of str): directories to stripe over (ie one per drive)
+        ring (FrameRing, SharedFrameRing or CompressedQueue): where the frames come from
+        open_kwargs (dict): chunk_format, meta, backend, codec, frame_size and syncer
+            for open_chunk_writer
+        mode (str): 'round_robin' or 'bandwidth'
+        report (callable): called with (first frame index, chunk size, frames, write seconds)
+            after every chunk that was closed cleanly, the frames of other chunks are lost
+        logger (instace of class logger): used to pass messages to gui
+        log (callable): called with (frame index, frame) once a frame is written (from
+            the writer threads, concurrently)
+    '''
+    def __init__(self, targets, ring, open_kwargs, mode='round_robin', report=None, logger=None, log=None):
+        if mode not in STRIPE_MODES:
+            raise ValueError(f'Unknown stripe mode {mode}, use one of {STRIPE_MODES}')
+        self.targets = list(targets)
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.report = report
+        self.writers = [StripeWriter(t, ring, open_kwargs, self._report, logger, log) for t in self.targets]
+        for writer in self.writers:
+            writer.start()
+        self.n_chunks = 0
+
+    def _report(self, first_index, nbytes, n_frames, write_seconds):
+        #writer threads report concurrently, the health counters expect one writer
+        if self.report is not None:
+            with self.lock:
+                self.report(first_index, nbytes, n_frames, write_seconds)
+
+    def pick(self):
+        '''
+        Index of the target the next chunk goes to
+        '''
+        n = len(self.writers)
+        k = self.n_chunks % n
+        if(self.mode == 'bandwidth'):
+            #idle (or not yet measured) targets take turns, so every bandwidth estimate stays current
+            idle = [w for w in range(n) if not self.writers[w].pending or not self.writers[w].bandwidth]
+            if idle:
+                k = min(idle, key=lambda w: (self.writers[w].pending, (w - k) % n))
+            else:
+                k = min(range(n), key=lambda w: (self.writers[w].pending + 1) / self.writers[w].bandwidth)
+        self.n_chunks += 1
+        return(k)
+
+    def close(self):
+        for writer in self.writers:
+            writer.stop()
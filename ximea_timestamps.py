@@ -0,0 +1,98 @@
+'''
+Binary per frame timestamp log of a ximea recording.
+
+timestamps_{cam_name}.tslog is a headerless array of TIMESTAMP_DTYPE records, one per
+saved frame: recording index i, camera frame number, camera time (seconds and
+microseconds) and the host (pupil) time the frame was received. Records are in
+recording order, except in a striped recording, where each chunk's frames are
+logged as its writer gets them to disk. Records are buffered
+and written in batches, so the save loop does no string formatting per frame, and
+the whole log loads with a single np.fromfile (or np.memmap) call.
+
+The original timestamps_{cam_name}.tsv can be written from a log for tools that
+expect it: python ximea_timestamps.py <rec_path>/ximea --cam_name ximea
+'''
+import os as os
+import numpy as np
+
+TIMESTAMP_DTYPE = np.dtype([('i', '<u8'),
+                            ('nframe', '<u8'),
+                            ('tsSec', '<u4'),
+                            ('tsUSec', '<u4'),
+                            ('host_time', '<f8')])
+
+def timestamp_log_name(save_folder, cam_name):
+    return(os.path.join(save_folder, f'timestamps_{cam_name}.tslog'))
+
+class TimestampLog():
+    '''
+    Append only writer of a binary timestamp log.
+    Params:
+        file_name (str): log file to create (truncated if it exists)
+        batch_size (int): records buffered before they are written out
+    '''
+    def __init__(self, file_name, batch_size=1024):
+        self.file_name = file_name
+        self.file = open(file_name, 'wb')
+        self.buffer = np.zeros(batch_size, dtype=TIMESTAMP_DTYPE)
+        self.fill = 0
+        self.n_records = 0
+
+    def append(self, i, nframe, tsSec, tsUSec, host_time=0.0):
+        self.buffer[self.fill] = (i, nframe, tsSec, tsUSec, host_time)
+        self.fill += 1
+        if self.fill == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered records out (also call to make them visible to readers)
+        '''
+        if self.fill:
+            self.file.write(self.buffer[:self.fill].tobytes())
+            self.n_records += self.fill
+            self.fill = 0
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+def read_timestamp_log(file_name, mmap=False):
+    '''
+    Load a binary timestamp log (a partially written last record is ignored)
+    Params:
+        file_name (str): timestamps_{cam_name}.tslog
+        mmap (bool): memory map the log instead of reading it
+    Returns:
+        ts (np.ndarray): structured array of TIMESTAMP_DTYPE
+    '''
+    n = os.path.getsize(file_name) // TIMESTAMP_DTYPE.itemsize
+    if(mmap and n):
+        return(np.memmap(file_name, dtype=TIMESTAMP_DTYPE, mode='r', shape=(n,)))
+    return(np.fromfile(file_name, dtype=TIMESTAMP_DTYPE, count=n))
+
+def export_timestamp_tsv(log_file_name, tsv_file_name):
+    '''
+    Write a binary log out as the original timestamps tsv (i, frame, camtime as sec.usec)
+    Returns:
+        n (int): number of rows written
+    '''
+    ts = read_timestamp_log(log_file_name)
+    #striped chunks are logged as their writers finish them
+    ts = ts[np.argsort(ts['i'], kind='stable')]
+    columns = np.column_stack([ts['i'], ts['nframe'], ts['tsSec'], ts['tsUSec']]).astype(np.int64)
+    np.savetxt(tsv_file_name, columns, fmt='%d\t%d\t%d.%06d', header='i\tframe\tcamtime', comments='')
+    return(len(ts))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Write the timestamps tsv of a ximea recording from its binary log')
+    parser.add_argument('save_folder', help='recording folder holding the timestamp log')
+    parser.add_argument('--cam_name', default='ximea')
+    args = parser.parse_args()
+    n = export_timestamp_tsv(timestamp_log_name(args.save_folder, args.cam_name),
+                             os.path.join(args.save_folder, f'timestamps_{args.cam_name}.tsv'))
+    print(f'Wrote {n} timestamps')
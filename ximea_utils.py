@@ -1,25 +1,45 @@
 import copy
 import threading
+import multiprocessing as mp
 import queue as queue
 import time
 import os as os
 import numpy as np
-from ximea import xiapi
-from collections import namedtuple
-import yaml
+if os.environ.get('XIMEA_SIMULATE'):
+    #simulated cameras for testing without hardware, see ximea_sim
+    import ximea_sim as xiapi
+else:
+    try:
+        from ximea import xiapi
+    except ImportError:
+        #no ximea SDK, init_camera will fail (set XIMEA_SIMULATE=1 to simulate)
+        xiapi = None
+import ximea_sim
+import ximea_replay
 import mmap
 import copy
 import sys
 import gc
 import signal
-import gc
 import ctypes
 import stat
-import cv2
 import struct
 import base64
-
-frame_data = namedtuple("frame_data", "raw_data nframe tsSec tsUSec")
+from ximea_ringbuffer import FrameRing, SharedFrameRing, frame_data, EndOfStream
+from ximea_decode import demosaic_frame
+from ximea_packing import camera_pixel_format, image_data, frame_bytes
+from ximea_preview import PreviewTap
+from ximea_proxy import ProxyWriter
+from ximea_codec import FrameCompressor, CompressedQueue
+from ximea_container import chunk_meta, chunk_file_name, open_chunk_writer, settings_hash, frame_size_of
+from ximea_clock import sample_clocks, ClockSampler
+from ximea_health import PipelineHealth, write_health_summary
+from ximea_manifest import ChunkManifest, manifest_file_name
+from ximea_stripes import StripeSet
+from ximea_writers import ChunkSyncer, ChunkSizer
+from ximea_settings import apply_settings
+from ximea_realtime import hold_gc, release_gc, plan_cores, make_realtime
+from ximea_timestamps import TimestampLog, timestamp_log_name, export_timestamp_tsv
 
 def write_sync_queue(sync_queue, cam_name, save_folder):
     '''
@@ -64,50 +84,45 @@ def get_sync_string(cam_name, cam_handle, save_dir, g_pool):
     Returns:
         sync_string (str): string to write to file with cam name, time, and wall time
     '''
-    t_wall_1 = time.time()
-    t_sync_1 = g_pool.get_timestamp()
-    t_cam = cam_handle.get_param('timestamp')
-    t_cam = t_cam/(1e9) #this is returned in nanoseconds, change to seconds
-    t_sync_2 = g_pool.get_timestamp()
-    t_wall_2 = time.time()
-    t_sync = np.mean((t_sync_1, t_sync_2)) #take middle of two wall times
-    t_wall = np.mean((t_wall_1, t_wall_2)) #take middle of two wall times
+    t_cam, t_sync, t_wall, _ = sample_clocks(cam_handle, g_pool)
     sync_string = f'{cam_name}\t{t_sync}\t{t_cam}\t{t_wall}\n'
     return(sync_string)
 
-def apply_cam_settings(cam, config_file):
+def apply_cam_settings(cam, config_file, logger=None, force=False):
     """
-    Apply settings to the camera from a config file.
+    Apply settings to the camera from a config file, only the ones that differ from
+    the camera's current values (see ximea_settings).
 
     Params:
         camera (XimeaCamera instance): camera handle
         config_file (str): string filename of the config file for the camera
+        force (bool): set every parameter, even ones the camera already has
+    Returns:
+        applied (list of ximea_settings.setting_applied): what was done per parameter, and how long it took
     """
-    with open(config_file, 'r') as f:
-        cam_props = yaml.safe_load(f)
-
-    for prop, value in cam_props.items():
-        #print(prop, value)
-        if f"set_{prop}" in dir(cam):
-            try:
-                cam.__getattribute__(f"set_{prop}")(value)
-            except Exception as e:
-                print(e)
-        elif prop in dir(cam) and "is_" in prop:
-            en_dis = "enable_" if value else "disable_"
-            try:
-                cam.__getattribute__(f"{en_dis}{prop.replace('is_', '')}")()
-            except Exception as e:
-                print(e)
+    return(apply_settings(cam, config_file, logger, force))
 
-        else:
-            print(f"Camera doesn't have a set_{prop}")
+def reapply_cam_settings(camera, settings_file, logger):
+    """
+    Apply a (changed) settings file to an already open camera, without reopening it
+    Returns:
+        ok (bool): camera is acquiring with the new settings
+    """
+    try:
+        camera.stop_acquisition()
+        apply_cam_settings(camera, settings_file, logger)
+        camera.start_acquisition()
+        return(True)
+    except Exception as e:
+        logger.info(f'Problem applying settings to camera: {e}')
+        return(False)
 
 def init_camera(cam_id, settings_file, logger):
     '''
     Initialize a ximea camera for use (recoring and preview) by external scripts
     Params:
-        cam_id (str): Serial number of camera to opening
+        cam_id (str): Serial number of camera to opening, or replay:<rec_path>/ximea/<cam_name>
+            to replay a recorded camera instead (see ximea_replay)
         setttings_file (str): Path to settings file for camera
         logger (instace of class logger): used to pass messages to gui
     Returns:
@@ -115,82 +130,309 @@ def init_camera(cam_id, settings_file, logger):
         iamge_handle (Ximea Camera image): handle to point to images from camera
         open_success (bool): Were we able to open the camera?
     '''
+    camera = None
     try:
         logger.info(f'Opening Ximea Camera {cam_id}')
-        camera = xiapi.Camera()
-        camera.open_device_by_SN(cam_id)
+        if cam_id.startswith(ximea_replay.REPLAY_PREFIX):
+            camera = ximea_replay.ReplayCamera.from_serial(cam_id)
+            image_class = ximea_sim.Image
+        else:
+            camera = xiapi.Camera()
+            camera.open_device_by_SN(cam_id)
+            image_class = xiapi.Image
         logger.info('Sucessfully Opened Camera')
-        apply_cam_settings(camera, settings_file)
+        apply_cam_settings(camera, settings_file, logger)
         logger.info('Sucessfully Applied Settings to Camera')
         camera.start_acquisition()
-        image = xiapi.Image()
+        image = image_class()
         logger.info('Sucessfully Started Aquisition')
         return(camera, image, True)
-    except:
-        logger.info('Problem initializing camera.')
-        camera.stop_acquisition()
-        camera.close_device()
+    except Exception as e:
+        logger.info(f'Problem initializing camera: {e}')
+        if camera is not None:
+            #the camera may not have got as far as opening, its handle can be invalid
+            for cleanup in (camera.stop_acquisition, camera.close_device):
+                try:
+                    cleanup()
+                except Exception:
+                    pass
         return(None, None, False)
 
-def decode_ximea_frame(camera, image_handle, imshape, logger, norm=True):
+def decode_ximea_frame(camera, image_handle, imshape, logger, norm=True, pixel_format='uint8'):
     '''
     Get a single frame from ximea cameras
     '''
     camera.get_image(image_handle)
-    im = image_handle.get_image_data_raw()
-    im = np.frombuffer(im,dtype='uint8') #.byteswap()
-    im = im.reshape(imshape)
-    im = cv2.cvtColor(im, cv2.COLOR_BayerRG2BGR)
-    im = cv2.flip(im, -1)
-    if(norm):
-        im = cv2.normalize(im, None, 0, 255, cv2.NORM_MINMAX)
-    return(im)
-
-def save_queue_worker(cam_name, save_queue_out, save_folder, ims_per_file, stop_collecting_event, currently_saving, logger):
+    im = image_data(image_handle, frame_bytes(imshape[0], imshape[1], pixel_format))
+    return(demosaic_frame(im, imshape, norm, pixel_format=pixel_format))
+
+def make_chunk_meta(camera, imshape, settings_file, bayer='RG'):
+    '''
+    Describe the frames a camera produces, for the header of indexed chunk files
+    Params:
+        camera (XimeaCamera instance): camera handle, used for the serial number and
+            the pixel format (8 bit, or 10/12 bit packed, see ximea_packing)
+        imshape (tuple): (height, width) of the raw frames
+        settings_file (str): yaml settings applied to the camera
+        bayer (str): bayer pattern as used by decode_ximea_frame (cv2.COLOR_Bayer<bayer>2BGR)
+    Returns:
+        meta (ximea_container.chunk_meta)
+    '''
+    try:
+        serial = camera.get_device_sn()
+        serial = serial.decode() if isinstance(serial, bytes) else serial
+    except Exception:
+        serial = ''
     try:
-        if not os.path.exists(os.path.join(save_folder, cam_name)):
-            os.makedirs(os.path.join(save_folder, cam_name))
-            #os.chmod(save_folder, stat.S_IRWXO)
-        ts_file_name = os.path.join(save_folder, f"timestamps_{cam_name}.tsv")
-        #make a new blank timestamp file
-        with open(ts_file_name, 'w') as ts_file:
-            ts_file.write(f"i\tframe\tcamtime\n")
-        #open it for appending
-        ts_file = open(ts_file_name, 'a+')
-        i = 0
+        settings = settings_hash(settings_file)
+    except OSError:
+        settings = ''
+    return(chunk_meta(imshape[0], imshape[1], camera_pixel_format(camera), bayer, serial, settings))
+
+def camera_frame_size(camera, imshape):
+    '''
+    Size in bytes of one raw frame of a camera in its current pixel format
+    '''
+    return(frame_bytes(imshape[0], imshape[1], camera_pixel_format(camera)))
+
+def raw_frame_size(image_handle):
+    '''
+    Size in bytes of the raw buffer behind a ximea image (same as get_image_data_raw)
+    '''
+    bpp = image_handle.get_bytes_per_pixel()
+    return(image_handle.width*image_handle.height*bpp + image_handle.padding_x*image_handle.height)
+
+def copy_image_into(image_handle, dest, nbytes=None):
+    '''
+    Copy the raw data of a ximea image straight into a preallocated uint8 buffer,
+    without going through the intermediate bytes object of get_image_data_raw.
+    Params:
+        image_handle (Ximea Image): image filled by camera.get_image
+        dest (np.ndarray): contiguous uint8 buffer (ie a FrameRing slot)
+        nbytes (int): size of the frame, default from the image's bytes per pixel
+            (give it for packed frames, see ximea_packing.frame_bytes)
+    Returns:
+        nbytes (int): number of bytes copied
+    '''
+    if not hasattr(image_handle, 'bp'):
+        data = np.frombuffer(image_handle.get_image_data_raw(), dtype=np.uint8)
+        dest[:data.size] = data
+        return(data.size)
+    if nbytes is None:
+        nbytes = raw_frame_size(image_handle)
+    if nbytes > dest.size:
+        raise ValueError(f'Frame of {nbytes} bytes does not fit in {dest.size} byte slot')
+    ctypes.memmove(dest.ctypes.data, image_handle.bp, nbytes)
+    return(nbytes)
+
+def save_queue_worker(cam_name, save_queue_out, save_folder, ims_per_file, stop_collecting_event, currently_saving, logger, write_backend='buffered', chunk_format='raw', chunk_meta=None, compression=None, compress_workers=4, disk_budget=None, timestamp_tsv=False, health=None, stripe_dirs=None, stripe_mode='round_robin', preallocate=True, sync_policy='chunk', sync_interval=5.0, adaptive_chunks=False, min_ims_per_file=50, max_ims_per_file=2000, chunk_probe_seconds=3.0, preroll_frames=0, cpu_cores=None, nice=None, drain_timeout=5.0):
+    '''
+    Write frames from the ring to chunk files of ims_per_file frames each (or of an
+    adaptively chosen size), plus the binary timestamp log (see ximea_timestamps).
+    Saving ends at the ring's end of stream (see FrameRing.end_stream): everything the
+    acquisition committed before it is written, the last chunk is closed partially
+    filled, and the frame count is checked against the acquisition's.
+    Params:
+        write_backend (str): 'buffered' or 'direct' (O_DIRECT from page aligned buffers,
+            falls back to buffered if the filesystem refuses it, see ximea_writers)
+        chunk_format (str): 'raw' headerless .bin chunks or 'indexed' self describing
+            .xchunk files with a header and per frame index (see ximea_container)
+        chunk_meta (ximea_container.chunk_meta): frame/camera description for indexed chunks
+        compression (str): None to store raw frames, or a lossless ximea_codec codec
+            (ie 'bp-zstd') to compress frames on a pool of compress_workers threads
+            before writing them (needs indexed chunks)
+        disk_budget (ximea_writers.DiskBudget): budget shared with the other cameras, checked every chunk
+        timestamp_tsv (bool): also write the timestamp log out as timestamps_{cam_name}.tsv when done
+        health (ximea_health.PipelineHealth): counters to report written chunks to
+        stripe_dirs (list of str): more directories (ie on other drives) to spread the
+            chunks over, each written by its own thread (see ximea_stripes). Where every
+            chunk went is listed in save_folder/manifest_{cam_name}.yaml
+        stripe_mode (str): 'round_robin' or 'bandwidth' (more chunks to faster drives)
+        preallocate (bool): fallocate every chunk at its full size when it is opened
+        sync_policy (str): when chunks are fdatasync'ed: 'chunk' (as each is closed),
+            'interval' (every sync_interval seconds) or 'stop' (once, when done), see
+            ximea_writers.ChunkSyncer
+        adaptive_chunks (bool): probe the disk for chunk_probe_seconds and choose the
+            chunk size within [min_ims_per_file, max_ims_per_file] instead of using
+            ims_per_file (see ximea_writers.ChunkSizer). Each chunk's size is in the manifest
+        preroll_frames (int): frames at the head of the ring from before the recording
+            started (see ximea_preroll), noted in the manifest
+        cpu_cores (list of int), nice (int): run this saver (and the threads it starts)
+            on these cores at this nice value, see ximea_realtime
+        drain_timeout (float): once stop_collecting_event is set (the acquisition has
+            ended), give up waiting for the ring's end of stream after this many idle seconds
+    '''
+    ts_log = None
+    manifest = None
+    stripes = None
+    syncer = None
+    try:
+        if cpu_cores or nice is not None:
+            make_realtime(cpu_cores, nice, logger, f'{cam_name} saver')
+        syncer = ChunkSyncer(sync_policy, sync_interval)
+        sizer = ChunkSizer(ims_per_file, adaptive_chunks, min_ims_per_file, max_ims_per_file,
+                           chunk_probe_seconds, logger=logger)
+        frame_size = save_queue_out.frame_size if preallocate else 0
+        codec = 'raw'
+        if compression and chunk_meta is not None and chunk_meta.dtype != 'uint8':
+            logger.info(f'Compression is for 8 bit frames, saving {chunk_meta.dtype} frames of {cam_name} uncompressed')
+            compression = None
+        if compression:
+            codec = compression
+            save_queue_out = CompressedQueue(save_queue_out,
+                                             FrameCompressor((chunk_meta.height, chunk_meta.width), compression, compress_workers))
+        targets = [save_folder] + list(stripe_dirs or [])
+        for target in targets:
+            if not os.path.exists(os.path.join(target, cam_name)):
+                os.makedirs(os.path.join(target, cam_name))
+                #os.chmod(save_folder, stat.S_IRWXO)
+        def report_chunk(nbytes, n_frames, write_seconds):
+            sizer.chunk_done(n_frames, write_seconds)
+            if disk_budget is not None:
+                disk_budget.add(nbytes)
+            if health is not None:
+                health.chunk_written(nbytes, n_frames, write_seconds)
+        manifest = ChunkManifest(manifest_file_name(save_folder, cam_name), cam_name, targets, chunk_format,
+                                 {'preroll_frames': int(preroll_frames),
+                                  'pixel_format': chunk_meta.dtype if chunk_meta is not None else 'uint8'})
+        n_saved = 0
+        def report_stripe_chunk(first_index, nbytes, n_frames, write_seconds):
+            #striped frames count as saved once their writer has closed the chunk
+            nonlocal n_saved
+            n_saved += n_frames
+            if health is not None:
+                health['frames_drained'] = n_saved
+            manifest.closed(first_index, n_frames)
+            with ts_lock:
+                ts_log.flush()
+            report_chunk(nbytes, n_frames, write_seconds)
+        ts_log = TimestampLog(timestamp_log_name(save_folder, cam_name), batch_size=ims_per_file)
+        ts_lock = threading.Lock()
+        def log_stripe_frame(i, image):
+            #from the stripe writers once the frame is written, so the log never gets ahead
+            #of the data (striped chunks finish out of order, readers sort the log by i)
+            with ts_lock:
+                ts_log.append(i, image.nframe, image.tsSec, image.tsUSec, image.host_time)
+        if len(targets) > 1:
+            stripes = StripeSet(targets, save_queue_out,
+                                dict(chunk_format=chunk_format, meta=chunk_meta, backend=write_backend, codec=codec,
+                                     frame_size=frame_size, syncer=syncer),
+                                stripe_mode, report_stripe_chunk, logger, log_stripe_frame)
+
+        def next_frame():
+            '''
+            Next frame off the ring. Waits as long as the acquisition runs, and once it
+            has stopped for at most drain_timeout seconds for the end of stream marker.
+            '''
+            nonlocal n_taken
+            t_idle = None
+            while True:
+                try:
+                    frame = save_queue_out.get(True, 0.5)
+                    n_taken += 1
+                    return(frame)
+                except queue.Empty:
+                    if not stop_collecting_event.is_set():
+                        continue
+                    t_idle = t_idle or time.monotonic()
+                    if time.monotonic() - t_idle > drain_timeout:
+                        logger.info(f'{cam_name}: no end of stream from the acquisition in {drain_timeout:.0f} s, stopping')
+                        raise EndOfStream(None)
+
+        fstart = 0
+        n_taken = 0
         logger.info('Started Saving...')
         currently_saving.set()
-        if(ims_per_file == 1):
-            while (not stop_collecting_event.is_set())  or save_queue_out.empty():
-                bin_file_name = os.path.join(save_folder, cam_name, f'frame_{i}.bin')
-                f = os.open(bin_file_name, os.O_WRONLY | os.O_CREAT , 0o777 | os.O_TRUNC | os.O_SYNC | os.O_DIRECT)
-                image = save_queue_out.get(True, 1)
-                os.write(f, image.raw_data)
-                ts_file.write(f"{i}\t{image.nframe}\t{image.tsSec}.{str(image.tsUSec).zfill(6)}\n")
-                i+=1
-        else:
-            while (not stop_collecting_event.is_set())  or save_queue_out.empty():
-                fstart=i*ims_per_file
-                bin_file_name = os.path.join(save_folder, cam_name, f'frames_{fstart}_{fstart+ims_per_file-1}.bin')
-                f = os.open(bin_file_name, os.O_WRONLY | os.O_CREAT , 0o777 | os.O_TRUNC | os.O_SYNC | os.O_DIRECT)
-                #f = os.open(bin_file_name, os.O_WRONLY | os.O_CREAT)
-                for j in range(ims_per_file):
-                    image = save_queue_out.get(True, 1)
-                    os.write(f, image.raw_data)
-                    ts_file.write(f"{fstart+j}\t{image.nframe}\t{image.tsSec}.{str(image.tsUSec).zfill(6)}\n")
-                os.close(f)
-                i+=1
-
-        logger.info(f"Finished Saving Frames from {cam_name}")
+        try:
+            while True:
+                #wait for a frame before opening a chunk, so the stream doesn't end in an empty one
+                slot, image = next_frame()
+                if disk_budget is not None and not disk_budget.exhausted() and any(disk_budget.check(t) for t in targets):
+                    logger.info(f'Disk budget used up, stopping recording from {cam_name}')
+                n_chunk = sizer.next_size()
+                chunk_name = os.path.join(cam_name, chunk_file_name(fstart, n_chunk, chunk_format))
+                if stripes is not None:
+                    #the chunk is written by the writer thread of the target picked for it
+                    k = stripes.pick()
+                    manifest.add(fstart, n_chunk, k, chunk_name)
+                    writer = stripes.writers[k]
+                    writer.open_chunk(os.path.join(targets[k], chunk_name), fstart, n_chunk)
+                    try:
+                        for j in range(n_chunk):
+                            if j:
+                                slot, image = next_frame()
+                            writer.put(slot, image)
+                    finally:
+                        writer.close_chunk()
+                    fstart += n_chunk
+                    continue
+                manifest.add(fstart, n_chunk, 0, chunk_name)
+                bin_file_name = os.path.join(save_folder, chunk_name)
+                t_write = time.perf_counter()
+                chunk = open_chunk_writer(bin_file_name, fstart, chunk_format, chunk_meta, write_backend, n_chunk, codec,
+                                          frame_size, syncer)
+                write_seconds = time.perf_counter() - t_write
+                if(write_backend == 'direct' and not chunk.direct):
+                    logger.info(f'O_DIRECT not supported in {save_folder}, using buffered writes')
+                    write_backend = 'buffered'
+                n_frames = 0
+                try:
+                    for j in range(n_chunk):
+                        if j:
+                            slot, image = next_frame()
+                        t_write = time.perf_counter()
+                        chunk.append(image.raw_data, image.nframe, image.tsSec, image.tsUSec)
+                        write_seconds += time.perf_counter() - t_write
+                        save_queue_out.release(slot)
+                        ts_log.append(fstart+j, image.nframe, image.tsSec, image.tsUSec, image.host_time)
+                        n_frames += 1
+                        n_saved += 1
+                        if health is not None:
+                            health['frames_drained'] = n_saved
+                finally:
+                    #flushes (and for O_DIRECT pads/truncates) a partial last chunk too
+                    t_write = time.perf_counter()
+                    chunk.close()
+                    write_seconds += time.perf_counter() - t_write
+                    ts_log.flush()
+                    manifest.closed(fstart, n_frames)
+                    report_chunk(chunk.size, n_frames, write_seconds)
+                fstart += n_chunk
+        except EndOfStream as end:
+            n_expected = n_taken if end.n_frames is None else end.n_frames
+        if stripes is not None:
+            #the last chunks are written (and counted) once the stripe writers are done
+            stripes.close()
+            stripes = None
+        lost = max(n_expected - n_saved, 0)
+        if health is not None:
+            health.drained(n_saved, lost)
+        logger.info(f"Finished Saving {n_saved} of {n_expected} Frames from {cam_name}"
+                    + (f", LOST {lost}" if lost else ''))
+        if compression:
+            logger.info(f"Compressed {cam_name} frames {save_queue_out.compressor.ratio:.2f}x with {compression}")
+            save_queue_out.compressor.close()
         currently_saving.clear()
 
     except Exception as e:
-        print(f'Exception!: e')
-        print('Exiting Save Thread')
+        logger.info(f'Saving frames from {cam_name} failed: {e!r}')
         currently_saving.clear()
 
+    finally:
+        if stripes is not None:
+            stripes.close()
+        if syncer is not None:
+            syncer.finish()
+            logger.info(f'{cam_name}: {syncer.n_syncs} chunk syncs ({sync_policy}), {syncer.sync_seconds:.2f} s')
+        if manifest is not None:
+            manifest.close()
+        if ts_log is not None:
+            ts_log.close()
+            if timestamp_tsv:
+                export_timestamp_tsv(ts_log.file_name, os.path.join(save_folder, f"timestamps_{cam_name}.tsv"))
 
-def aquire_camera_worker(camera, image_handle, cam_name, sync_queue, save_queue, save_dir, stop_collecting_event, currently_recording, g_pool, logger):
+
+def aquire_camera_worker(camera, image_handle, cam_name, sync_queue, save_queue, save_dir, stop_collecting_event, currently_recording, g_pool, logger, disk_budget=None, preview_tap=None, clock_sample_hz=1.0, health=None, cpu_cores=None, nice=None, frame_nbytes=None, proxy_tap=None):
 
     """
     Acquire frames from a single camera. Can have mulitple instances of this to record from multiple cameras.
@@ -199,41 +441,363 @@ def aquire_camera_worker(camera, image_handle, cam_name, sync_queue, save_queue,
         camera (Ximea Camera) Instance of a ximea camera
         image_handle (Ximea Image) Instance of Ximea camera image
         sync_queue (Mutlithreading.Queue): A queue to sync timestamps of camera and computer
-        save_queue (Mutlithreading.Queue): A queue which accepts xiapi.Images
+        save_queue (FrameRing): Ring of preallocated slots the raw frames are copied into
         stop_collecting (threading.Event): keep collecting until this is set
+        disk_budget (ximea_writers.DiskBudget): also stop once this is exhausted
+        preview_tap (ximea_preview.PreviewTap): hand every Nth frame to the preview as well
+        clock_sample_hz (float): rate at which a ClockSampler records camera/pupil clock
+            pairs during the recording (see ximea_clock), 0 for only the pre/post sync
+        health (ximea_health.PipelineHealth): counters to report frames, gaps and queue depth to
+        cpu_cores (list of int), nice (int): run the acquisition loop on these cores at
+            this nice value, see ximea_realtime
+        frame_nbytes (int): size of a raw frame, needed for packed pixel formats (see ximea_packing)
+        proxy_tap (ximea_preview.PreviewTap): hand every Nth frame to the proxy writer (see ximea_proxy)
 
     """
 
+    clock_sampler = None
+    taps = [tap for tap in (preview_tap, proxy_tap) if tap is not None]
     try:
+        if cpu_cores or nice is not None:
+            make_realtime(cpu_cores, nice, logger, f'{cam_name} acquisition')
 
         sync_str = get_sync_string(cam_name + "_pre", camera, save_dir, g_pool)
         sync_queue.put(sync_str)
 
+        if clock_sample_hz:
+            clock_sampler = ClockSampler(camera, g_pool, cam_name, save_dir, clock_sample_hz)
+            clock_sampler.start()
+
         logger.info(f'Begin Recording..')
         currently_recording.set()
+        #frames lost because claim() found no slot, the ring counts the ones it overwrote
+        ring_full = 0
+        was_full = False
+        t_last = None
 
         while not stop_collecting_event.is_set():
+            if disk_budget is not None and disk_budget.exhausted():
+                logger.info(f'Disk budget used up, stopping {cam_name}')
+                break
             camera.get_image(image_handle)
-            data = image_handle.get_image_data_raw()
-            save_queue.put(frame_data(data,
-                                   image_handle.nframe,
-                                   image_handle.tsSec,
-                                   image_handle.tsUSec))
+            host_time = g_pool.get_timestamp()
+            t_now = time.perf_counter()
+            period = t_now - t_last if t_last is not None else 0
+            t_last = t_now
+            try:
+                slot = save_queue.claim(timeout=1)
+            except queue.Full:
+                if not was_full:
+                    #once per episode, the health line keeps count
+                    logger.info(f'Ximea frame ring of {cam_name} full, saving is falling behind')
+                was_full = True
+                ring_full += 1
+                continue
+            was_full = False
+            nbytes = copy_image_into(image_handle, save_queue.frames[slot], frame_nbytes)
+            tapped = [tap for tap in taps if tap.wants()]
+            for tap in tapped:
+                #keep the slot for the preview/proxy until it is done with it
+                save_queue.retain(slot)
+            save_queue.commit(slot, nbytes,
+                              image_handle.nframe,
+                              image_handle.tsSec,
+                              image_handle.tsUSec,
+                              host_time)
+            for tap in tapped:
+                tap.offer(slot, frame_data(save_queue.frames[slot, :nbytes],
+                                           image_handle.nframe,
+                                           image_handle.tsSec,
+                                           image_handle.tsUSec,
+                                           host_time))
+            if health is not None:
+                health.frame_acquired(image_handle.nframe, period, save_queue.occupancy, save_queue.dropped + ring_full)
 
         logger.info(f'Stopping Ximea Collection')
+        stop_clock_sampler(clock_sampler, cam_name, logger)
         sync_str = get_sync_string(cam_name + "_post", camera, save_dir, g_pool)
         sync_queue.put(sync_str)
         write_sync_queue(sync_queue, cam_name, save_dir)
 
     except Exception as e:
         logger.info(f'Detected Exception {e} Stopping Acquisition')
+        stop_clock_sampler(clock_sampler, cam_name, logger)
         sync_str = get_sync_string(cam_name + "_post", camera, save_dir, g_pool)
         sync_queue.put(sync_str)
         write_sync_queue(sync_queue, cam_name, save_dir)
 
     finally:
+        #the saver drains the ring up to here
+        n_frames = save_queue.end_stream()
+        if health is not None:
+            health.stream_closed(n_frames)
+        for tap in taps:
+            tap.close()
         currently_recording.clear()
         logger.info(f"Camera aquisition finished")
+        logger.info(f"Frame ring stats for {cam_name}: {save_queue.stats()}")
+
+def stop_clock_sampler(clock_sampler, cam_name, logger):
+    '''
+    Stop a ClockSampler (if any) and log the clock fit it ended up with
+    '''
+    if clock_sampler is None:
+        return
+    clock_fit = clock_sampler.stop()
+    offset, drift = clock_fit.fit()
+    logger.info(f'{cam_name} clock drift {(drift - 1) * 1e6:.2f} ppm over {clock_fit.n_samples} samples '
+                f'(residual {clock_fit.residual * 1e6:.1f} us)')
+
+def save_process_worker(save_jobs, gc_mode='none'):
+    '''
+    Body of a writer process: run the save_queue_worker of each camera assigned to
+    this process in its own thread (the writes release the GIL, so one process can
+    keep several cameras going).
+    Params:
+        save_jobs (list of (tuple, dict)): args and kwargs of each save_queue_worker
+        gc_mode (str): keep cyclic GC out of the way in this process, see ximea_realtime
+    '''
+    hold_gc(gc_mode)
+    save_threads = [threading.Thread(target=save_queue_worker, args=args, kwargs=kwargs) for args, kwargs in save_jobs]
+    for save_thread in save_threads:
+        save_thread.start()
+    for save_thread in save_threads:
+        save_thread.join()
+
+def watch_pipelines(acq_procs, save_procs, save_stops, save_savings, save_queues, currently_recording, currently_saving, healths=None, save_dir=None, gc_held=False, proxies=None):
+    '''
+    Babysit the acquisition and save workers of all cameras: tell each camera's saver to
+    stop once its acquisition thread has committed its last frame, keep the plugin's
+    recording/saving events set while any camera is still recording/saving, and free
+    shared memory rings once every saver has exited.
+    Params:
+        acq_procs (list of threading.Thread): aquire_camera_worker of each camera
+        save_procs (list of threading.Thread or multiprocessing.Process): writer threads/processes
+        save_stops (list of Events): stop event handed to the saver of each camera
+        save_savings (list of Events): saving event set by the saver of each camera
+        save_queues (list of FrameRing or SharedFrameRing): ring of each camera
+        currently_recording (threading.Event): plugin side recording event
+        currently_saving (threading.Event): plugin side saving event
+        healths (list of ximea_health.PipelineHealth): counters of each camera, written
+            to save_dir/ximea_health.tsv every 10 seconds and at the end
+        save_dir (str): recording folder
+        gc_held (bool): release the GC hold of the recording (ximea_realtime.hold_gc) when done
+        proxies (list of ximea_proxy.ProxyWriter): proxy writers, finished and logged before
+            the shared memory rings are freed
+    '''
+    currently_recording.set()
+    t_summary = time.time()
+    while any(p.is_alive() for p in save_procs) or any(p.is_alive() for p in acq_procs):
+        for acq_proc, save_stop in zip(acq_procs, save_stops):
+            if not acq_proc.is_alive():
+                save_stop.set()
+        if not any(p.is_alive() for p in acq_procs):
+            currently_recording.clear()
+        if any(s.is_set() for s in save_savings):
+            currently_saving.set()
+        else:
+            currently_saving.clear()
+        if healths and time.time() - t_summary > 10:
+            write_health_summary(save_dir, healths)
+            t_summary = time.time()
+        time.sleep(0.1)
+    for proxy in proxies or []:
+        #the taps are closed with the acquisition, so the writers are on their last frame
+        proxy.join(5)
+    if healths:
+        write_health_summary(save_dir, healths)
+    currently_recording.clear()
+    currently_saving.clear()
+    if gc_held:
+        release_gc()
+    for save_queue in save_queues:
+        if hasattr(save_queue, 'unlink'):
+            save_queue.unlink()
+
+def start_multi_ximea_aquisition(cameras, image_handles, cam_names,
+                                 save_dir, ims_per_file,
+                                 stop_collecting,
+                                 currently_recording,
+                                 currently_saving,
+                                 g_pool,
+                                 logger,
+                                 frame_size=1544*2064,
+                                 ring_slots=64,
+                                 ring_policy='block',
+                                 writer_mode='thread',
+                                 writer_procs=0,
+                                 disk_budget=None,
+                                 chunk_metas=None,
+                                 preview_every=0,
+                                 clock_sample_hz=1.0,
+                                 prerolls=None,
+                                 realtime=False,
+                                 realtime_cores=None,
+                                 realtime_nice=-10,
+                                 gc_mode='freeze',
+                                 proxy_every=0,
+                                 proxy_step=4,
+                                 proxy_quality=70,
+                                 **save_options):
+    '''
+    Start one acquisition pipeline per ximea camera: an acquisition thread feeding a
+    frame ring and a saver writing it to save_dir/{cam_name}/ with its own
+    timestamps_{cam_name}.tslog and timestamp_camsync_{cam_name}.tsv.
+    Params:
+        cameras (list of XimeaCamera): opened, acquiring cameras
+        image_handles (list of Ximea Image): image handle of each camera
+        cam_names (list of str): name of each camera, used for folder and file names
+        frame_size (int): size of one raw frame in bytes, sets the ring slot size (see
+            camera_frame_size for packed pixel formats)
+        ring_slots (int): number of preallocated frames per camera between acquisition and saving
+        ring_policy (str): 'block' or 'overwrite' when the saver falls behind (see FrameRing)
+        writer_mode (str): 'thread' saves from threads in this process, 'process' runs
+            the savers in writer processes fed through shared memory rings, so saving
+            does not compete with the world process for the GIL
+        writer_procs (int): number of writer processes shared by all cameras in
+            'process' mode (cameras are dealt round robin), 0 for one per camera
+        disk_budget (ximea_writers.DiskBudget): byte/free space budget shared by all
+            cameras, recording stops when it runs out
+        chunk_metas (list of ximea_container.chunk_meta): header info for indexed chunks
+        preview_every (int): hand every Nth recorded frame of each camera to a
+            PreviewTap for the live preview, 0 for no preview while recording
+        clock_sample_hz (float): camera/pupil clock samples per second during the
+            recording, 0 for only the pre/post sync (see ximea_clock)
+        prerolls (list of ximea_preroll.PreRollWorker or None): pre-roll of each camera,
+            its ring (holding the last frames before now) becomes the camera's frame ring
+            and is saved ahead of the live frames
+        realtime (bool): low jitter mode while recording (see ximea_realtime): hold off
+            cyclic GC (gc_mode 'freeze' or 'disable'), pin acquisition threads and writers
+            to dedicated cores (from realtime_cores, default all but the first two) and
+            set their nice value to realtime_nice where permitted
+        proxy_every (int): also write a low resolution proxy of every Nth recorded frame
+            of each camera (binned by proxy_step, JPEG at proxy_quality) to
+            save_dir/proxy_{cam_name}.mjpeg from a low priority thread that skips frames
+            when it falls behind (see ximea_proxy), 0 for no proxy
+        save_options: passed on to save_queue_worker (write_backend, chunk_format,
+            compression, compress_workers, timestamp_tsv, stripe_dirs, stripe_mode, preallocate,
+            sync_policy, sync_interval, adaptive_chunks, min_ims_per_file, max_ims_per_file,
+            chunk_probe_seconds)
+    Returns:
+        save_queues (list of FrameRing or SharedFrameRing): ring of each camera (for their stats)
+        preview_taps (list of PreviewTap or None): preview tap of each camera
+        healths (list of ximea_health.PipelineHealth): live counters of each camera
+    '''
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    n_cams = len(cameras)
+    chunk_metas = chunk_metas or [None]*n_cams
+
+    if(writer_mode == 'process'):
+        ring_class, event_class = SharedFrameRing, mp.Event
+    elif(writer_mode == 'thread'):
+        ring_class, event_class = FrameRing, threading.Event
+    else:
+        raise ValueError(f'Unknown writer mode {writer_mode}')
+    save_stops = [event_class() for _ in range(n_cams)]
+    save_savings = [event_class() for _ in range(n_cams)]
+
+    save_queues = []
+    n_preroll = []
+    for k, preroll in enumerate(prerolls or [None]*n_cams):
+        if preroll is not None and (preroll.writer_mode != writer_mode or preroll.ring.frame_size != frame_size):
+            logger.info(f'Pre-roll of {cam_names[k]} was made for another writer mode or frame size, dropping it')
+            preroll.stop()
+            preroll = None
+        if preroll is not None:
+            try:
+                ring, n_frames = preroll.handover()
+            except RuntimeError as e:
+                logger.info(f'PRE-ROLL OF {cam_names[k]} LOST: {e}')
+                preroll = None
+        if preroll is None:
+            save_queues.append(ring_class(ring_slots, frame_size, ring_policy))
+            n_preroll.append(0)
+            continue
+        ring.policy = ring_policy
+        save_queues.append(ring)
+        n_preroll.append(n_frames)
+        logger.info(f'Saving {n_frames} frames of pre-roll from {cam_names[k]}')
+
+    healths = [PipelineHealth(cam_names[k], save_queues[k].n_slots) for k in range(n_cams)]
+
+    n_procs = min(writer_procs or n_cams, n_cams) if writer_mode == 'process' else n_cams
+    if realtime:
+        acq_cores, writer_cores = plan_cores(n_cams, n_procs, realtime_cores)
+        logger.info(f'Low jitter mode: acquisition on cores {acq_cores}, writers on {writer_cores}, gc {gc_mode}')
+        hold_gc(gc_mode)
+        realtime_acq = [dict(cpu_cores=acq_cores[k], nice=realtime_nice) for k in range(n_cams)]
+        realtime_save = dict(cpu_cores=writer_cores, nice=realtime_nice)
+    else:
+        realtime_acq = [{} for k in range(n_cams)]
+        realtime_save = {}
+
+    save_jobs = []
+    for k in range(n_cams):
+        save_jobs.append(((cam_names[k], save_queues[k],
+                           save_dir, ims_per_file,
+                           save_stops[k],
+                           save_savings[k],
+                           logger),
+                          dict(save_options, chunk_meta=chunk_metas[k], disk_budget=disk_budget, health=healths[k],
+                               preroll_frames=n_preroll[k], **realtime_save)))
+
+    if(writer_mode == 'process'):
+        save_procs = [mp.Process(target=save_process_worker, args=(save_jobs[p::n_procs], gc_mode if realtime else 'none'))
+                      for p in range(n_procs)]
+    else:
+        save_procs = [threading.Thread(target=save_queue_worker, args=args, kwargs=kwargs) for args, kwargs in save_jobs]
+
+    preview_taps = [PreviewTap(ring, preview_every) if preview_every else None for ring in save_queues]
+
+    proxy_taps = [None]*n_cams
+    proxies = []
+    if proxy_every:
+        for k in range(n_cams):
+            if chunk_metas[k] is None:
+                logger.info(f'No frame shape known for {cam_names[k]}, recording it without proxy')
+                continue
+            proxy_taps[k] = PreviewTap(save_queues[k], proxy_every)
+            proxies.append(ProxyWriter(proxy_taps[k], save_dir, cam_names[k],
+                                       (chunk_metas[k].height, chunk_metas[k].width),
+                                       chunk_metas[k].dtype, chunk_metas[k].bayer,
+                                       proxy_step, proxy_quality, logger=logger))
+
+    acq_procs = []
+    for k in range(n_cams):
+        acq_procs.append(threading.Thread(target=aquire_camera_worker,
+                                          args=(cameras[k],
+                                                image_handles[k],
+                                                cam_names[k],
+                                                queue.Queue(),
+                                                save_queues[k],
+                                                save_dir,
+                                                stop_collecting,
+                                                threading.Event(),
+                                                g_pool,
+                                                logger),
+                                          kwargs=dict(disk_budget=disk_budget, preview_tap=preview_taps[k],
+                                                      clock_sample_hz=clock_sample_hz, health=healths[k],
+                                                      frame_nbytes=frame_size_of(chunk_metas[k]) if chunk_metas[k] is not None else None,
+                                                      proxy_tap=proxy_taps[k], **realtime_acq[k])))
+    for save_proc in save_procs:
+        save_proc.daemon = True
+        save_proc.start()
+    for proxy in proxies:
+        proxy.start()
+    for acq_proc in acq_procs:
+        acq_proc.daemon = False
+        acq_proc.start()
+
+    watch_proc = threading.Thread(target=watch_pipelines,
+                                  args=(acq_procs, save_procs,
+                                        save_stops, save_savings, save_queues,
+                                        currently_recording, currently_saving,
+                                        healths, save_dir, realtime, proxies))
+    watch_proc.daemon = True
+    watch_proc.start()
+
+    return(save_queues, preview_taps, healths)
 
 def start_ximea_aquisition(camera, image_handle,
                             save_dir, ims_per_file,
@@ -241,37 +805,26 @@ def start_ximea_aquisition(camera, image_handle,
                             currently_recording,
                             currently_saving,
                             g_pool,
-                            logger):
-
-    save_queue = queue.Queue()
-    sync_queue = queue.Queue()
-
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-
-    cam_name = 'ximea'
-    save_proc = threading.Thread(target=save_queue_worker,
-                            args=(cam_name, save_queue,
-                                 save_dir, ims_per_file,
-                                 stop_collecting,
-                                 currently_saving,
-                                 logger))
-
-
-    acq_proc = threading.Thread(target=aquire_camera_worker,
-                          args=(camera,
-                                image_handle,
-                                cam_name,
-                                sync_queue,
-                                save_queue,
-                                save_dir,
-                                stop_collecting,
-                                currently_recording,
-                                g_pool,
-                                logger))
-    save_proc.daemon = True
-    save_proc.start()
-    acq_proc.daemon = False
-    acq_proc.start()
-
-    return(save_queue)
+                            logger,
+                            chunk_meta=None,
+                            cam_name='ximea',
+                            **options):
+    '''
+    Start the acquisition and save workers for a single ximea camera.
+    Takes the same options as start_multi_ximea_aquisition (frame_size, ring_slots,
+    ring_policy, writer_mode, disk_budget, preview_every, write_backend, chunk_format, compression, ...)
+    Returns:
+        save_queue (FrameRing or SharedFrameRing): ring the frames are handed over in (for its stats)
+        preview_tap (PreviewTap or None): tap of recorded frames for the preview
+        health (PipelineHealth): live counters of the pipeline
+    '''
+    save_queues, preview_taps, healths = start_multi_ximea_aquisition([camera], [image_handle], [cam_name],
+                                               save_dir, ims_per_file,
+                                               stop_collecting,
+                                               currently_recording,
+                                               currently_saving,
+                                               g_pool,
+                                               logger,
+                                               chunk_metas=[chunk_meta],
+                                               **options)
+    return(save_queues[0], preview_taps[0], healths[0])
@@ -0,0 +1,424 @@
+import os as os
+import shutil
+import multiprocessing as mp
+import errno
+import fcntl
+import mmap
+import numpy as np
+import threading
+import time
+
+PAGE_SIZE = mmap.PAGESIZE
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+WRITE_BACKENDS = ('buffered', 'direct')
+SYNC_POLICIES = ('chunk', 'interval', 'stop')
+
+def align_up(n, align=PAGE_SIZE):
+    '''
+    Round n up to the next multiple of align
+    '''
+    return(-(-n // align) * align)
+
+def write_all(fd, data):
+    '''
+    os.write until every byte of data is written (os.write may write less than asked)
+    '''
+    data = memoryview(data).cast('B')
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+    return(written)
+
+def preallocate_file(fd, nbytes):
+    '''
+    Reserve nbytes of disk for an empty file up front (fallocate), so writing it doesn't
+    allocate blocks (and update metadata) write by write and the file isn't fragmented.
+    Returns:
+        done (bool): False if the filesystem doesn't support it (the file just grows as before)
+    '''
+    if nbytes <= 0 or not hasattr(os, 'posix_fallocate'):
+        return(False)
+    try:
+        os.posix_fallocate(fd, 0, nbytes)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise
+        return(False)
+    return(True)
+
+class ChunkSyncer():
+    '''
+    When chunk files are fdatasync'ed, shared by the chunk files of a saver (thread safe,
+    stripe writer threads share one: the lock only covers the bookkeeping, the syncs of
+    different disks run in parallel).
+        'chunk': every chunk is synced as it is closed
+        'interval': the open chunk, and the chunks closed since, are synced every interval seconds
+        'stop': everything is synced once, by finish() at the end of the recording
+    Writes themselves never wait for the disk, so write latency stays flat; the policy
+    only bounds how much is lost if the machine goes down.
+    Params:
+        policy (str): 'chunk', 'interval' or 'stop'
+        interval (float): seconds between syncs for the 'interval' policy
+    '''
+    def __init__(self, policy='chunk', interval=5.0):
+        if policy not in SYNC_POLICIES:
+            raise ValueError(f'Unknown sync policy {policy}, use one of {SYNC_POLICIES}')
+        self.policy = policy
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.unsynced = []
+        self.last_sync = time.monotonic()
+        self.n_syncs = 0
+        self.sync_seconds = 0.0
+
+    def _sync_fd(self, fd):
+        #outside the lock, so the stripe writers sync their disks in parallel
+        t_sync = time.perf_counter()
+        os.fdatasync(fd)
+        with self.lock:
+            self.sync_seconds += time.perf_counter() - t_sync
+            self.n_syncs += 1
+
+    def _take_unsynced(self):
+        with self.lock:
+            unsynced, self.unsynced = self.unsynced, []
+            self.last_sync = time.monotonic()
+        return(unsynced)
+
+    def _sync_files(self, file_names):
+        #fdatasync through a new descriptor flushes whatever the closed one left dirty
+        for file_name in file_names:
+            try:
+                fd = os.open(file_name, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                self._sync_fd(fd)
+            finally:
+                os.close(fd)
+
+    def wrote(self, chunk_file):
+        '''
+        Called after every write to an open chunk file
+        '''
+        if(self.policy != 'interval' or time.monotonic() - self.last_sync < self.interval):
+            return
+        with self.lock:
+            #another writer may have just taken this interval's sync
+            if time.monotonic() - self.last_sync < self.interval:
+                return
+            unsynced, self.unsynced = self.unsynced, []
+            self.last_sync = time.monotonic()
+        self._sync_fd(chunk_file.fd)
+        self._sync_files(unsynced)
+
+    def closing(self, chunk_file):
+        '''
+        Called when a chunk file is done, before its descriptor is closed
+        '''
+        if(self.policy == 'chunk'):
+            self._sync_fd(chunk_file.fd)
+        else:
+            with self.lock:
+                self.unsynced.append(chunk_file.file_name)
+
+    def finish(self):
+        '''
+        Sync every chunk not synced yet (end of the recording)
+        '''
+        self._sync_files(self._take_unsynced())
+
+class BufferedChunkFile():
+    '''
+    Plain write() backend going through the page cache.
+    Params:
+        file_name (str): path of the chunk file to create (truncated if it exists)
+        sync (bool): open with O_SYNC so every write waits for the disk
+        preallocate (int): bytes to fallocate up front, the file is truncated back to
+            what was written on close
+        syncer (ChunkSyncer): fdatasync policy, None to leave it to the OS
+    '''
+    direct = False
+
+    def __init__(self, file_name, sync=False, preallocate=0, syncer=None):
+        self.file_name = file_name
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if(sync):
+            flags |= os.O_SYNC
+        self.fd = os.open(file_name, flags, 0o666)
+        self.preallocated = preallocate_file(self.fd, preallocate)
+        self.syncer = syncer
+        self.size = 0
+
+    def write(self, data):
+        self.size += write_all(self.fd, data)
+        if self.syncer is not None:
+            self.syncer.wrote(self)
+
+    def write_at(self, offset, data):
+        '''
+        Overwrite already written bytes (ie a header) without moving the append position
+        '''
+        os.pwrite(self.fd, data, offset)
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            if self.preallocated:
+                #give back the preallocated space a partial chunk didn't use
+                os.ftruncate(self.fd, self.size)
+            if self.syncer is not None:
+                self.syncer.closing(self)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+class DirectChunkFile():
+    '''
+    O_DIRECT backend that keeps chunk files out of the page cache.
+
+    O_DIRECT needs the memory address, file offset and length of every write to be
+    block aligned, so frames are copied into a page aligned staging buffer (an
+    anonymous mmap) that is written out whenever it fills up. On close the last
+    partial buffer is zero padded to a whole page, written, and the file truncated
+    back to the number of bytes actually written.
+
+    If the filesystem rejects O_DIRECT (EINVAL from open or from the first write,
+    ie tmpfs or some network mounts) the file silently continues as a buffered
+    write, check .direct to find out which one you got.
+
+    Params:
+        file_name (str): path of the chunk file to create (truncated if it exists)
+        sync (bool): also open with O_SYNC so every write waits for the disk
+        buffer_size (int): size of the staging buffer in bytes (rounded up to a page)
+        preallocate (int): bytes to fallocate up front, the file is truncated back to
+            what was written on close
+        syncer (ChunkSyncer): fdatasync policy, None to leave it to the OS
+    '''
+    def __init__(self, file_name, sync=False, buffer_size=16*1024*1024, preallocate=0, syncer=None):
+        self.file_name = file_name
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if(sync):
+            flags |= os.O_SYNC
+        self.direct = bool(O_DIRECT)
+        try:
+            self.fd = os.open(file_name, flags | O_DIRECT, 0o666)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            self.direct = False
+            self.fd = os.open(file_name, flags, 0o666)
+        self.preallocated = preallocate_file(self.fd, preallocate)
+        self.syncer = syncer
+        self.buffer = mmap.mmap(-1, align_up(buffer_size))
+        self.staged = memoryview(self.buffer)
+        self.fill = 0
+        self.size = 0
+        self.written = 0
+
+    def _drop_direct(self):
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~O_DIRECT)
+        self.direct = False
+
+    def _flush(self, n):
+        try:
+            write_all(self.fd, self.staged[:n])
+        except OSError as e:
+            if not (e.errno == errno.EINVAL and self.direct and self.written == 0):
+                raise
+            #first write refused, the filesystem doesn't do O_DIRECT after all
+            self._drop_direct()
+            write_all(self.fd, self.staged[:n])
+        self.written += n
+        self.fill = 0
+        if self.syncer is not None:
+            self.syncer.wrote(self)
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        pos = 0
+        while pos < len(data):
+            n = min(len(data) - pos, len(self.staged) - self.fill)
+            self.staged[self.fill:self.fill+n] = data[pos:pos+n]
+            self.fill += n
+            self.size += n
+            pos += n
+            if self.fill == len(self.staged):
+                self._flush(self.fill)
+
+    def write_at(self, offset, data):
+        '''
+        Overwrite already written bytes (ie a header) without moving the append position.
+        Bytes still in the staging buffer are patched there, bytes already on disk are
+        rewritten with an aligned pwrite (offset and len(data) must be page aligned).
+        '''
+        data = memoryview(data).cast('B')
+        if offset >= self.written:
+            start = offset - self.written
+            if start + len(data) > self.fill:
+                raise ValueError('write_at past the end of the chunk')
+            self.staged[start:start+len(data)] = data
+            return
+        if offset + len(data) > self.written:
+            raise ValueError('write_at on an O_DIRECT chunk cannot straddle the staging buffer')
+        if offset % PAGE_SIZE or len(data) % PAGE_SIZE:
+            raise ValueError('write_at on an O_DIRECT chunk needs page aligned offset and size')
+        page = mmap.mmap(-1, len(data))
+        try:
+            page[:] = data
+            os.pwrite(self.fd, page, offset)
+        finally:
+            page.close()
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            if self.fill:
+                padded = align_up(self.fill)
+                self.staged[self.fill:padded] = bytes(padded - self.fill)
+                self._flush(padded)
+            if self.written != self.size or self.preallocated:
+                os.ftruncate(self.fd, self.size)
+            if self.syncer is not None:
+                self.syncer.closing(self)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            self.staged.release()
+            self.buffer.close()
+
+def open_chunk_file(file_name, backend='buffered', **kwargs):
+    '''
+    Open a chunk file for writing with the chosen backend.
+    Params:
+        file_name (str): path of the chunk file
+        backend (str): 'buffered' or 'direct' (O_DIRECT, see DirectChunkFile)
+        kwargs: passed on to the backend (ie preallocate, syncer)
+    Returns:
+        chunk_file (BufferedChunkFile or DirectChunkFile): has write(data), close(), size, direct
+    '''
+    if(backend == 'direct'):
+        return(DirectChunkFile(file_name, **kwargs))
+    elif(backend == 'buffered'):
+        return(BufferedChunkFile(file_name, **kwargs))
+    raise ValueError(f'Unknown write backend {backend}, use one of {WRITE_BACKENDS}')
+
+class ChunkSizer():
+    '''
+    Frames per chunk file for a saver, fixed or adaptive.
+
+    Adaptive sizing probes first: for probe_seconds the saver writes small chunks of
+    alternating sizes (min_ims_per_file, twice and four times that) and reports how long
+    each took from open to close. A line fit of chunk time against frames gives the
+    per file overhead (open, fallocate, close, sync) and the time per frame on this
+    disk, and the chunk size is then fixed at the smallest one whose overhead is at
+    most overhead_target of its write time, within [min_ims_per_file, max_ims_per_file].
+    Thread safe: stripe writer threads report chunks while the save loop asks for sizes.
+    Params:
+        ims_per_file (int): the fixed chunk size (when not adaptive)
+        adaptive (bool): probe and choose the size instead
+        min_ims_per_file (int): smallest chunk, and the size probing starts from
+        max_ims_per_file (int): largest chunk
+        probe_seconds (float): how long to probe before choosing
+        overhead_target (float): acceptable fraction of per file overhead
+        logger (instace of class logger): used to pass messages to gui
+    '''
+    def __init__(self, ims_per_file=400, adaptive=False, min_ims_per_file=50, max_ims_per_file=2000,
+                 probe_seconds=3.0, overhead_target=0.02, logger=None):
+        self.ims_per_file = int(ims_per_file)
+        self.adaptive = adaptive
+        self.min_ims_per_file = max(1, int(min_ims_per_file))
+        self.max_ims_per_file = max(self.min_ims_per_file, int(max_ims_per_file))
+        self.probe_seconds = probe_seconds
+        self.overhead_target = overhead_target
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.samples = []
+        self.n_probes = 0
+        self.t_start = None
+        self.chosen = None if adaptive else self.ims_per_file
+        self.fit = None
+
+    @property
+    def probing(self):
+        return(self.chosen is None)
+
+    def next_size(self):
+        '''
+        Frames for the next chunk
+        '''
+        if self.chosen is not None:
+            return(self.chosen)
+        if self.t_start is None:
+            self.t_start = time.monotonic()
+        if time.monotonic() - self.t_start >= self.probe_seconds:
+            with self.lock:
+                self._choose()
+            if self.chosen is not None:
+                return(self.chosen)
+        sizes = [min(self.min_ims_per_file * m, self.max_ims_per_file) for m in (1, 2, 4)]
+        size = sizes[self.n_probes % len(sizes)]
+        self.n_probes += 1
+        return(size)
+
+    def chunk_done(self, n_frames, seconds):
+        '''
+        Report a written chunk: its frames and seconds from open to close
+        '''
+        if self.chosen is None and n_frames:
+            with self.lock:
+                self.samples.append((n_frames, seconds))
+
+    def _choose(self):
+        if len(self.samples) < 3 or len(set(n for n, _ in self.samples)) < 2:
+            #not enough chunks written yet (slow camera), keep probing
+            return
+        n, t = np.array(self.samples, dtype=np.float64).T
+        per_frame, overhead = np.polyfit(n, t, 1)
+        if per_frame <= 0:
+            size = self.ims_per_file
+        elif overhead <= 0:
+            size = self.min_ims_per_file
+        else:
+            size = overhead * (1 - self.overhead_target) / (self.overhead_target * per_frame)
+        self.chosen = int(np.clip(round(size), self.min_ims_per_file, self.max_ims_per_file))
+        self.fit = (overhead, per_frame)
+        if self.logger is not None:
+            self.logger.info(f'Chunk size set to {self.chosen} frames (per file overhead {overhead*1e3:.1f} ms, '
+                             f'{per_frame*1e3:.2f} ms per frame over {len(self.samples)} probe chunks)')
+
+class DiskBudget():
+    '''
+    Disk budget shared by every camera (and writer process) of a recording. Savers
+    add() the bytes of each finished chunk and check() the budget before starting the
+    next one, once it runs out the exhausted event tells the acquisition threads to
+    stop (the savers then drain what is already buffered).
+    Params:
+        max_bytes (int): total bytes the recording may write, 0 for no limit
+        min_free_bytes (int): stop when the target filesystem has less free space than this
+    '''
+    def __init__(self, max_bytes=0, min_free_bytes=0):
+        self.max_bytes = int(max_bytes)
+        self.min_free_bytes = int(min_free_bytes)
+        self.written = mp.Value('q', 0)
+        self.exhausted_event = mp.Event()
+
+    def add(self, nbytes):
+        with self.written.get_lock():
+            self.written.value += nbytes
+
+    def check(self, folder):
+        '''
+        Is the budget used up? (sets the exhausted event if so)
+        '''
+        over = self.max_bytes and self.written.value >= self.max_bytes
+        low = self.min_free_bytes and shutil.disk_usage(folder).free < self.min_free_bytes
+        if over or low:
+            self.exhausted_event.set()
+        return(self.exhausted())
+
+    def exhausted(self):
+        return(self.exhausted_event.is_set())